@@ -13,9 +13,25 @@ DIIGO_URL = "https://secure.diigo.com/api/v2/"
 CONFIG_PATH = "~/.ncdbookmarks/config.yaml"
 SAMPLE_CONFIG_PATH = "./sample_config.yaml"
 SESSION_PATH = "~/.ncdbookmarks/session_cookies.yaml"
+# Local SQLite copy of the Nextcloud bookmarks
+MIRROR_PATH = "~/.ncdbookmarks/nc_mirror.sqlite"
+# Progress of an interrupted Diigo -> Nextcloud migration
+JOURNAL_PATH = "~/.ncdbookmarks/migration_journal.jsonl"
+# Progress of the LLM descriptions for the Nextcloud bookmarks (nc_llm_improve.py)
+LLM_QUEUE_PATH = "~/.ncdbookmarks/llm_queue.sqlite"
+# Web pages read for the LLM descriptions
+PAGE_CACHE_PATH = "~/.ncdbookmarks/page_cache"
+# LLM answers, so they are not computed twice
+LLM_CACHE_PATH = "~/.ncdbookmarks/llm_cache.sqlite"
+LINK_REPORT_PATH = "~/.ncdbookmarks/link_check.csv"
+DEDUP_REPORT_PATH = "~/.ncdbookmarks/duplicates.csv"
+TAG_MERGE_PLAN_PATH = "~/.ncdbookmarks/tag_merge_plan.json"
+# Tag statistics, kept up to date with the mirror
+TAG_INDEX_PATH = "~/.ncdbookmarks/tags.json"
+# Embeddings of the bookmarks, for suggesting tags
+EMBEDDINGS_PATH = "~/.ncdbookmarks/embeddings.npz"
 
 b_path = "../data/802697_csv_2024_05_08_9389e.csv"
-tags_path = "../data/tags.json"
 
 # Diigo batch size for exporting and deleting -> moved to config.yaml
 # diigo_batch_size = 100 
@@ -137,6 +153,16 @@ def setup_config_dir():
     write_config(path,sample_config)
     return True
 
+# Read an optional top-level setting from the config, 
+# falling back to default if there is no config file or the key is not set.
+def get_setting(key, default=None):
+    if config is None:
+        return default
+    value = config.get(key)
+    if value is None:
+        return default
+    return value
+
 # config
 # Global variable nastiness
 config = get_config(CONFIG_PATH)
@@ -156,4 +182,17 @@ content of a website, condensed to one paragraph.
 Check the DESCRIPTION and add what is missing
 """
 
+# For pages too long for one prompt: summarize each part first
+summarize_chunk_de_p = """
+        Du bist Bibliothekar. Fasse diesen Teil des Inhalts einer Website 
+        in wenigen Sätzen zusammen. Lass Navigation, Werbung und 
+        Wiederholungen weg.
+        """
+
+summarize_chunk_en_p = """
+You are a librarian. Summarize this part of the content of a website 
+in a few sentences. Leave out navigation, ads, and repetitions.
+"""
+
 summarize_prompt = summarize_de_p
+summarize_chunk_prompt = summarize_chunk_de_p
@@ -0,0 +1,230 @@
+# dedup.py
+#
+# Find (and optionally merge) duplicate bookmarks.
+#
+# Two kinds of duplicates:
+# - the same address in different spellings: http/https, "www.", trailing
+#   slashes, tracking parameters... These are found by grouping on the
+#   canonical URL (process.canonical_url) - one pass with a dict, a hash join.
+# - the same article under a different address, or with a slightly changed
+#   title: found by MinHash over character shingles of title and description.
+#   Each bookmark gets a signature of num_perm minimum hashes; the signatures
+#   are cut into bands, and bookmarks sharing a band end up in the same
+#   bucket (locality-sensitive hashing). Only bookmarks in the same bucket are
+#   compared: 100k bookmarks take some 15 seconds, not 5 billion comparisons.
+#
+# Both are joined into clusters. A cluster whose addresses differ only in
+# scheme, "www.", trailing slash or utm_ parameters is safe to merge; all
+# others (text similarity, or a canonical URL that dropped a fragment or a
+# tracking parameter) are reported, and only merged on request.
+#
+#   clusters = find_duplicates(bookmarks)
+#   write_dedup_report(clusters)
+
+import os
+import re
+import csv
+from collections import defaultdict
+
+import numpy as np
+
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from config import *
+from process import canonical_url, better_desc
+from nc_bookmarks_api import bulk_edit_nc_bookmarks, delete_nc_bookmark
+
+
+# The address with only the differences that never change the page folded:
+# scheme, "www.", trailing slash and utm_ parameters. Bookmarks that agree on
+# it are the same page for sure; canonical_url goes further.
+def plain_url(url):
+    u = urlsplit(str(url).strip())
+    host = u.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    query = [(k, v) for k, v in parse_qsl(u.query, keep_blank_values=True)
+             if not k.lower().startswith('utm_')]
+    return urlunsplit(('', host, u.path.rstrip('/'), urlencode(query), u.fragment))
+
+# Title and description - without the LLM summary, which is derived from the page
+def dedup_text(b):
+    description = str(b.get('description', "")).split("# LLM_DESCRIPTION")[0]
+    return f"{b.get('title', '')} {description}"
+
+# Byte 5-grams of the normalized text, each packed into one integer
+# (5 bytes = 40 bits, so no hashing and no collisions), as a NumPy array
+# without repetitions
+def shingles(text, k = 5):
+    t = " ".join(re.sub(r'[^\w]+', ' ', str(text).lower()).split())
+    b = np.frombuffer(t.encode('utf-8'), dtype = np.uint8).astype(np.uint64)
+    if len(b) < k:
+        return np.zeros(0, dtype = np.uint64)
+    x = np.zeros(len(b) - k + 1, dtype = np.uint64)
+    for j in range(k):
+        x = (x << np.uint64(8)) | b[j:len(b) - k + 1 + j]
+    return np.unique(x)
+
+class MinHasher:
+    """
+    MinHash signatures with one permutation: every shingle is hashed once
+    (multiply-shift), the hash picks one of num_perm bins and each bin keeps its
+    minimum - instead of num_perm hash functions over all shingles. Empty bins
+    take the value of the next filled bin to the right (densification), so
+    similar bookmarks still agree on them.
+    """
+    def __init__(self, num_perm = 64, seed = 1):
+        rng = np.random.default_rng(seed)
+        # a must be odd
+        self.a = np.uint64(int(rng.integers(0, 1 << 62)) * 2 + 1)
+        self.b = np.uint64(int(rng.integers(0, 1 << 62)))
+        self.num_perm = num_perm
+
+    # Signatures for a list of shingle arrays (none of them empty), as one
+    # matrix with a row per array
+    def signatures(self, shingle_arrays):
+        n = len(shingle_arrays)
+        k = self.num_perm
+        x = np.concatenate(shingle_arrays)
+        doc = np.repeat(np.arange(n), [len(a) for a in shingle_arrays])
+        with np.errstate(over = 'ignore'):
+            h = (x * self.a + self.b) >> np.uint64(32)
+        bins = (h % np.uint64(k)).astype(np.int64)
+        empty = np.uint64(1 << 63)
+        base = np.full((n, k), empty, dtype = np.uint64)
+        np.minimum.at(base, (doc, bins), h // np.uint64(k))
+        # Densification: an empty bin takes the value of the bin `shift` to
+        # its right (plus an offset for the distance)
+        result = base.copy()
+        missing = base == empty
+        shift = 1
+        while missing.any() and shift < k:
+            source = np.roll(base, -shift, axis = 1)
+            fill = missing & (source != empty)
+            result[fill] = source[fill] + np.uint64(shift << 40)
+            missing &= ~fill
+            shift += 1
+        return result
+
+# Pairs of indices whose signatures agree on at least one whole band.
+# Buckets with more than max_bucket members (boilerplate like "Home") are skipped.
+def lsh_candidates(signatures, bands = 16, max_bucket = 50):
+    rows = signatures.shape[1] // bands
+    pairs = set()
+    for band in range(bands):
+        buckets = defaultdict(list)
+        chunk = signatures[:, band*rows:(band+1)*rows]
+        for i in range(len(signatures)):
+            buckets[chunk[i].tobytes()].append(i)
+        for members in buckets.values():
+            if len(members) < 2 or len(members) > max_bucket:
+                continue
+            for j, a in enumerate(members):
+                for b in members[j+1:]:
+                    pairs.add((a, b))
+    return pairs
+
+class UnionFind:
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i, j):
+        self.parent[self.find(i)] = self.find(j)
+
+# Clusters of duplicate bookmarks (dicts with 'url', 'title', 'description').
+# threshold: estimated Jaccard similarity of the shingles above which two
+# bookmarks count as the same text (config: dedup_threshold); texts with fewer
+# than min_shingles shingles are only matched by URL.
+# Returns a list of dicts, biggest clusters first:
+#   'bookmarks': the bookmarks in the cluster
+#   'reason': 'url' if all of them have the same address (see plain_url) - safe
+#             to merge - 'text' otherwise, even if the canonical URLs agree
+def find_duplicates(bookmarks, threshold = None, num_perm = 64, bands = 16, min_shingles = 20):
+    if threshold == None:
+        threshold = get_setting('dedup_threshold', 0.7)
+    bookmarks = list(bookmarks)
+    uf = UnionFind(len(bookmarks))
+    # Same canonical URL
+    by_url = {}
+    canonical = []
+    for i, b in enumerate(bookmarks):
+        c = canonical_url(b.get('url', ""))
+        canonical.append(c)
+        if c in by_url:
+            uf.union(i, by_url[c])
+        else:
+            by_url[c] = i
+    # Similar text: only one bookmark per canonical URL needs a signature
+    candidates = []
+    shingle_arrays = []
+    for c, i in by_url.items():
+        s = shingles(dedup_text(bookmarks[i]))
+        if len(s) >= min_shingles:
+            candidates.append(i)
+            shingle_arrays.append(s)
+    if len(candidates) > 1:
+        signatures = MinHasher(num_perm).signatures(shingle_arrays)
+        for a, b in lsh_candidates(signatures, bands):
+            similarity = np.mean(signatures[a] == signatures[b])
+            if similarity >= threshold:
+                uf.union(candidates[a], candidates[b])
+    groups = defaultdict(list)
+    for i in range(len(bookmarks)):
+        groups[uf.find(i)].append(i)
+    clusters = []
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        same = len({plain_url(bookmarks[i].get('url', "")) for i in members}) == 1
+        reason = 'url' if same else 'text'
+        clusters.append({'bookmarks': [bookmarks[i] for i in members], 'reason': reason})
+    clusters.sort(key = lambda c: -len(c['bookmarks']))
+    return clusters
+
+# Merge a cluster into its oldest bookmark: all tags and folders,
+# the better description. Returns (merged bookmark, list of the others).
+def merge_cluster(cluster):
+    bookmarks = sorted(cluster['bookmarks'], key = lambda b: (b.get('added') or 0))
+    keep = dict(bookmarks[0])
+    for b in bookmarks[1:]:
+        keep['tags'] = keep.get('tags', []) + [t for t in b.get('tags', []) if t not in keep.get('tags', [])]
+        keep['folders'] = keep.get('folders', []) + [f for f in b.get('folders', []) if f not in keep.get('folders', [])]
+        keep['description'] = better_desc(str(keep.get('description', "")), str(b.get('description', "")))
+    return keep, bookmarks[1:]
+
+def write_dedup_report(clusters, path = DEDUP_REPORT_PATH):
+    path = os.path.expanduser(path)
+    with open(path, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(['cluster', 'reason', 'id', 'url', 'title'])
+        for n, c in enumerate(clusters):
+            for b in c['bookmarks']:
+                writer.writerow([n, c['reason'], b.get('id'), b.get('url'), b.get('title')])
+    return path
+
+# Merge the clusters in Nextcloud: the merged bookmark is written, the others
+# are deleted, and the mirror is updated. Clusters found by text similarity are
+# only merged with include_text. Returns the number of bookmarks deleted.
+def merge_nc_duplicates(clusters, mirror, include_text = False, silent = False):
+    merges = [merge_cluster(c) for c in clusters if c['reason'] == 'url' or include_text]
+    if merges == []:
+        return 0
+    keepers = [keep for keep, _ in merges]
+    result = bulk_edit_nc_bookmarks(keepers, silent = silent)
+    n = 0
+    for (keep, others), id in zip(merges, result['ids']):
+        if id == None:
+            # Do not delete anything we could not merge into the keeper
+            continue
+        mirror.upsert(keep)
+        for b in others:
+            if delete_nc_bookmark(b['id']):
+                mirror.delete(b['id'])
+                n += 1
+    return n
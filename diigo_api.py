@@ -12,13 +12,18 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 import logging
+import threading
 from http.client import HTTPConnection
 
 
 from config import *
+from rate_limit import get_limiter
+from pipeline import Pipeline
+from journal import Journal
 from import_export import update_bookmarks, move_backup, inspect_file
 from process import refactor_diigo_bookmark, suggest_description, suggest_tags
-from nc_bookmarks_api import edit_nc_bookmark, get_nc_folder
+from llm_pool import get_llm_pool
+from nc_bookmarks_api import edit_nc_bookmark, get_nc_folder, get_nc_folders_ids
     
 
 # Sample API call: https://secure.diigo.com/api/v2/bookmarks?key=your_api_key&user=joel&count=10
@@ -73,7 +78,8 @@ def get_diigo_bookmarks(d_start = 0, d_count= 10, tags=""):
         d_params['start'] = d_start
     if d_count != 10: 
         d_params['count'] = d_count
-    response = requests.get("https://secure.diigo.com/api/v2/bookmarks",
+    response = get_limiter('diigo_api').call(requests.get,
+                            "https://secure.diigo.com/api/v2/bookmarks",
                             params = d_params,
                             headers= AUTH_HEADERS,
                             auth=(config['diigo']['user'], config['diigo']['password']),
@@ -126,8 +132,10 @@ def write_diigo_bookmark(title,url, # these are required, i.e. they ID the bookm
         'readLater': f'{"yes" if readLater else "no"}',
         'merge': f'{"yes" if merge else "no"}',
     }
-    response = requests.post("https://secure.diigo.com/api/v2/bookmarks",
+    response = get_limiter('diigo_api').call(requests.post,
+                            "https://secure.diigo.com/api/v2/bookmarks",
                             params = d_params,
+                            idempotent = False,
                             headers= AUTH_HEADERS,
                             auth=(config['diigo']['user'], config['diigo']['password']),
                             )
@@ -164,16 +172,14 @@ def delete_diigo_bookmark(title,url,session = None):
         'url': url,
     }
     if session == None: 
-        response = requests.delete("https://secure.diigo.com/api/v2/bookmarksbookmarks",
+        session = requests
+    # Diigo's rate limit for deletes is the tightest; let the limiter find it
+    response = get_limiter('diigo_delete').call(session.delete,
+                                "https://secure.diigo.com/api/v2/bookmarks",
                                 params = d_params,
                                 headers= AUTH_HEADERS,
                                 auth=(diigo_user,diigo_password),
                                 )
-    else: 
-        response = session.delete("https://secure.diigo.com/api/v2/bookmarks",
-                                  params = d_params,
-                                  headers = AUTH_HEADERS,
-                                  auth = (diigo_user,diigo_password))
     if response.status_code == 200:
         return response.json()
     else:
@@ -196,7 +202,7 @@ def probe_dia(session):
     # apikey = config['diigo']['apikey']
     user = config['diigo']['user']    
     password = config['diigo']['password']
-    response = session.get("https://www.diigo.com/interact_api/load_user_items",
+    response = get_limiter('dia').call(session.get, "https://www.diigo.com/interact_api/load_user_items",
                             headers = AUTH_HEADERS,
                             params = {'page_num':0,
                                       'count':1},
@@ -309,7 +315,7 @@ def dia_load_user_items(page_num=0,sort='updated',count=24, session=None):
         'count': count,
     }
     if session != None: 
-        response = session.get("https://www.diigo.com/interact_api/load_user_items",
+        response = get_limiter('dia').call(session.get, "https://www.diigo.com/interact_api/load_user_items",
                             headers = AUTH_HEADERS, 
                             params = d_params,
                             auth=(diigo_user, diigo_password),
@@ -346,7 +352,7 @@ def dia_search_user_items(what="",page_num=0,sort='updated',count=24, session=No
         'count': count,
     }
     if session != None: 
-        response = session.get("https://www.diigo.com/interact_api/search_user_items",
+        response = get_limiter('dia').call(session.get, "https://www.diigo.com/interact_api/search_user_items",
                             headers = AUTH_HEADERS, 
                             params = d_params,
                             auth=(diigo_user, diigo_password),
@@ -410,8 +416,9 @@ def dia_write(title,
     d_headers['Referer'] = f'https://www.diigo.com/user/{diigo_user}?query=test'
 
     if session != None: 
-        response = session.post("https://www.diigo.com/item/save/bookmark",
+        response = get_limiter('dia').call(session.post, "https://www.diigo.com/item/save/bookmark",
                             params = d_params,
+                            idempotent = False,
                             headers= d_headers,
                             auth=(diigo_user,diigo_password),
                             )
@@ -460,8 +467,9 @@ def dia_change_mode_b(link_id, mode=2, session=None, silent = False):
 #    d_headers['Origin'] = 'https://www.diigo.com'
 #    d_headers['Referer'] = f'https://www.diigo.com/user/{diigo_user}?query=test'
     if session != None: 
-        response = session.post("https://www.diigo.com/ditem_mana2/convert_mode",
+        response = get_limiter('dia').call(session.post, "https://www.diigo.com/ditem_mana2/convert_mode",
                             params = d_params,
+                            idempotent = False,
                             headers= d_headers,
                             auth=(diigo_user, diigo_password),
                             )
@@ -500,8 +508,9 @@ def dia_delete_b(link_id, session=None):
     d_headers['Origin'] = 'https://www.diigo.com'
     d_headers['Referer'] = f'https://www.diigo.com/user/{diigo_user}?query=test'
     if session != None: 
-        response = session.post("https://www.diigo.com/ditem_mana2/delete_b",
+        response = get_limiter('dia').call(session.post, "https://www.diigo.com/ditem_mana2/delete_b",
                             params = d_params,
+                            idempotent = False,
                             headers= d_headers,
                             auth=(diigo_user, diigo_password),
                             )
@@ -613,102 +622,201 @@ def dia_privatize():
     session.close()    
     return True
 
-# 
+# Generator over the pages of Diigo bookmarks (each a list of dicts), 
+# stops at the first empty page - the end of the bookmarks. A page that 
+# cannot be read is not the end: raises ConnectionError, so the caller can 
+# tell an incomplete read from a complete one.
+def dia_iter_pages(session, count = 24, sort = 'created_at'):
+    p = 0
+    while True:
+        items = dia_load_user_items(page_num=p, sort=sort, count=count, session=session)
+        if items == None:
+            raise ConnectionError(f"Could not read page {p} of the Diigo bookmarks")
+        if len(items) == 0:
+            return
+        yield items
+        p += 1
+
+# Export all Diigo bookmarks to the dump file, and optionally recreate them in 
+# Nextcloud (improving the description with the LLM) and remove them from Diigo.
+#
+# Runs as a pipeline of stages connected by bounded queues (see pipeline.py):
+#   Diigo fetch -> dump -> LLM enrich -> NC write -> Diigo delete
+# so a slow LLM does not hold up reading and dumping. Worker counts per stage:
+# llm_workers (default: what the Ollama servers take), nc_concurrency; 
+# queue size: pipeline_queue_size.
+#
+# Bookmarks are only removed from Diigo once they are dumped (and, if 
+# create_nextcloud is set, written to Nextcloud). Deleting starts after 
+# all pages have been read - otherwise the pages would shift under the reader.
+#
+# Progress is recorded in a journal (see journal.py). If a run is interrupted,
+# the next one continues the dump file, and skips every stage a bookmark has 
+# already passed.
 def dia_export_delete(create_nextcloud = False,
                       remove_diigo = False,
                       use_llm = False):
     # Get ID of DIIGO folder on Nextcloud (or create if not there)
     if create_nextcloud: 
-        diigo_folder = get_nc_folder(DIIGO_FOLDER)
-        unread_folder = get_nc_folder(UNREAD_FOLDER)
-        private_folder = get_nc_folder(PRIVATE_FOLDER)
-        unreachable_folder = get_nc_folder(UNREACHABLE_FOLDER)
+        # One request for the folder tree, instead of one for each folder
+        diigo_folder, unread_folder, private_folder, unreachable_folder = \
+            get_nc_folders_ids([DIIGO_FOLDER, UNREAD_FOLDER, PRIVATE_FOLDER, UNREACHABLE_FOLDER])
     # Login
     session = dia_login()
-    move_backup(config['diigo_dump_path'])
-    p = 0
     diigo_batch_size = config['diigo_batch_size']
-    # Step through Diigo bookmarks in batches of diigo_batch_size = 100.
+    journal = Journal(batch_size = diigo_batch_size)
+    if journal.resuming():
+        print(f"Resuming interrupted run: {len(journal.entries)} bookmarks already in the journal")
+    else:
+        move_backup(config['diigo_dump_path'])
     print(f"Processing in batches of {diigo_batch_size}") 
-    print(f"Batch progress: (.) Reading (v) Dumping {'(@) AI reflecting ' if use_llm else ''}{'(X) Removing' if remove_diigo else ''} (*) Done")
-    print(".",end="", flush=True)
-    items = dia_load_user_items(page_num=p,
-                                sort = 'created_at',
-                                count= diigo_batch_size,    # defined in config.py
-                                session = session)
-    while len(items) > 0:
-        print("\bv",end = "")
+    print(f"Progress: (.) Reading (v) Dumping {'(@) AI reflecting ' if use_llm else ''}{'(*) Created in Nextcloud ' if create_nextcloud else ''}{'(X) Removing' if remove_diigo else ''}")
+    fetch_done = threading.Event()
+
+    def fetch():
+        # A read failure raises - then fetch_done stays unset, and the run
+        # is not complete
+        for items in dia_iter_pages(session, count = diigo_batch_size):
+            print(".",end="", flush=True)
+            yield items
+        fetch_done.set()
+
+    def dump(items):
         # Add to CSV
-        df = pd.DataFrame(items)
-        # If existing bookmark file is found, move to .bak
-        # Tends to contain empty lists; convert these to strings        
-        update_bookmarks(config['diigo_dump_path'],df)
-
-        # Create Nextcloud Bookmarks if necessary here
-        if create_nextcloud: 
-            for i in items:
-                print("\b^",end="", flush=True)
-                folders = [diigo_folder] 
-                if i['readed'] == 0:
-                    folders.append(unread_folder)
-                if not i['private']: # Yes, it's private if False!
-                    folders.append(private_folder)
-                bookmark_data = refactor_diigo_bookmark(url = i['url'],
-                                                        title = i['title'],
-                                                        description = i['description'],
-                                                        annotations = i['annotations'],
-                                                        comments = 'comments',
-                                                        created_at = i['created_at']
-                                                        )
-                # Assign folders to NC bookmark
-                bookmark_data['folders'] = folders
-                # create bookmark
-                # Use LLM
-                if use_llm:
-                    print("\b@",end="", flush=True)                 
+        new_items = [i for i in items if not journal.done(i['link_id'], 'dumped')]
+        if len(new_items) > 0:
+            df = pd.DataFrame(new_items)
+            if update_bookmarks(config['diigo_dump_path'],df) is None:
+                # Not in the dump - so these must not be deleted either
+                print(f"\nCould not dump {len(new_items)} bookmarks")
+                return None
+            for i in new_items:
+                journal.record(i['link_id'], 'dumped')
+            journal.sync()
+        print("v",end="", flush=True)
+        return items
+
+    def prepare(i):
+        if journal.done(i['link_id'], 'created'):
+            return (i, None)
+        folders = [diigo_folder] 
+        if i['readed'] == 0:
+            folders.append(unread_folder)
+        if not i['private']: # Yes, it's private if False!
+            folders.append(private_folder)
+        bookmark_data = refactor_diigo_bookmark(url = i['url'],
+                                                title = i['title'],
+                                                description = i['description'],
+                                                annotations = i['annotations'],
+                                                comments = 'comments',
+                                                created_at = i['created_at']
+                                                )
+        # Assign folders to NC bookmark
+        bookmark_data['folders'] = folders
+        # Use LLM - unless we already did, in an earlier run
+        if use_llm:
+            summarized = journal.get(i['link_id'], 'summarized')
+            if summarized != None:
+                llm_d = summarized.get('description')
+            else:
+                try:
                     llm_d = suggest_description(bookmark_data['url'],
-                                                bookmark_data['description'])
-                    if llm_d == None: 
-                        folders.append(unreachable_folder)
-                    else:
-                        bookmark_data['description'] = bookmark_data['description'].replace('###LLM###', llm_d)
-                    # TODO: Add tagging
-                edit_nc_bookmark(bookmark_data)
-                print("\b*",end="", flush=True)
-                
-
+                                                bookmark_data['description'],
+                                                silent = True)
+                    # Only real summaries and pages that are gone for good:
+                    # anything else is tried again in the next run
+                    journal.record(i['link_id'], 'summarized', description = llm_d)
+                except Exception as e:
+                    # Page or LLM not reachable for now: the ###LLM### placeholder
+                    # stays, for nc_llm_improve to fill in
+                    print(f"\nNo description for {bookmark_data['url']} yet: {e}")
+                    llm_d = '###LLM###'
+            print("@",end="", flush=True)
+            if llm_d == None: 
+                folders.append(unreachable_folder)
+            else:
+                bookmark_data['description'] = bookmark_data['description'].replace('###LLM###', llm_d)
+            # TODO: Add tagging
+        return (i, bookmark_data)
+
+    def write_nc(prepared):
+        i, bookmark_data = prepared
+        if bookmark_data == None:
+            # Created in an earlier run
+            return i
+        nc_id = edit_nc_bookmark(bookmark_data)
+        if nc_id == None:
+            # Keep it on Diigo
+            return None
+        journal.record(i['link_id'], 'created', nc_id = nc_id)
+        print("*",end="", flush=True)
+        return i
+
+    # Only what deleting needs: (link_id, title, url)
+    delete_buffer = []
+    # link_ids that could not be deleted - the run is not complete then
+    delete_failed = []
+    def delete_batch(items):
+        items = [i for i in items if not journal.done(i[0], 'deleted')]
+        if len(items) == 0:
+            return
         # Bulk-delete bookmarks in list
-        if remove_diigo: 
-            print("\bX",end="", flush=True)
-            id_list = [i['link_id'] for i in items]
-            response = dia_delete_b(id_list, session = session)
-            if response == 403:
-                print(f"dia_delete_bookmarks returned 'Forbidden', could not delete those: {id_list}")
-                for i in items:
-                    title = i['title']
-                    url = i['url']
-                    print(f"Trying force-delete {url} {title}")
+        print("X",end="", flush=True)
+        id_list = [link_id for link_id, _, _ in items]
+        response = dia_delete_b(id_list, session = session)
+        # Success comes as a JSON answer; failures as None (no JSON) or the status code
+        if isinstance(response, dict):
+            for link_id in id_list:
+                journal.record(link_id, 'deleted')
+        elif response == 403:
+            print(f"dia_delete_bookmarks returned 'Forbidden', could not delete those: {id_list}")
+            for link_id, title, url in items:
+                print(f"Trying force-delete {url} {title}")
+                response = delete_diigo_bookmark(title=title,url=url,session = session)
+                print(f"Response: {response}")
+                # The rate limiter paces the deletes, backs off and pauses 
+                # when Diigo complains - so just keep trying.
+                while (response == None):
+                    print("Retrying")
                     response = delete_diigo_bookmark(title=title,url=url,session = session)
-                    print(f"Response: {response}")
-                    while (response == None):
-                        print("Waiting 5 minutes for retry")
-                        time.sleep(300)
-                        response = delete_diigo_bookmark(title=title,url=url,session = session)
-                    
-                    # Wait 2 seconds 
-                    time.sleep(2)
-            
-        else: 
-            # No bookmarks have been removed, so we have to go to the next page. 
-            p += 1 
-        # Load next batch
-        print("\b*.",end="", flush=True)
-        items = dia_load_user_items(page_num=p,
-                                    sort = 'created_at',
-                                    count=diigo_batch_size,
-                                    session = session)
-    # Erase the last read symbol and erase
-    print("\b \n")     
+                journal.record(link_id, 'deleted')
+        else:
+            print(f"\ndia_delete_b failed ({response}), keeping those: {id_list}")
+            delete_failed.extend(id_list)
+        journal.sync()
+
+    def delete(i):
+        delete_buffer.append((i['link_id'], i['title'], i['url']))
+        if fetch_done.is_set() and len(delete_buffer) >= diigo_batch_size:
+            delete_batch(delete_buffer[:])
+            delete_buffer.clear()
+        return i
+
+    def finish_delete():
+        while len(delete_buffer) > 0:
+            delete_batch(delete_buffer[:diigo_batch_size])
+            del delete_buffer[:diigo_batch_size]
+
+    pipe = Pipeline()
+    pipe.add_stage("dump", dump, fan_out = True)
+    if create_nextcloud:
+        pipe.add_stage("prepare", prepare, 
+                       workers = (get_setting('llm_workers') or get_llm_pool().capacity()) if use_llm else 1)
+        pipe.add_stage("nextcloud", write_nc, workers = get_setting('nc_concurrency', 8))
+    if remove_diigo:
+        # Single worker: deletes go out in batches
+        pipe.add_stage("delete", delete, finish = finish_delete)
+    stats = pipe.run(fetch())
+    print("\n")     
+    for name, stat in stats.items():
+        print(f"{name}: {stat['processed']} processed, {stat['dropped']} skipped, {stat['errors']} errors")
+    if fetch_done.is_set() and len(delete_failed) == 0 \
+        and sum(stat['errors'] + stat['dropped'] for stat in stats.values()) == 0:
+        # Complete run; the next one starts from scratch
+        journal.finish()
+    else:
+        journal.close()
+        print("Not all bookmarks went through - run again to resume.")
     session.close()
     df = inspect_file(config['diigo_dump_path'])
     # Shows file and waits for ENTER
@@ -741,17 +849,11 @@ def diigo_export_delete():
             url = bookmark['url']
             title = bookmark['title']
             # Kill it
+            # The rate limiter takes care of pacing and retrying
             if delete_diigo_bookmark(title=title, url=url)!= None:
-                print(f"Removed {url}, waiting...")
-                time.sleep(1)
+                print(f"Removed {url}")
             else:
-                print("Waiting a literal minute...")
-                get_diigo_bookmarks()
-                time.sleep(60)
-                if delete_diigo_bookmark(title=title, url = url) != None:
-                    print("Success on the 2nd attempt.")
-                else:
-                    print("Still won't work. Retrying on the next round...")
+                print("Still won't work. Retrying on the next round...")
         df = pd.DataFrame()  # Reset the DataFrame
         i += 10
         # I had a logical error in here. If I remove bookmarks, 
@@ -773,8 +875,10 @@ def diigo_export_delete():
             # And no, adding some waiting time after each 
             # delete action did not help. And I did not find
             # any provisions for bulk-deleting (yet?)
-            print("Cannot reach Diigo - I'll be back in five.")
-            time.sleep(300)
+            #
+            # The rate limiter now does the waiting: it backs off, 
+            # and pauses all Diigo calls after repeated failures.
+            print("Cannot reach Diigo - retrying.")
             d_b_dict = get_diigo_bookmarks(d_start=0, d_count=step)
             
 
@@ -0,0 +1,188 @@
+# embeddings.py
+#
+# Embedding index of the bookmarks, for suggesting tags.
+#
+# Every bookmark's title and description (which includes the LLM summary) is
+# turned into a vector by a local Ollama embedding model (ollama/embed_model,
+# e.g. nomic-embed-text). The vectors are normalized and kept as one NumPy
+# matrix, stored as float16 in EMBEDDINGS_PATH together with the bookmark IDs,
+# their tags, and a hash of the text each vector was made from - so a
+# bookmark is only embedded again when its text changes. New texts are
+# embedded in batches, spread over the Ollama servers (see llm_pool.py).
+#
+# The neighbours of a bookmark are found with one matrix-vector product over
+# all vectors: for some 40,000 bookmarks that takes a few milliseconds, so
+# there is no need for an approximate index. The tags of the k nearest
+# neighbours, weighted by similarity, are the suggestions.
+#
+#   index = get_embedding_index()
+#   index.update(mirror.iter_bookmarks())
+#   tags = index.suggest(bookmark)
+
+import os
+import json
+import hashlib
+import threading
+
+import numpy as np
+
+from config import *
+from llm_pool import get_llm_pool
+
+# Text of a bookmark that goes into its embedding
+def embedding_text(b, max_chars = 2000):
+    text = f"{b.get('title', '')}\n{b.get('description', '')}"
+    # The placeholder for an LLM description that has not been written yet
+    text = text.replace("###LLM###", "")
+    return text[:max_chars]
+
+class EmbeddingIndex:
+    """
+    Bookmark ID -> normalized embedding vector, with the bookmark's tags.
+
+    - path: .npz file (default: EMBEDDINGS_PATH)
+    - model: Ollama embedding model (config: ollama/embed_model)
+    - batch_size: texts per embedding request (config: embed_batch_size)
+    """
+    def __init__(self, path = EMBEDDINGS_PATH, model = None, batch_size = None):
+        self.path = os.path.expanduser(path)
+        if model == None:
+            model = (get_setting('ollama', {}) or {}).get('embed_model', 'nomic-embed-text')
+        self.model = model
+        self.batch_size = batch_size or get_setting('embed_batch_size', 32)
+        self.lock = threading.Lock()
+        self.ids = []
+        self.hashes = []
+        self.tags = []
+        # None while empty; compare with "is", it is a NumPy array otherwise
+        self.matrix = None
+        self.rows = {}
+        self.load()
+
+    def _hash(self, text):
+        return hashlib.sha256(f"{self.model}\n{text}".encode('utf-8')).hexdigest()[:32]
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            data = np.load(self.path)
+            self.ids = data['ids'].tolist()
+            self.hashes = data['hashes'].tolist()
+            self.tags = json.loads(str(data['tags']))
+            self.matrix = data['matrix'].astype(np.float32)
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Could not read embeddings from {self.path}: {e}")
+            self.ids, self.hashes, self.tags, self.matrix = [], [], [], None
+        self.rows = {id: i for i, id in enumerate(self.ids)}
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory != "" and not os.path.exists(directory):
+            os.mkdir(directory)
+        matrix = self.matrix if self.matrix is not None else np.zeros((0, 0))
+        # np.savez appends .npz to names without it
+        tmp = self.path + ".tmp.npz"
+        np.savez(tmp,
+                 ids = np.array(self.ids, dtype = np.int64),
+                 hashes = np.array(self.hashes, dtype = str),
+                 tags = np.array(json.dumps(self.tags)),
+                 matrix = matrix.astype(np.float16))
+        os.replace(tmp, self.path)
+
+    def __len__(self):
+        return len(self.ids)
+
+    # Normalized embeddings for a list of texts, as a float32 matrix
+    def embed(self, texts):
+        vectors = np.array(get_llm_pool().embed(self.model, texts), dtype = np.float32)
+        norms = np.linalg.norm(vectors, axis = 1, keepdims = True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    # Bring the index up to date with these bookmarks: embed the new and
+    # changed ones (in batches, concurrently), take over their tags, and - with
+    # prune - drop bookmarks that are no longer there. Returns the number of
+    # bookmarks embedded.
+    def update(self, bookmarks, prune = True, silent = False):
+        bookmarks = list(bookmarks)
+        todo = []
+        for b in bookmarks:
+            h = self._hash(embedding_text(b))
+            row = self.rows.get(b['id'])
+            if row == None or self.hashes[row] != h:
+                todo.append((b, h))
+        batches = [todo[i:i+self.batch_size] for i in range(0, len(todo), self.batch_size)]
+        vectors = {}
+        pool = get_llm_pool()
+        for batch, v in pool.map(lambda batch: self.embed([embedding_text(b) for b, _ in batch]), batches):
+            for (b, h), vector in zip(batch, v):
+                vectors[b['id']] = (h, vector)
+            if not silent:
+                print("*", end = "", flush = True)
+        with self.lock:
+            tags_of = {b['id']: b.get('tags', []) for b in bookmarks}
+            keep = bookmarks
+            if not prune:
+                keep = keep + [{'id': id} for id in self.ids if id not in tags_of]
+            ids, hashes, tags, rows = [], [], [], []
+            for b in keep:
+                id = b['id']
+                if id in vectors:
+                    h, vector = vectors[id]
+                elif id in self.rows:
+                    h, vector = self.hashes[self.rows[id]], self.matrix[self.rows[id]]
+                else:
+                    continue
+                ids.append(id)
+                hashes.append(h)
+                tags.append(tags_of.get(id, self.tags[self.rows[id]] if id in self.rows else []))
+                rows.append(vector)
+            self.ids, self.hashes, self.tags = ids, hashes, tags
+            self.matrix = np.vstack(rows).astype(np.float32) if rows != [] else None
+            self.rows = {id: i for i, id in enumerate(self.ids)}
+        self.save()
+        if not silent and len(todo) > 0:
+            print(f"\nEmbedded {len(todo)} bookmarks")
+        return len(todo)
+
+    # Vector for a bookmark: from the index if its text has not changed
+    def vector(self, b):
+        text = embedding_text(b)
+        row = self.rows.get(b.get('id'))
+        if row != None and self.hashes[row] == self._hash(text):
+            return self.matrix[row]
+        return self.embed([text])[0]
+
+    # The k most similar bookmarks: list of (id, similarity), best first
+    def neighbours(self, vector, k = 10, exclude = None):
+        if self.matrix is None or len(self.ids) == 0:
+            return []
+        similarities = self.matrix @ vector
+        if exclude in self.rows:
+            similarities[self.rows[exclude]] = -np.inf
+        k = min(k, len(self.ids))
+        best = np.argpartition(-similarities, k - 1)[:k]
+        best = best[np.argsort(-similarities[best])]
+        return [(self.ids[i], float(similarities[i])) for i in best if similarities[i] > -np.inf]
+
+    # Tags for a bookmark from its k nearest neighbours, weighted by similarity;
+    # returns up to n tags the bookmark does not have yet, best first.
+    def suggest(self, b, k = 10, n = 5):
+        scores = {}
+        for id, similarity in self.neighbours(self.vector(b), k, exclude = b.get('id')):
+            for t in self.tags[self.rows[id]]:
+                scores[t] = scores.get(t, 0) + similarity
+        own = set(b.get('tags', []))
+        ranked = sorted((t for t in scores if t not in own), key = lambda t: -scores[t])
+        return ranked[:n]
+
+# Shared index, loaded on first use
+embedding_index = None
+embedding_index_lock = threading.Lock()
+
+def get_embedding_index():
+    global embedding_index
+    with embedding_index_lock:
+        if embedding_index == None:
+            embedding_index = EmbeddingIndex()
+        return embedding_index
@@ -3,12 +3,18 @@
 # 
 
 import os
+import ast
+import csv
+import json
+import threading
 import pandas as pd
 
 from config import *
 from process import *
 from file_menu import file_menu, proceed
-from nc_bookmarks_api import probe_nc_bookmarks, get_nc_bookmarks, get_nc_diigo_folder, find_nc_bookmark, create_nc_bookmark
+from nc_bookmarks_api import probe_nc_bookmarks, get_nc_bookmarks, iter_nc_bookmarks, get_nc_diigo_folder, find_nc_bookmark, create_nc_bookmark, edit_nc_bookmark, bulk_edit_nc_bookmarks
+from nc_mirror import NcMirror, get_nc_mirror
+from dedup import plain_url
 
 # import the CSV with the Diigo bookmarks
 """
@@ -38,15 +44,9 @@ def read_diigo_bookmarks(b_path):
     df = df[DIIGO_FIELDS_LIST]
 
 
-# Add bookmarks to a bookmarks CSV file. Rudimentary error checking.
-# 
-def update_bookmarks(b_path, b_df):
-    b_path = os.path.expanduser(b_path)
-    # Check whether directory exists and create if necessary
-    directory = os.path.dirname(b_path)
-    if not os.path.exists(directory):
-        os.mkdir(directory)
-    
+# Rudimentary format check for a dataframe of bookmarks. 
+# Returns the dataframe (with 'desc' renamed to 'description'), None if columns are missing.
+def check_bookmark_columns(b_df):
     # Use Diigo-style CSV data for compatibility.
     # check b_df
     # Special: Rename column 'desc' to  'description'
@@ -64,18 +64,112 @@ def update_bookmarks(b_path, b_df):
         print(f"ERROR: Missing columns {missing_columns}")
         print(f"Bookmarks dataframe contains these columns: {list(b_df.columns)}")
         return None
-    # Read 
-    try:
-        old_df = get_bookmarks(b_path)
-    except:
-        # File not found, create empty df
-        # Create a new dataframe with the columns from `b_columns`
-        old_df = pd.DataFrame(columns=b_df.columns)
-    # Join b_df and drop duplicate entries
-    new_df = pd.concat([old_df, b_df], ignore_index=True)
-    new_df = new_df.drop_duplicates(subset=['url','title'])
-    new_df.to_csv(b_path, index=False)
-    return new_df
+    return b_df
+
+class DumpWriter:
+    """
+    Appends batches of bookmarks to a CSV dump file, skipping bookmarks that 
+    are already in it. Keeps a set of (url, title) keys in memory instead 
+    of reading, merging and rewriting the whole file for every batch.
+    The keys are the exact strings: a dump keeps every Diigo bookmark, 
+    finding duplicates among them is up to dedup.py.
+
+    The keys are read once from an existing file (just these two columns).
+    If a batch brings new columns, the file is rewritten once with the 
+    extended header. 
+    """
+    def __init__(self, b_path):
+        b_path = os.path.expanduser(b_path)
+        # Check whether directory exists and create if necessary
+        directory = os.path.dirname(b_path)
+        if directory != "" and not os.path.exists(directory):
+            os.mkdir(directory)
+        self.path = b_path
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        self.keys = set()
+        self.columns = None
+        self.size = 0
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            self.columns = pd.read_csv(self.path, nrows=0).columns.to_list()
+            key_columns = [c for c in ['url','title'] if c in self.columns]
+            # As strings, empty fields as "" - like _keys does for a batch
+            for chunk in pd.read_csv(self.path, usecols=key_columns, chunksize=10000,
+                                     dtype=str, keep_default_na=False):
+                self.keys.update(self._keys(chunk))
+            self.size = os.path.getsize(self.path)
+
+    # Missing values (None, NaN) become "", not "nan", so an empty title in 
+    # a batch matches the empty field in the file
+    def _keys(self, df):
+        urls = df['url'].fillna("").astype(str) if 'url' in df.columns else [""] * len(df)
+        titles = df['title'].fillna("").astype(str) if 'title' in df.columns else [""] * len(df)
+        return list(zip(urls, titles))
+
+    def _extend_columns(self, new_columns):
+        self.columns = self.columns + new_columns
+        if self.size > 0:
+            df = get_bookmarks(self.path)
+            df.reindex(columns=self.columns).to_csv(self.path, index=False)
+            self.size = os.path.getsize(self.path)
+
+    # Append the bookmarks in b_df that are not in the file yet. 
+    # Returns the rows that were appended, None if b_df has missing columns.
+    def append(self, b_df):
+        b_df = check_bookmark_columns(b_df)
+        if b_df is None:
+            return None
+        with self.lock:
+            # Someone else (e.g. move_backup) changed the file? Start over.
+            current_size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            if current_size != self.size:
+                self._load()
+            # Drop duplicates within the batch, and those already written
+            keys = self._keys(b_df)
+            keep = []
+            for k in keys:
+                keep.append(k not in self.keys)
+                self.keys.add(k)
+            new_df = b_df[keep]
+            if len(new_df) == 0:
+                return new_df
+            if self.columns == None:
+                self.columns = new_df.columns.to_list()
+            else:
+                new_columns = [c for c in new_df.columns if c not in self.columns]
+                if new_columns != []:
+                    self._extend_columns(new_columns)
+            new_df.reindex(columns=self.columns).to_csv(self.path, 
+                                                        mode='a', 
+                                                        header=(self.size == 0),
+                                                        index=False)
+            self.size = os.path.getsize(self.path)
+            return new_df
+
+# One writer per dump file, so consecutive batches reuse the key set
+dump_writers = {}
+
+# Add bookmarks to a bookmarks CSV file. Rudimentary error checking.
+# Only appends the bookmarks that are new; returns them as a dataframe
+# (None if the format check fails).
+def update_bookmarks(b_path, b_df):
+    b_path = os.path.expanduser(b_path)
+    if b_path not in dump_writers:
+        dump_writers[b_path] = DumpWriter(b_path)
+    return dump_writers[b_path].append(b_df)
+
+# Rewrite a dump file without duplicate (url, title) entries - 
+# only needed for files that were written by other means.
+def compact_bookmarks(b_path):
+    b_path = os.path.expanduser(b_path)
+    df = get_bookmarks(b_path)
+    n = len(df)
+    df = df.drop_duplicates(subset=['url','title'])
+    df.to_csv(b_path, index=False)
+    dump_writers.pop(b_path, None)
+    return n - len(df)
 
 def write_to_log(log_path,text):
     if not os.path.exists(log_path):
@@ -94,30 +188,95 @@ def move_backup(b_path):
             backup_path = f"{b_path}.{i}.bak"
         os.rename(b_path,backup_path)
 
+# Tags in a CSV cell: "a,b" in Diigo files, "['a', 'b']" in Nextcloud dumps
+def file_tags(value):
+    value = str(value).strip()
+    if value == "":
+        return []
+    if value.startswith('['):
+        try:
+            return [str(t) for t in ast.literal_eval(value)]
+        except (ValueError, SyntaxError):
+            pass
+    return [t for t in tag_process(value) if t != ""]
+
+# Statistics of a bookmarks CSV file: dict with 'rows', 'columns', 'tags'
+# (tag -> count, most frequent first), 'size' and 'mtime'. 
+# Only the tags column is read, in chunks of chunksize rows, so memory stays
+# bounded however large the file is. The result is kept next to the file
+# (<file>.stats.json) and reused as long as size and mtime are unchanged.
+def get_file_stats(path, chunksize = 10000):
+    path = os.path.expanduser(path)
+    stat = os.stat(path)
+    stats_path = path + ".stats.json"
+    try:
+        with open(stats_path, 'r') as f:
+            stats = json.load(f)
+        if stats.get('size') == stat.st_size and stats.get('mtime') == stat.st_mtime:
+            return stats
+    except (OSError, json.JSONDecodeError):
+        pass
+    columns = pd.read_csv(path, nrows=0).columns.to_list()
+    usecols = ['tags'] if 'tags' in columns else columns[:1]
+    rows = 0
+    tags = {}
+    for chunk in pd.read_csv(path, usecols=usecols, chunksize=chunksize, 
+                             dtype=str, keep_default_na=False):
+        rows += len(chunk)
+        if 'tags' in chunk.columns:
+            for value in chunk['tags']:
+                for t in file_tags(value):
+                    tags[t] = tags.get(t, 0) + 1
+    stats = {
+        'rows': rows,
+        'columns': columns,
+        'tags': dict(sorted(tags.items(), key=lambda x: x[1], reverse=True)),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+    }
+    try:
+        with open(stats_path + ".tmp", 'w') as f:
+            json.dump(stats, f, ensure_ascii=False)
+        os.replace(stats_path + ".tmp", stats_path)
+    except OSError:
+        # Read-only directory: just don't keep them
+        pass
+    return stats
+
+# Show the first lines, the number of bookmarks, the columns and the most
+# frequent tags of a CSV file. Only the first lines are parsed in full;
+# the rest comes from get_file_stats. Returns the stats, None if the file
+# cannot be read.
 def inspect_file(path): 
     try:
-        df = get_bookmarks(path)
-    except:
-        print(f"ERROR: Could not read file '{path}'")
+        stats = get_file_stats(path)
+        head = pd.read_csv(os.path.expanduser(path), nrows=5, index_col=False)
+    except Exception as e:
+        print(f"ERROR: Could not read file '{path}': {e}")
         return None
-    print(f"File '{path}' contains {len(df)} bookmarks. First lines:")
+    print(f"File '{path}' contains {stats['rows']} bookmarks. First lines:")
     print()
-    print(df.head(5))
-    # Look at the columns - put them into a list
-    columns = df.columns.to_list()
+    print(head)
+    # Look at the columns
+    columns = stats['columns']
     print()
     print(f"Contains these columns (*starred* columns are necessary):")
     for c in columns: 
         print(f"*{c}*" if c in NC_FIELDS_LIST else str(c),end=", ")
+    if len(stats['tags']) > 0:
+        top = ", ".join(f"{t} ({n})" for t, n in list(stats['tags'].items())[:10])
+        print(f"\n\n{len(stats['tags'])} tags, most frequent: {top}")
     input("\nPress ENTER to continue")
+    return stats
 
 
 # Get a CSV, convert and upload to Nextcloud. 
 def upload_nc_bookmarks(b_path):
     nc_key = config['nc_bookmarks']['password']
     probe_nc_bookmarks()
-    bookmarks_df = get_nc_bookmarks(b_path)
-    print(bookmarks_df.head(5))
+    # Look up existing bookmarks locally rather than asking Nextcloud for every row
+    mirror = get_nc_mirror()
+    print(f"{mirror.count()} bookmarks in Nextcloud")
     diigo_folder = get_nc_diigo_folder()
     diigo_df = get_bookmarks(b_path)
     # tags ist ein String, müssen wir erst splitten - 
@@ -127,6 +286,13 @@ def upload_nc_bookmarks(b_path):
     for t in diigo_df['tags']:
         l.extend(tag_process(t))
     d = convert_to_dict(l)
+    # Bookmarks to write, and the existing version of each (if any)
+    writes = []
+    existing = []
+    # plain URL -> index in writes of the bookmarks to be created
+    queued = {}
+    # NC id -> index in writes, so several rows for one bookmark become one write
+    modified = {}
     # Write bookmarks to Diigo folder
     for i in range(0,len(diigo_df)):
 
@@ -157,54 +323,125 @@ def upload_nc_bookmarks(b_path):
         # Get dict of bookmark if exists
         print(f"Bookmark {i+1} of {len(diigo_df)}:")
         print(url)
-        d = find_nc_bookmark(url=url,folder_id=diigo_folder)
+        # The mirror matches canonical URLs; only merge into the same address 
+        # (see dedup.plain_url) - a different fragment or parameter may be another page
+        d = [dd for dd in mirror.find_url(url=url,folder_id=diigo_folder)
+             if plain_url(dd['url']) == plain_url(url)]
+        # Rows for the same bookmark are merged into one write
+        def merge(current):
+            return {
+                # Take the title of the bookmark with the longer description
+                'title' : title if len(desc) > len(current['description']) else current['title'],
+                'description': better_desc(desc,current['description']),
+                # Merge, removing duplicate tags
+                'tags': list(set(tags + current['tags'])),
+                'folders': [diigo_folder]
+            }
         if len(d) == 0:
             # If descriptions already contains # BOOKMARKED etc., keep it
             if ('# BOOKMARKED' in description) and ('# ANNOTATIONS' in description):
                 desc=description
-            # Creating bookmark
+            # Same URL twice in the file? Merge into the bookmark already queued.
+            if plain_url(url) in queued:
+                print(f"Bookmark already queued for URL {url}. Merge.")
+                n = queued[plain_url(url)]
+                writes[n] = dict(merge(writes[n]), url = writes[n]['url'])
+                continue
+            queued[plain_url(url)] = len(writes)
+            # Queue bookmark for creation
             print(title)
-            print(desc)
-            r = create_nc_bookmark(url=url,
-                title=title,
-                description=desc,
-                tags=tags,
-                folders=[diigo_folder])
-            print(f"Created with id {r}")
+            writes.append({'url': url,
+                           'title': title,
+                           'description': desc,
+                           'tags': tags,
+                           'folders': [diigo_folder]})
+            existing.append({})
         else:
             for dd in d:    
                 if title==dd['title']:
                     print(f"Bookmark exists for URL {url}")
                 else:
                     print(f"Different bookmark for same URL. Modify.")
-                    id = dd['id']
-                    data = {
-                        # Take the title of the bookmark with the longer description
-                        'title' : title if len(description) > len(dd['description']) else dd['title'],
-                        'description': better_desc(desc,dd['description']),
-                        # Merge, removing duplicate tags
-                        'tags': list(set(tags + dd['tags'])),
-                        'folders': [folder_id]
-                    }
-                    r = edit_nc_bookmark(data,id)
-                    print(f"Modified id {r}")
-
-def get_nc_dump(dump_path = None):
-    df = pd.DataFrame()
-    p = 0
+                    # Already modified by an earlier row? Merge into that version,
+                    # not into the mirror's copy, or only the last row would count.
+                    current = writes[modified[dd['id']]] if dd['id'] in modified else dd
+                    data = dict(merge(current), id = dd['id'])
+                    if dd['id'] in modified:
+                        writes[modified[dd['id']]] = data
+                    else:
+                        modified[dd['id']] = len(writes)
+                        writes.append(data)
+                        existing.append(dd)
+    # Write all at once, several requests in parallel
+    print(f"Writing {len(writes)} bookmarks to Nextcloud")
+    result = bulk_edit_nc_bookmarks(writes)
+    for data, dd, r in zip(writes, existing, result['ids']):
+        if r != None:
+            b = dict(dd, **data)
+            b['id'] = r
+            mirror.upsert(b)
+    mirror.close()
+
+# Write bookmarks (an iterable of dicts, e.g. from iter_nc_bookmarks) straight 
+# to a CSV file in one pass, without keeping them in memory. 
+# An existing file is moved to a backup first. The columns are taken from the
+# first bookmark; list values (tags, folders) are written the way pandas does.
+#
+# Returns the number of bookmarks written.
+def write_nc_dump(dump_path, bookmarks, progress_step = 0):
+    dump_path = os.path.expanduser(dump_path)
+    directory = os.path.dirname(dump_path)
+    if directory != "" and not os.path.exists(directory):
+        os.mkdir(directory)
+    move_backup(dump_path)
+    n = 0
+    writer = None
+    with open(dump_path, 'w', newline='') as f:
+        for b in bookmarks:
+            if writer == None:
+                writer = csv.DictWriter(f, fieldnames=list(b.keys()), extrasaction='ignore')
+                writer.writeheader()
+            writer.writerow({k: str(v) if isinstance(v, list) else v for k, v in b.items()})
+            n += 1
+            if progress_step > 0 and n % progress_step == 0:
+                print("*",end="", flush=True)
+    return n
+
+# Download all Nextcloud bookmarks. 
+# If dump_path is given, they are streamed to that CSV file, and the number 
+# of bookmarks is returned; otherwise, they are returned as a dataframe.
+#
+# prefetch: number of page requests kept in flight (config: nc_prefetch)
+# incremental: only fetch what has changed since the last run into the local
+#   mirror, and dump from there. Bookmarks deleted in Nextcloud are only noticed
+#   by the mirror's full refresh (nc_mirror_full_refresh), so such a dump may
+#   still hold them.
+# Returns None if the download (or the mirror's sync) failed.
+def get_nc_dump(dump_path = None, prefetch = None, incremental = False):
     nc_batch_size = config['nc_batch_size']
-    print(f"Downloading Nextcloud bookmarks in batches of {nc_batch_size}")
-    data = get_nc_bookmarks(page = 0, limit = nc_batch_size)
-    while len(data) > 0: 
-        print(".",end="", flush=True)
-        b_df = pd.DataFrame(data)
-        df =  pd.concat([df, b_df], ignore_index=True)  
+    if prefetch == None:
+        prefetch = get_setting('nc_prefetch', 4)
+    mirror = None
+    if incremental:
+        mirror = NcMirror()
+        if mirror.sync() == None:
+            # Would dump a stale copy as if it were current
+            mirror.close()
+            return None
+        bookmarks = mirror.iter_bookmarks()
+    else:
+        print(f"Downloading Nextcloud bookmarks in batches of {nc_batch_size}")
+        bookmarks = iter_nc_bookmarks(limit = nc_batch_size, prefetch = prefetch)
+    try:
         if dump_path != None:
-             update_bookmarks(dump_path,b_df)
-        p += 1
-        print("\b*",end="", flush=True)
-        data = get_nc_bookmarks(page = p, limit = nc_batch_size)
-    return df
+            return write_nc_dump(dump_path, bookmarks, progress_step = nc_batch_size)
+        return pd.DataFrame(list(bookmarks))
+    except ConnectionError as e:
+        print(f"\nERROR: {e}")
+        return None
+    finally:
+        if mirror != None:
+            mirror.close()
               
 # Select and upload CSV to Nextcloud
 def import_nc_csv(f):
@@ -251,8 +488,12 @@ def export_nc_csv(f):
         return
     probe_nc_bookmarks()
     print("Retrieving bookmarks from Nextcloud")
-    df = get_nc_dump(f)
+    n = get_nc_dump(f, incremental = get_setting('nc_incremental_export', False))
     print("")
+    if n == None:
+        print(f"Download incomplete - {f} is not a full dump")
+        return
+    print(f"Wrote {n} bookmarks to {f}")
 
 if __name__ == "__main__":
     global config
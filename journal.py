@@ -0,0 +1,108 @@
+# journal.py
+#
+# Append-only journal for Diigo -> Nextcloud migrations.
+#
+# Every bookmark (by its Diigo link_id) passes through the stages
+#   dumped -> summarized -> created (in Nextcloud, with the NC id) -> deleted (on Diigo)
+# and every stage reached is appended as one JSON line. The file is flushed
+# and fsync'ed once per batch, not once per line. If a run dies halfway, the
+# next run replays the journal and skips everything that is already done -
+# no second NC write, no second LLM call for the same bookmark.
+
+import os
+import json
+import threading
+import time
+
+from config import *
+
+class Journal:
+    """
+    Records the progress of each bookmark through the migration stages.
+
+    - path: the journal file (default: JOURNAL_PATH)
+    - batch_size: fsync after this many records at the latest; call sync()
+      to force it at the end of a batch
+    """
+    def __init__(self, path = JOURNAL_PATH, batch_size = 100):
+        path = os.path.expanduser(path)
+        directory = os.path.dirname(path)
+        if directory != "" and not os.path.exists(directory):
+            os.mkdir(directory)
+        self.path = path
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        # link_id -> dict of stage -> data recorded for that stage
+        self.entries = {}
+        self.pending = 0
+        self._replay()
+        self.f = open(path, 'a')
+        if self.f.tell() > 0 and not self._ends_with_newline():
+            # Don't append to a half-written line
+            self.f.write("\n")
+
+    def _ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    r = json.loads(line)
+                except json.JSONDecodeError:
+                    # Half-written last line of a crashed run
+                    continue
+                self.entries.setdefault(r['link_id'], {})[r['stage']] = r.get('data', {})
+
+    # Anything to resume from?
+    def resuming(self):
+        return len(self.entries) > 0
+
+    def record(self, link_id, stage, **data):
+        r = {'link_id': link_id, 'stage': stage, 't': time.time()}
+        if data:
+            r['data'] = data
+        with self.lock:
+            self.entries.setdefault(link_id, {})[stage] = data
+            self.f.write(json.dumps(r) + "\n")
+            self.pending += 1
+            if self.pending >= self.batch_size:
+                self._sync()
+
+    def done(self, link_id, stage):
+        with self.lock:
+            return stage in self.entries.get(link_id, {})
+
+    # Data recorded for this stage (e.g. {'nc_id': 1234}), None if not reached
+    def get(self, link_id, stage):
+        with self.lock:
+            return self.entries.get(link_id, {}).get(stage)
+
+    def _sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pending = 0
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.f.close()
+
+    # The run is complete: move the journal out of the way, so the next
+    # run starts from scratch
+    def finish(self):
+        self.close()
+        i = 0
+        done_path = f"{self.path}.{i}.done"
+        while os.path.exists(done_path):
+            i += 1
+            done_path = f"{self.path}.{i}.done"
+        os.rename(self.path, done_path)
@@ -0,0 +1,285 @@
+# link_check.py
+#
+# Dead-link scanner for the Nextcloud bookmarks - no LLM involved.
+#
+# Every URL gets a HEAD request first; if that fails with an error status
+# (many servers answer HEAD with 405, 403 - or even 404), it gets a GET, of
+# which only the headers are read. Many links are checked at once (link_check_concurrency), but never
+# more than link_check_per_host at a time on the same server, with a pause
+# of link_check_host_delay between them - the links are interleaved by host,
+# so one big site does not hold up the rest. Host names are resolved once and
+# the answer (or the failure) is kept for the whole run.
+#
+# Each link is classified as one of
+#   ok, redirect (moved permanently), dns, tls, timeout, connection,
+#   not_found (404), gone (410), http_error (other 4xx/5xx), invalid
+# Bookmarks whose result is in link_check_dead (default: dns, not_found, gone)
+# are moved to UNREACHABLE_FOLDER in one bulk write.
+#
+#   python link_check.py
+
+import os
+import csv
+import time
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, defaultdict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import SSLError
+
+from config import *
+from nc_bookmarks_api import probe_nc_bookmarks, get_nc_folder, bulk_edit_nc_bookmarks
+from nc_mirror import get_nc_mirror
+from page_cache import PERMANENT_DNS_ERRORS, find_gaierror
+
+RESULTS = ['ok', 'redirect', 'dns', 'tls', 'timeout', 'connection',
+           'not_found', 'gone', 'http_error', 'invalid']
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) nextcloud-diigo-bookmarks link check"
+
+class DnsCache:
+    """
+    Caches socket.getaddrinfo while installed: each host name is looked up
+    once per run. Of the failures, only "no such host" answers are cached -
+    a timeout or a busy resolver (EAI_AGAIN) is asked again next time, or a 
+    passing hiccup would count every bookmark on that host as dead.
+    """
+    def __init__(self):
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.original = None
+
+    def getaddrinfo(self, host, *args, **kwargs):
+        key = (host,) + args + tuple(sorted(kwargs.items()))
+        with self.lock:
+            hit = self.cache.get(key)
+        if hit == None:
+            try:
+                hit = (True, self.original(host, *args, **kwargs))
+            except socket.gaierror as e:
+                if e.errno not in PERMANENT_DNS_ERRORS:
+                    raise
+                hit = (False, e)
+            with self.lock:
+                self.cache[key] = hit
+        if not hit[0]:
+            raise hit[1]
+        return hit[1]
+
+    def install(self):
+        self.original = socket.getaddrinfo
+        socket.getaddrinfo = self.getaddrinfo
+
+    def uninstall(self):
+        if self.original != None:
+            socket.getaddrinfo = self.original
+            self.original = None
+
+class HostLimiter:
+    """
+    At most per_host requests at once to the same host, at least
+    delay seconds apart.
+    """
+    def __init__(self, per_host = 2, delay = 0.5):
+        self.per_host = per_host
+        self.delay = delay
+        self.slots = defaultdict(lambda: threading.Semaphore(per_host))
+        self.next_time = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def acquire(self, host):
+        with self.lock:
+            slot = self.slots[host]
+        slot.acquire()
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time[host] - now
+            self.next_time[host] = max(now, self.next_time[host]) + self.delay
+        if wait > 0:
+            time.sleep(wait)
+
+    def release(self, host):
+        with self.lock:
+            slot = self.slots[host]
+        slot.release()
+
+# Reorder links so that consecutive ones are on different hosts (round robin)
+def interleave_by_host(bookmarks):
+    hosts = defaultdict(deque)
+    for b in bookmarks:
+        hosts[urlsplit(b['url']).hostname or ""].append(b)
+    queues = deque(hosts.values())
+    while queues:
+        q = queues.popleft()
+        yield q.popleft()
+        if q:
+            queues.append(q)
+
+def classify_exception(e):
+    if isinstance(e, SSLError):
+        return 'tls'
+    if isinstance(e, requests.exceptions.Timeout):
+        return 'timeout'
+    if isinstance(e, (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema,
+                      requests.exceptions.InvalidSchema)):
+        return 'invalid'
+    # Only a host that does not exist is 'dns' (and dead); a resolver
+    # that is busy or timing out is a connection problem like any other
+    gaierror = find_gaierror(e)
+    if gaierror != None and gaierror.errno in PERMANENT_DNS_ERRORS:
+        return 'dns'
+    return 'connection'
+
+def classify_response(response, url):
+    status = response.status_code
+    if status == 404:
+        return 'not_found'
+    if status == 410:
+        return 'gone'
+    if status >= 400:
+        return 'http_error'
+    if any(r.status_code in [301, 308] for r in response.history) and response.url != url:
+        return 'redirect'
+    return 'ok'
+
+class LinkChecker:
+    """
+    Checks many URLs at once, politely.
+
+    - concurrency: requests in flight (config: link_check_concurrency)
+    - per_host: requests at once per host (config: link_check_per_host)
+    - host_delay: seconds between requests to one host (config: link_check_host_delay)
+    - timeout: (connect, read) timeout (config: link_check_timeout)
+    """
+    def __init__(self, concurrency = None, per_host = None, host_delay = None, timeout = None):
+        self.concurrency = concurrency or get_setting('link_check_concurrency', 64)
+        self.hosts = HostLimiter(per_host or get_setting('link_check_per_host', 2),
+                                 host_delay if host_delay != None else get_setting('link_check_host_delay', 0.5))
+        self.timeout = timeout or tuple(get_setting('link_check_timeout', [5, 10]))
+        self.dns = DnsCache()
+        self.local = threading.local()
+
+    # One session per thread, with a connection pool for the hosts it sees
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            s = requests.Session()
+            s.headers['User-Agent'] = USER_AGENT
+            adapter = HTTPAdapter(pool_connections = 100, pool_maxsize = 2, max_retries = 0)
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            self.local.session = s
+        return self.local.session
+
+    # Check one URL. Returns a dict with url, result (see RESULTS), status,
+    # final_url, error and seconds.
+    def check(self, url):
+        start = time.monotonic()
+        r = {'url': url, 'result': None, 'status': None, 'final_url': None, 'error': None}
+        host = urlsplit(url).hostname
+        if host == None:
+            r['result'] = 'invalid'
+            r['seconds'] = 0
+            return r
+        session = self.session()
+        self.hosts.acquire(host)
+        try:
+            response = session.head(url, timeout = self.timeout, allow_redirects = True)
+            if response.status_code >= 400:
+                # Try again properly; only the headers are read
+                response = session.get(url, timeout = self.timeout, allow_redirects = True, stream = True)
+                response.close()
+            r['status'] = response.status_code
+            r['final_url'] = response.url
+            r['result'] = classify_response(response, url)
+        except requests.exceptions.RequestException as e:
+            r['result'] = classify_exception(e)
+            r['error'] = str(e)
+        except Exception as e:
+            r['result'] = 'invalid'
+            r['error'] = str(e)
+        finally:
+            self.hosts.release(host)
+        r['seconds'] = time.monotonic() - start
+        return r
+
+    # Check the urls of all bookmarks; yields (bookmark, result) as they come in.
+    def run(self, bookmarks):
+        self.dns.install()
+        try:
+            with ThreadPoolExecutor(max_workers = self.concurrency) as pool:
+                futures = deque()
+                for b in interleave_by_host(bookmarks):
+                    futures.append((b, pool.submit(self.check, b['url'])))
+                    # Keep a window of work ahead of the slowest link
+                    if len(futures) >= 4 * self.concurrency:
+                        b, f = futures.popleft()
+                        yield b, f.result()
+                while futures:
+                    b, f = futures.popleft()
+                    yield b, f.result()
+        finally:
+            self.dns.uninstall()
+
+def write_link_report(results, path = LINK_REPORT_PATH):
+    path = os.path.expanduser(path)
+    with open(path, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(['id', 'url', 'result', 'status', 'final_url', 'error', 'seconds'])
+        for b, r in results:
+            writer.writerow([b.get('id'), r['url'], r['result'], r['status'],
+                             r['final_url'], r['error'], f"{r['seconds']:.2f}"])
+    return path
+
+# Check all Nextcloud bookmarks (from the local mirror), print a summary,
+# write the report to LINK_REPORT_PATH, and - if move is set - move the dead
+# ones into UNREACHABLE_FOLDER. Returns a dict of result -> count.
+def check_nc_links(move = True, silent = False):
+    mirror = get_nc_mirror()
+    bookmarks = list(mirror.iter_bookmarks())
+    dead_results = get_setting('link_check_dead', ['dns', 'not_found', 'gone'])
+    checker = LinkChecker()
+    if not silent:
+        print(f"Checking {len(bookmarks)} links, {checker.concurrency} at once")
+    counts = defaultdict(int)
+    results = []
+    start = time.time()
+    for b, r in checker.run(bookmarks):
+        counts[r['result']] += 1
+        results.append((b, r))
+        if not silent and len(results) % 100 == 0:
+            print(f"\r{len(results)} checked, {sum(counts[d] for d in dead_results)} dead", end="", flush=True)
+    seconds = time.time() - start
+    report = write_link_report(results)
+    if not silent:
+        print(f"\rChecked {len(results)} links in {seconds:.0f}s - report in {report}")
+        for result in RESULTS:
+            if counts[result] > 0:
+                print(f"  {result}: {counts[result]}")
+    if move:
+        unreachable_folder = get_nc_folder(UNREACHABLE_FOLDER)
+        edits = []
+        for b, r in results:
+            if r['result'] in dead_results and unreachable_folder not in b['folders']:
+                b = dict(b)
+                b['folders'] = b['folders'] + [unreachable_folder]
+                edits.append(b)
+        if edits != []:
+            if not silent:
+                print(f"Moving {len(edits)} bookmarks to {UNREACHABLE_FOLDER}")
+            written = bulk_edit_nc_bookmarks(edits, silent = silent)
+            for b, id in zip(edits, written['ids']):
+                if id != None:
+                    mirror.upsert(b)
+    mirror.close()
+    return dict(counts)
+
+if __name__ == "__main__":
+    # Try to reach NC bookmarks
+    if not probe_nc_bookmarks():
+        print("Nextcloud unreachable. Returning.")
+    else:
+        check_nc_links()
+        input("Done - press ENTER to return")
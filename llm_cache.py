@@ -0,0 +1,115 @@
+# llm_cache.py
+#
+# Persistent cache for LLM answers.
+#
+# An answer is stored under a hash of everything that went into the
+# request: the model, the messages (system prompt and page content), and the
+# options. Asking the same question again - e.g. re-running the enrichment
+# on bookmarks that have not changed - returns the stored answer instantly.
+#
+# Entries remember model and system prompt, so answers from a model or prompt
+# that is no longer in use can be purged with invalidate(). Above max_entries,
+# the least recently used answers are evicted.
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from config import *
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    key TEXT PRIMARY KEY,
+    model TEXT,
+    prompt_hash TEXT,
+    answer TEXT,
+    created_at REAL,
+    accessed_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_answers_accessed_at ON answers(accessed_at);
+"""
+
+def hash_text(s):
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+class LlmCache:
+    """
+    SQLite store of LLM answers, keyed by a hash of model, messages and options.
+
+    - path: database file (default: LLM_CACHE_PATH)
+    - max_entries: LRU limit (config: llm_cache_max_entries)
+    """
+    def __init__(self, path = LLM_CACHE_PATH, max_entries = None):
+        path = os.path.expanduser(path)
+        directory = os.path.dirname(path)
+        if directory != "" and not os.path.exists(directory):
+            os.mkdir(directory)
+        if max_entries == None:
+            max_entries = get_setting('llm_cache_max_entries', 100000)
+        self.max_entries = max_entries
+        self.puts = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def key(self, model, messages, options = {}):
+        return hash_text(json.dumps([model, messages, options], sort_keys=True))
+
+    # The stored answer, None if there is none
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT answer FROM answers WHERE key = ?", (key,)).fetchone()
+            if row == None:
+                return None
+            self.db.execute("UPDATE answers SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+        return row[0]
+
+    # prompt: the system prompt used, so the answer can be invalidated with it
+    def put(self, key, answer, model, prompt):
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO answers VALUES (?,?,?,?,?,?)",
+                            (key, model, hash_text(prompt), answer, now, now))
+            self.db.commit()
+            self.puts += 1
+            check = self.puts % 100 == 0
+        # Counting is not free; check the size every 100 answers
+        if check:
+            self.evict()
+
+    # Drop the least recently used answers beyond max_entries
+    def evict(self):
+        with self.lock:
+            n = self.db.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            if n <= self.max_entries:
+                return 0
+            self.db.execute("""DELETE FROM answers WHERE key IN
+                               (SELECT key FROM answers ORDER BY accessed_at LIMIT ?)""",
+                            (n - self.max_entries,))
+            self.db.commit()
+        return n - self.max_entries
+
+    # Remove all answers that were not given by this model to one of these prompts
+    # Returns the number of answers removed.
+    def invalidate(self, model, prompts):
+        prompt_hashes = [hash_text(p) for p in prompts]
+        with self.lock:
+            cursor = self.db.execute(
+                f"""DELETE FROM answers WHERE model != ?
+                    OR prompt_hash NOT IN ({','.join('?' * len(prompt_hashes))})""",
+                [model] + prompt_hashes)
+            self.db.commit()
+        return cursor.rowcount
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM answers")
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,215 @@
+# llm_pool.py
+#
+# Spreads LLM requests over one or more Ollama servers.
+#
+# Each endpoint (host:port) takes up to `parallel` requests at once (set it
+# to what the server runs with, OLLAMA_NUM_PARALLEL). A request goes to the
+# healthy endpoint with the fewest requests in flight relative to its
+# capacity (least outstanding requests). An endpoint that cannot be reached,
+# times out or answers with a server error is taken out of rotation for
+# `cooldown` seconds, and the request is tried on the next one.
+#
+# Configure the endpoints in config.yaml:
+#   ollama:
+#     model: "gemma2:9b"
+#     hosts:
+#       - "http://localhost:11434"
+#       - "http://gpu-box:11434"
+#     parallel: 1
+#
+# Without hosts, the default Ollama server (OLLAMA_HOST) is used.
+#
+#   pool = get_llm_pool()
+#   answer = pool.chat(model, messages, options)
+#   vectors = pool.embed(embed_model, texts)
+#   for b, d in pool.map(lambda b: suggest_description(b['url']), bookmarks): ...
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+import httpx
+import ollama
+
+from config import *
+
+class LlmEndpoint:
+    """
+    One Ollama server, with its load and health counters.
+    """
+    def __init__(self, host = None, parallel = 1, timeout = None):
+        self.host = host if host != None else "default"
+        self.client = ollama.Client(host = host, timeout = timeout)
+        self.parallel = parallel
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0
+        self.seconds = 0.0
+        self.down_until = 0
+        self.last_error = None
+
+    def load(self):
+        return self.outstanding / self.parallel
+
+    def up(self, now = None):
+        return (now or time.monotonic()) >= self.down_until
+
+class LlmPool:
+    """
+    Least-outstanding-requests balancer over Ollama endpoints.
+
+    - hosts: list of Ollama URLs (config: ollama/hosts); None for the default server
+    - parallel: requests per endpoint at once (config: ollama/parallel)
+    - timeout: seconds to wait for an answer (config: ollama/timeout)
+    - cooldown: seconds a failing endpoint is left alone
+    """
+    def __init__(self, hosts = None, parallel = None, timeout = None, cooldown = 60):
+        ollama_config = get_setting('ollama', {}) or {}
+        if hosts == None:
+            hosts = ollama_config.get('hosts') or [None]
+        if parallel == None:
+            parallel = ollama_config.get('parallel', 1)
+        if timeout == None:
+            timeout = ollama_config.get('timeout', 300)
+        self.endpoints = [LlmEndpoint(h, parallel, timeout) for h in hosts]
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.free = threading.Condition(self.lock)
+
+    # Number of requests all endpoints take at once
+    def capacity(self):
+        return sum(e.parallel for e in self.endpoints)
+
+    # Wait for a slot on the least loaded endpoint that is up, and take it.
+    # If all endpoints are down, the one coming back first is tried.
+    def _acquire(self, exclude):
+        with self.free:
+            while True:
+                now = time.monotonic()
+                candidates = [e for e in self.endpoints if e not in exclude] or self.endpoints
+                up = [e for e in candidates if e.up(now)]
+                if up == []:
+                    up = [min(candidates, key = lambda e: e.down_until)]
+                e = min(up, key = lambda e: e.load())
+                if e.outstanding < e.parallel:
+                    e.outstanding += 1
+                    return e
+                self.free.wait()
+
+    def _release(self, e, seconds, error = None):
+        with self.free:
+            e.outstanding -= 1
+            e.requests += 1
+            e.seconds += seconds
+            if error == None:
+                e.failures = 0
+            else:
+                e.errors += 1
+                e.failures += 1
+                e.last_error = str(error)
+                e.down_until = time.monotonic() + self.cooldown
+            self.free.notify()
+
+    # Call a client method on the best endpoint; on connection errors, timeouts and
+    # server errors, tries the other endpoints before giving up.
+    # Raises ollama.ResponseError if no endpoint answers
+    # (or the request itself is rejected, e.g. an unknown model).
+    def _call(self, method, **kwargs):
+        tried = []
+        while True:
+            e = self._acquire(tried)
+            start = time.monotonic()
+            try:
+                response = getattr(e.client, method)(**kwargs)
+            except ollama.ResponseError as error:
+                if error.status_code < 500:
+                    # Not the server's fault; another one would say the same
+                    self._release(e, time.monotonic() - start)
+                    raise
+                self._release(e, time.monotonic() - start, error)
+                last_error = error
+            except (ConnectionError, httpx.TransportError) as error:
+                self._release(e, time.monotonic() - start, error)
+                last_error = ollama.ResponseError(f"{e.host}: {error}")
+            else:
+                self._release(e, time.monotonic() - start)
+                return response
+            tried.append(e)
+            if len(tried) >= len(self.endpoints):
+                raise last_error
+
+    # Chat request; returns the answer text
+    def chat(self, model, messages, options = {}):
+        response = self._call('chat', model = model, messages = messages, options = options)
+        return response['message']['content']
+
+    # Embeddings for a list of texts (one request); returns a list of vectors
+    def embed(self, model, texts):
+        return self._call('embed', model = model, input = texts)['embeddings']
+
+    # Run func on every item with as many threads as the endpoints take at once
+    # (or workers), yielding (item, result) in the order of items.
+    # Only a limited number of items are read ahead, so items may be a generator.
+    def map(self, func, items, workers = None):
+        if workers == None:
+            workers = self.capacity()
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            futures = deque()
+            for item in items:
+                futures.append((item, pool.submit(func, item)))
+                if len(futures) >= 2 * workers:
+                    item, f = futures.popleft()
+                    yield item, f.result()
+            while futures:
+                item, f = futures.popleft()
+                yield item, f.result()
+
+    # Ask every endpoint whether it is there; marks unreachable ones as down.
+    # Returns the number of endpoints that answered.
+    def probe(self):
+        n = 0
+        for e in self.endpoints:
+            try:
+                e.client.list()
+                with self.lock:
+                    e.down_until = 0
+                    e.failures = 0
+                n += 1
+            except Exception as error:
+                with self.lock:
+                    e.last_error = str(error)
+                    e.down_until = time.monotonic() + self.cooldown
+        return n
+
+    # One dict per endpoint: host, up, outstanding, requests, errors,
+    # avg_seconds, last_error
+    def health(self):
+        now = time.monotonic()
+        with self.lock:
+            return [{'host': e.host,
+                     'up': e.up(now),
+                     'outstanding': e.outstanding,
+                     'requests': e.requests,
+                     'errors': e.errors,
+                     'avg_seconds': e.seconds / e.requests if e.requests > 0 else None,
+                     'last_error': e.last_error} for e in self.endpoints]
+
+    def print_health(self):
+        for h in self.health():
+            avg = f"{h['avg_seconds']:.1f}s" if h['avg_seconds'] != None else "-"
+            print(f"{h['host']}: {'up' if h['up'] else 'DOWN'}, {h['requests']} requests, "
+                  f"{h['errors']} errors, avg {avg}"
+                  + (f" (last error: {h['last_error']})" if h['last_error'] else ""))
+
+# Shared pool, created on first use
+llm_pool = None
+llm_pool_lock = threading.Lock()
+
+def get_llm_pool():
+    global llm_pool
+    with llm_pool_lock:
+        if llm_pool == None:
+            llm_pool = LlmPool()
+        return llm_pool
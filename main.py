@@ -14,7 +14,10 @@ from file_menu import file_menu
 from config import *
 
 from process import tag_process, convert_to_dict
-from nc_bookmarks_api import probe_nc_bookmarks, probe_nc_bookmarks_url
+from nc_bookmarks_api import probe_nc_bookmarks, probe_nc_bookmarks_url, bulk_edit_nc_bookmarks, get_nc_folder
+from nc_mirror import get_nc_mirror
+from tag_similarity import cluster_tags, merge_plan, write_merge_plan, apply_merge_plan
+from dedup import find_duplicates, write_dedup_report, merge_nc_duplicates
 from diigo_api import dia_login, probe_dia, dia_export_delete, dia_privatize
 from diigo_api import probe_diigo_api, probe_dia
 from import_export import import_nc_csv, export_nc_csv, inspect_file
@@ -52,15 +55,69 @@ def inspect_dump_csv_files(path):
 ############### Actual processes ###############
 def process_nc_bookmark_tags():
     """
-    - Read all nc bookmarks via API
-    - Create a dict of all tags
-    - Assign all bookmarks that have no tags, or use unique tags, to a folder
+    - Read all nc bookmarks (from the local mirror)
+    - Get the tags by frequency (from the tag index)
     - Try improving the bookmarks:
-        - Create a dict of tags with the shortest Levenshtein distance for each tag
-        - Use it to remove obvious spelling errors
-        - 
+        - Find clusters of tags that are probably misspellings of each other 
+          (tag_similarity.py)
+        - Write a merge plan, and - if confirmed - replace the variants with
+          the most frequent tag of their cluster
+    - Then, with the merged tags: assign all bookmarks that have no tags, or 
+      only use single-use tags, to UNIQUE_TAG_FOLDER
     """
-    return None
+    mirror = get_nc_mirror()
+    bookmarks = list(mirror.iter_bookmarks())
+    tag_counts = mirror.tags.counts()
+    print(f"{len(bookmarks)} bookmarks, {len(tag_counts)} different tags, {len(mirror.tags.unique_tags())} used only once")
+    clusters = cluster_tags(tag_counts)
+    plan = merge_plan(clusters)
+    for c in clusters[:20]:
+        variants = ", ".join(f"{v} ({n})" for v, n, _ in c['variants'])
+        print(f"{c['tag']} ({c['count']}): {variants}")
+    if len(clusters) > 20:
+        print(f"...and {len(clusters) - 20} more clusters")
+    plan_path = write_merge_plan(plan)
+    print(f"Merge plan with {len(plan)} replacements written to {plan_path}")
+    if len(plan) > 0 and input("Apply merge plan to Nextcloud? (y/N) ").lower() == 'y':
+        changed = apply_merge_plan(bookmarks, plan)
+        result = bulk_edit_nc_bookmarks(changed)
+        for b, id in zip(changed, result['ids']):
+            if id != None:
+                mirror.upsert(b)
+    # A merged tag may no longer be single-use: ask the updated mirror and tag index
+    unique_folder = get_nc_folder(UNIQUE_TAG_FOLDER)
+    ids = set(mirror.tags.single_use_ids())
+    ids |= {b['id'] for b in mirror.iter_bookmarks() if len(b.get('tags', [])) == 0}
+    single_use = [mirror.get(id) for id in sorted(ids)]
+    single_use = [b for b in single_use if b != None and unique_folder not in b['folders']]
+    if len(single_use) > 0 and input(f"Move {len(single_use)} bookmarks without tags or with single-use tags to {UNIQUE_TAG_FOLDER}? (y/N) ").lower() == 'y':
+        for b in single_use:
+            b['folders'] = b['folders'] + [unique_folder]
+        result = bulk_edit_nc_bookmarks(single_use)
+        for b, id in zip(single_use, result['ids']):
+            if id != None:
+                mirror.upsert(b)
+    mirror.close()
+    input("Press Enter to continue")
+    return plan
+
+def find_nc_duplicates():
+    # Report duplicate bookmarks in Nextcloud, and merge them if confirmed
+    mirror = get_nc_mirror()
+    bookmarks = list(mirror.iter_bookmarks())
+    clusters = find_duplicates(bookmarks)
+    url_clusters = [c for c in clusters if c['reason'] == 'url']
+    print(f"{len(bookmarks)} bookmarks: {len(url_clusters)} groups with the same address, "
+          f"{len(clusters) - len(url_clusters)} groups with similar title and description")
+    for c in clusters[:10]:
+        print(f"({c['reason']}) " + " | ".join(str(b['title'])[:40] for b in c['bookmarks']))
+    print(f"Full list in {write_dedup_report(clusters)}")
+    if len(url_clusters) > 0 and input("Merge the groups with the same address? (y/N) ").lower() == 'y':
+        include_text = input("...and the groups with similar text, too? (y/N) ").lower() == 'y'
+        n = merge_nc_duplicates(clusters, mirror, include_text = include_text)
+        print(f"Merged; {n} duplicates deleted")
+    mirror.close()
+    input("Press Enter to continue")
 
 def dummy(remove_diigo=True,
                       use_llm = True,
@@ -136,6 +193,10 @@ if __name__ == "__main__":
                                   "python nc_llm_improve.py"))
     nc_bookmarks_menu.append_item(CommandItem("AI-supported improvement of tags (DETACHED)", 
                                   "python process.py"))
+    nc_bookmarks_menu.append_item(FunctionItem("Find and merge misspelt tags", 
+                                  process_nc_bookmark_tags))
+    nc_bookmarks_menu.append_item(CommandItem("Check for dead links and move them to the '" + UNREACHABLE_FOLDER + "' folder", 
+                                  "python link_check.py"))
     ### Sub-Menu: Tools
     tools_menu = ConsoleMenu("Tools Menu",
                              "Inspect and compare.")
@@ -144,6 +205,7 @@ if __name__ == "__main__":
                                         [config['diigo_dump_path']]))
     tools_menu.append_item(FunctionItem("Analyze bookmarks and tags in CSV file",dummy,[]))
     tools_menu.append_item(FunctionItem("Compare bookmarks",dummy,[]))
+    tools_menu.append_item(FunctionItem("Find and merge duplicate bookmarks in Nextcloud",find_nc_duplicates))
     
     ### Main Menu
     main_menu.append_item(SubmenuItem("Do things on Diigo", diigo_menu,menu=main_menu))
@@ -1,9 +1,154 @@
 # nc_bookmarks_api.py
 
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from collections import deque
 import pandas as pd
 
 from config import *
+from rate_limit import get_limiter, IDEMPOTENT_METHODS
+
+BOOKMARKS_API_PATH = "index.php/apps/bookmarks/public/rest/v2"
+
+############ The client ##############
+
+class NcBookmarksClient:
+    """
+    Talks to the Nextcloud Bookmarks API through one pooled requests session,
+    so consecutive calls reuse their keep-alive TCP/TLS connections instead
+    of doing a new handshake for every single call.
+
+    - nc_url, user, password: default to the values in config['nc_bookmarks']
+    - pool_size: max. number of open connections (config: nc_pool_size)
+    - timeout: (connect, read) timeout in seconds
+      (config: nc_connect_timeout, nc_read_timeout)
+    """
+    def __init__(self,
+                 nc_url = None,
+                 user = None,
+                 password = None,
+                 pool_size = None,
+                 timeout = None):
+        nc_config = config['nc_bookmarks'] if config is not None else {}
+        if nc_url == None:
+            nc_url = nc_config.get('nc_url', "")
+        if user == None:
+            user = nc_config.get('user', "")
+        if password == None:
+            password = nc_config.get('password', "")
+        if pool_size == None:
+            pool_size = get_setting('nc_pool_size', 10)
+        if timeout == None:
+            timeout = (get_setting('nc_connect_timeout', 5),
+                       get_setting('nc_read_timeout', 60))
+        self.nc_url = str(nc_url).rstrip('/')
+        self.user = user
+        self.password = password
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update(AUTH_HEADERS)
+        self.session.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive'
+        })
+        self.session.auth = (user, password)
+
+    def api_url(self, endpoint, id=None):
+        api_url = f"{self.nc_url}/{BOOKMARKS_API_PATH}/{endpoint}"
+        if id != None:
+            api_url += f"/{id}"
+        return api_url
+
+    # All API calls go through here; sets the default timeout, 
+    # and keeps to the shared rate limit (retrying if Nextcloud asks us to slow down)
+    def request(self, method, endpoint, id=None, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return get_limiter('nextcloud').call(self.session.request, 
+                                             method, self.api_url(endpoint, id),
+                                             idempotent = method in IDEMPOTENT_METHODS, **kwargs)
+
+    # Returns the 'data' of a successful query, None otherwise
+    def query(self, endpoint, data, what="bookmarks"):
+        response = self.request('GET', endpoint, json=data)
+        if response.status_code == 200:
+            j = response.json()
+            if j['status'] == "success":
+                return j['data']
+            else: # no success
+                return None
+        else:
+            print(f"Failed to query {what}. Status code: {response.status_code}")
+        return None
+
+    # Returns the ID of the created/changed item, None otherwise
+    def write(self, endpoint, data, id=None, what="bookmark"):
+        response = self.request('POST', endpoint, id, json=data)
+        if response.status_code == 200:
+            j = response.json()
+            if j['status'] == 'success':
+                return j['item']['id']
+            else:
+                print(f"Could not create {what}")
+                return None
+        else:
+            print(f"Failed to create {what}. Status code: {response.status_code}")
+        return None
+
+    def probe(self):
+        response = self.request('GET', 'bookmark')
+        return response.status_code
+
+    def get_bookmarks(self, bookmark_data):
+        return self.query('bookmark', bookmark_data)
+
+    def edit_bookmark(self, bookmark_data, id=None):
+        return self.write('bookmark', bookmark_data, id)
+
+    # True if the bookmark was deleted
+    def delete_bookmark(self, id):
+        response = self.request('DELETE', 'bookmark', id)
+        if response.status_code != 200:
+            print(f"Failed to delete bookmark {id}. Status code: {response.status_code}")
+            return False
+        return response.json().get('status') == 'success'
+
+    def get_folders(self, folder_data):
+        return self.query('folder', folder_data, what="folders")
+
+    def create_folder(self, folder_data):
+        return self.write('folder', folder_data, what="folder")
+
+    def matches(self, nc_url, user, password):
+        return (str(nc_url).rstrip('/'), user, password) == (self.nc_url, self.user, self.password)
+
+    def close(self):
+        self.session.close()
+
+# The module functions share one client. It is rebuilt whenever
+# URL or credentials in the config have changed (e.g. after the user
+# has entered a new password in main.py)
+nc_client = None
+
+def get_nc_client():
+    global nc_client
+    nc_config = config['nc_bookmarks']
+    nc_url = nc_config.get('nc_url', "")
+    user = nc_config.get('user', "")
+    password = nc_config.get('password', "")
+    if nc_client is None or not nc_client.matches(nc_url, user, password):
+        if nc_client is not None:
+            nc_client.close()
+        nc_client = NcBookmarksClient(nc_url, user, password)
+    return nc_client
+
+############ Bookmarks ##############
 
 # Is there a Nextcloud at the URL?
 def probe_nc_bookmarks_url(nc_url=None):
@@ -41,15 +186,15 @@ def probe_nc_bookmarks():
     if config['nc_bookmarks']['user'] + config['nc_bookmarks']['password'] == "":
         print("nc_bookmarks user/password not set")
         return False
-    response = requests.get(f"{nc_url}/index.php/apps/bookmarks/public/rest/v2/bookmark", 
-                            auth=(config['nc_bookmarks']['user'],config['nc_bookmarks']['password']))
-    if response.status_code == 200:
-        bookmarks = response.json()
+    client = NcBookmarksClient(nc_url=nc_url)
+    status_code = client.probe()
+    client.close()
+    if status_code == 200:
         print("Bookmarks probed successfully!")
         # Process the bookmarks data as needed
         return True
     else:
-        print(f"Failed to reach bookmarks. Status code: {response.status_code}")
+        print(f"Failed to reach bookmarks. Status code: {status_code}")
         return False
 
 def create_nc_bookmark(url, 
@@ -64,46 +209,73 @@ def create_nc_bookmark(url,
         "tags": tags,
         "folders": folders
     }
-    
-    response = requests.post(f"{config['nc_bookmarks']['nc_url']}/index.php/apps/bookmarks/public/rest/v2/bookmark",
-                             headers= AUTH_HEADERS,
-                             json=bookmark_data,
-                             auth=(config['nc_bookmarks']['user'],config['nc_bookmarks']['password']))
-    
-    if response.status_code == 200:
-        j = response.json()
-        if j['status'] == 'success':
-            return j['item']['id']
-        else:
-            print("Could not create bookmark")
-            return None
-    else:
-        print(f"Failed to create bookmark. Status code: {response.status_code}")
+    return get_nc_client().edit_bookmark(bookmark_data)
 
 # Update bookmark with given ID.
 # If no ID is given, create from scratch. (NC Bookmarks might overwrite existing bookmarks.)
 def edit_nc_bookmark(data,id=None):
-    bookmark_data = data
-    api_url = f"{config['nc_bookmarks']['nc_url']}index.php/apps/bookmarks/public/rest/v2/bookmark"
-    # Is there an ID? If yes, add to API call. 
-    if id != None:
-        api_url += f"/{id}"
-    response = requests.post(api_url,
-                             headers= AUTH_HEADERS,
-                             json=bookmark_data,
-                             auth=(config['nc_bookmarks']['user'],config['nc_bookmarks']['password']))
-    
-    if response.status_code == 200:
-        j = response.json()
-        if j['status'] == 'success':
-            return j['item']['id']
-        else:
-            print("Could not create bookmark")
+    return get_nc_client().edit_bookmark(data, id)
+
+# Delete the bookmark with this ID; True if successful
+def delete_nc_bookmark(id):
+    return get_nc_client().delete_bookmark(id)
+
+# Create or update many bookmarks at once, with up to concurrency requests
+# in flight (config: nc_concurrency). 
+#
+# bookmarks: iterable of bookmark dicts as for edit_nc_bookmark; a dict with an
+#   'id' key updates that bookmark, otherwise the bookmark is created.
+# Only a window of 2*concurrency bookmarks is held at a time, so the iterable
+# may be a generator over a large file. 
+#
+# Returns a dict with
+# - 'ids': list of the resulting IDs in input order, None where the write failed
+# - 'written', 'failed': number of bookmarks
+# - 'seconds', 'rate': elapsed time, and bookmarks per second
+def bulk_edit_nc_bookmarks(bookmarks, concurrency = None, silent = False):
+    if concurrency == None:
+        concurrency = get_setting('nc_concurrency', 8)
+    client = get_nc_client()
+    def write(b):
+        b = dict(b)
+        id = b.pop('id', None)
+        return client.edit_bookmark(b, id)
+    # A write that raised (connection lost...) fails like any other
+    def result(future):
+        try:
+            return future.result()
+        except Exception as e:
+            print(f"\nERROR writing bookmark: {e}")
             return None
-    else:
-        print(f"Failed to create bookmark. Status code: {response.status_code}")
+    ids = []
+    window = deque()
+    start = time.time()
+    with ThreadPoolExecutor(max_workers = concurrency) as pool:
+        for b in bookmarks:
+            window.append(pool.submit(write, b))
+            if len(window) >= 2 * concurrency:
+                ids.append(result(window.popleft()))
+                if not silent:
+                    print("*" if ids[-1] != None else "x", end="", flush=True)
+        while window:
+            ids.append(result(window.popleft()))
+            if not silent:
+                print("*" if ids[-1] != None else "x", end="", flush=True)
+    seconds = time.time() - start
+    failed = ids.count(None)
+    result = {
+        'ids': ids,
+        'written': len(ids) - failed,
+        'failed': failed,
+        'seconds': seconds,
+        'rate': len(ids) / seconds if seconds > 0 else 0,
+    }
+    if not silent:
+        print(f"\nWrote {result['written']} bookmarks ({failed} failed) in {seconds:.1f}s - {result['rate']:.1f}/s")
+    return result
 
-# Retrieve a list of bookmarks from the given folder, selected by the given tags and filter word
+# Retrieve a list of bookmarks from the given folder, selected by the given tags and filter word.
+# The filters are applied by Nextcloud, so only matching bookmarks are transferred.
 def get_nc_bookmarks(page = 0,
                      limit = 10,
                      tags = [],
@@ -119,63 +291,84 @@ def get_nc_bookmarks(page = 0,
     - tags (list, default []) – 
     - sortby (['url', 'title', 'description', 'public', 
             'lastmodified', 'clickcount'], default: 'lastmodified')
-    - search ([], words to filter by)
-    - conjunction (['and','or'], default: 'or')
+    - search ([], words to filter by - matched against URL, title, 
+            description and tags; a string is one word)
+    - conjunction (['and','or'], default: 'or' - whether a bookmark has
+            to match all of the tags and words, or one of them)
     - folder (int)
     - url (which is ignored here; use "find_nc_bookmarks")
 
     Returns a list of dicts containing the bookmarks - with ID!
     """
-    config = get_config(CONFIG_PATH)
+    if isinstance(search, str):
+        search = [search]
     bookmark_data = {
         'page': page,
         'limit': limit,
         'tags': tags,
-        'sortby': 'lastmodified',
-        'search': [],
-        'conjunction': 'or',
+        'sortby': sortby,
+        'search': search,
+        'conjunction': conjunction,
     }
     if folder != None: 
         bookmark_data['folder'] = folder
     # Ignore URL for the time being. 
-    response = requests.get(f"{config['nc_bookmarks']['nc_url']}/index.php/apps/bookmarks/public/rest/v2/bookmark",
-                            headers= AUTH_HEADERS,
-                            json=bookmark_data,
-                            auth=(config['nc_bookmarks']['user'],
-                                  config['nc_bookmarks']['password']))
-    if response.status_code == 200:
-        folders_j = response.json()
-        if folders_j['status'] == "success":
-            d = folders_j['data']
-            return d
-        else: # no success
-            return None
-    else:
-        print(f"Failed to query bookmarks. Status code: {response.status_code}")
-    return None
+    return get_nc_client().get_bookmarks(bookmark_data)
+
+# Page through the bookmarks, yielding one list of bookmarks per page, in page order.
+# Stops at the first empty page. A page that cannot be read raises ConnectionError -
+# it is not the end of the bookmarks, and a caller must not take it for one.
+#
+# With prefetch > 1, keeps that many page requests in flight on a thread pool,
+# so the next pages are already on their way while the caller processes this one.
+# Other keyword arguments are passed on to get_nc_bookmarks.
+def get_nc_pages(limit = 10, prefetch = 1, **kwargs):
+    if prefetch <= 1:
+        p = 0
+        while True:
+            data = get_nc_bookmarks(page = p, limit = limit, **kwargs)
+            if data == None:
+                raise ConnectionError(f"Could not read page {p} of the Nextcloud bookmarks")
+            if len(data) == 0:
+                return
+            yield data
+            p += 1
+    pool = ThreadPoolExecutor(max_workers = prefetch)
+    pending = deque()
+    next_page = 0
+    try:
+        for _ in range(prefetch):
+            pending.append(pool.submit(get_nc_bookmarks, page = next_page, limit = limit, **kwargs))
+            next_page += 1
+        while pending:
+            data = pending.popleft().result()
+            if data == None:
+                raise ConnectionError(f"Could not read page {next_page - len(pending) - 1} of the Nextcloud bookmarks")
+            if len(data) == 0:
+                break
+            yield data
+            pending.append(pool.submit(get_nc_bookmarks, page = next_page, limit = limit, **kwargs))
+            next_page += 1
+    finally:
+        # Pages beyond the first empty one are not needed
+        for f in pending:
+            f.cancel()
+        pool.shutdown(wait = True)
+
+# Generator over all bookmarks (single dicts), fetched page by page.
+# Only the pages in flight are held in memory, however large the collection.
+def iter_nc_bookmarks(limit = 100, prefetch = 1, **kwargs):
+    for data in get_nc_pages(limit = limit, prefetch = prefetch, **kwargs):
+        for b in data:
+            yield b
 
 # Return bookmark id for this url, None if not found
 def find_nc_bookmark(url,folder_id=-1):
-    global config
     bookmark_data = {
         "url": url,
         "folder": folder_id,
     }
-    response = requests.get(f"{config['nc_bookmarks']['nc_url']}/index.php/apps/bookmarks/public/rest/v2/bookmark",
-                            headers= AUTH_HEADERS,
-                            json=bookmark_data,
-                            auth=(config['nc_bookmarks']['user'],
-                                  config['nc_bookmarks']['password']))
-    if response.status_code == 200:
-        folders_j = response.json()
-        if folders_j['status'] == "success":
-            d = folders_j['data']
-            return d
-        else: # no success
-            return None
-    else:
-        print(f"Failed to query bookmarks. Status code: {response.status_code}")
-    return None
+    return get_nc_client().get_bookmarks(bookmark_data)
 
 def check_nc_bookmark(url):
     d = find_nc_bookmark(url)
@@ -186,71 +379,122 @@ def check_nc_bookmark(url):
 ########### Folders ##############
 
 # Dict of all folders in the root folder, with name and ID. 
-def get_nc_folders():   
-    global config
-    bookmark_data = {
+# With layers=-1, the complete tree: each folder has a list of 'children'.
+def get_nc_folders(layers = None):   
+    folder_data = {
         "root": -1
     }
-    response = requests.get(f"{config['nc_bookmarks']['nc_url']}/index.php/apps/bookmarks/public/rest/v2/folder",
-                            headers= AUTH_HEADERS,
-                            json=bookmark_data,
-                            auth=(config['nc_bookmarks']['user'],
-                                  config['nc_bookmarks']['password']))
-    if response.status_code == 200:
-        folders_j = response.json()
-        if folders_j['status'] == "success":
-            return folders_j['data']
-        else: # no success
-            print("Failed to retrieve folders")
-            return None
-        return response.json()
-    else:
-        print(f"Failed to query folders. Status code: {response.status_code}")
+    if layers != None:
+        folder_data['layers'] = layers
+    f = get_nc_client().get_folders(folder_data)
+    if f == None:
+        print("Failed to retrieve folders")
+    return f
 
 def create_nc_folder(name, parent =-1):  
-    global config 
     folder_data = {
-        "title": name #,
-        # "parent_folder": parent
+        "title": name
     }
-    response = requests.post(f"{config['nc_bookmarks']['nc_url']}/index.php/apps/bookmarks/public/rest/v2/folder",
-                            headers= AUTH_HEADERS,
-                            json=folder_data,
-                            auth=(config['nc_bookmarks']['user'],
-                                  config['nc_bookmarks']['password']))
-    if response.status_code == 200:
-        folders_j = response.json()
-        if folders_j['status'] == "success":
-            return folders_j['item']['id']
-        else: # no success
-            print(f"Failed to create folder {name} with parent {parent}")
-            return None
-        return response.json()
-    else:
-        print(f"Failed to create folders. Status code: {response.status_code}")
+    if parent != -1:
+        folder_data['parent_folder'] = parent
+    folder_id = get_nc_client().create_folder(folder_data)
+    if folder_id == None:
+        print(f"Failed to create folder {name} with parent {parent}")
+    elif nc_folder_cache != None:
+        # Created behind the cache's back
+        nc_folder_cache.invalidate()
+    return folder_id
 
+class NcFolderCache:
+    """
+    Loads the whole folder tree once, and resolves folder names and paths 
+    like "DIIGO/LESEN" to IDs with a dict lookup. A plain name is a folder 
+    in the root folder. 
+
+    Missing folders (and missing parents) are created on the way, and 
+    entered into the cache right away, so the tree is not reloaded.
+    """
+    def __init__(self, client = None):
+        self.client = client
+        self.lock = threading.Lock()
+        self.paths = None
+
+    def invalidate(self):
+        with self.lock:
+            self.paths = None
+
+    def _walk(self, folders, prefix):
+        for f in folders:
+            path = f"{prefix}{f['title']}"
+            # If names are not unique, the first one wins - like get_nc_folder_id did
+            self.paths.setdefault(path, f['id'])
+            self._walk(f.get('children', []), path + "/")
+
+    def _load(self):
+        folders = get_nc_folders(layers = -1)
+        if folders == None:
+            raise Exception("Could not read Nextcloud folders")
+        self.paths = {}
+        self._walk(folders, "")
+
+    # ID of the folder at path, None if there is none
+    def get_id(self, path):
+        with self.lock:
+            if self.paths == None:
+                self._load()
+            return self.paths.get(path.strip('/'))
 
-# Checks whether there is a folder with a name that matches the regex r,
-# then return a list of all matching folder ids
+    # ID of the folder at path; creates it (and its parents) if necessary
+    def get(self, path):
+        with self.lock:
+            if self.paths == None:
+                self._load()
+            path = path.strip('/')
+            if path in self.paths:
+                return self.paths[path]
+            parent = -1
+            prefix = ""
+            for name in path.split('/'):
+                prefix = f"{prefix}{name}"
+                if prefix in self.paths:
+                    parent = self.paths[prefix]
+                else:
+                    print(f"Creating Nextcloud folder {prefix}...")
+                    folder_data = {"title": name}
+                    if parent != -1:
+                        folder_data['parent_folder'] = parent
+                    parent = get_nc_client().create_folder(folder_data)
+                    if parent == None:
+                        raise Exception(f"Could not create {prefix} folder")
+                    self.paths[prefix] = parent
+                prefix += "/"
+            return parent
+
+    # Resolve several paths in one go, creating what is missing
+    def get_many(self, paths):
+        return [self.get(p) for p in paths]
+
+# Shared cache, belongs to the current client (i.e. user)
+nc_folder_cache = None
+
+def get_nc_folder_cache():
+    global nc_folder_cache
+    client = get_nc_client()
+    if nc_folder_cache == None or nc_folder_cache.client is not client:
+        nc_folder_cache = NcFolderCache(client)
+    return nc_folder_cache
+
+# Return the id of the folder with this name (or path), None if it does not exist
 def get_nc_folder_id(r):
-    f_j = get_nc_folders()
-    # f = []
-    for j in f_j:
-        if (r == j['title']):
-        #if re.match(r,j['title']):
-            return j['id']
-    return None 
+    return get_nc_folder_cache().get_id(r)
 
+# Return the id of the folder with this name (or path), create it if necessary
 def get_nc_folder(name):
-# Is there already a folder called name?
-    folder_id = get_nc_folder_id(name)
-    if folder_id == None:
-        print(f"Creating Nextcloud folder {name}...")
-        folder_id = create_nc_folder(name)
-        if folder_id == None:
-            raise Exception(f"Could not create {name} folder")
-    else:
-        return(folder_id)
+    return get_nc_folder_cache().get(name)
+
+# Same for a list of names, e.g. [DIIGO_FOLDER, UNREAD_FOLDER]
+def get_nc_folders_ids(names):
+    return get_nc_folder_cache().get_many(names)
 
 def get_nc_diigo_folder():
     return get_nc_folder("DIIGO")
@@ -1,64 +1,293 @@
 # nc_llm_improve.py
 #
-# Get a dump of all bookmarks from Nextcloud, 
-# look for those without a description, and have an LLM
-# suggest a description. 
+# Go through all bookmarks in Nextcloud, look for those without
+# a description, and have an LLM suggest a description.
 #
-# Also, make a dict of all tags and their frequency, 
-# and filter out those that have been used only once. 
-# Try suggesting similar tags. 
-# 
 # Script is supposed to be running in the background as it
-# will definitely take indefinitely. 
+# will definitely take indefinitely. So it keeps a work list (see
+# work_queue.py) with the status of every bookmark - pending, done,
+# unreachable, or failed - and every run continues with what is
+# still pending. Only bookmarks that may need work are downloaded:
+# those with a placeholder, and those modified since the last run.
+#
+# The most valuable bookmarks come first - unread, clicked, recent, without
+# a description (see scheduler.py). Each bookmark goes through a pipeline
+# (see pipeline.py):
+#   read page (fetch workers) -> LLM (llm workers) -> write to Nextcloud
+# Bookmarks whose page is unreachable are moved to the UNREAD_FOLDER.
+#
+#   python nc_llm_improve.py [--max-items N] [--max-runtime SECONDS]
+#                            [--fetch-workers N] [--llm-workers N]
+#                            [--retry-unreachable]
+#
+# Stops after max-items bookmarks or max-runtime seconds; on SIGTERM or
+# Ctrl-C, it finishes the bookmarks that are being written and leaves the
+# rest pending for the next run.
 
+import sys
+import argparse
+import signal
+import threading
+import time
 
 from config import *
-from process import * 
+from process import *
 from nc_bookmarks_api import *
+from nc_mirror import NcMirror
+from llm_pool import get_llm_pool
+from pipeline import Pipeline
+from work_queue import WorkQueue
+from scheduler import Scheduler, PriorityScorer
+
+# Does the bookmark still need an LLM description?
+def needs_description(b):
+    description = b['description']
+    # Bookmark already prepared for LLM description, and no placeholder left?
+    if '# LLM_DESCRIPTION' in description and '###LLM###' not in description:
+        return False
+    # Placeholder, or native bookmark not set by importer
+    return True
+
+# Bring the work list up to date with Nextcloud. Only two kinds of bookmarks
+# are downloaded - the filtering is done by Nextcloud:
+# - those with a placeholder for an LLM description (found by searching for it)
+# - those modified since the last run, newest first (on the first run: all)
+# New bookmarks are added (as done if they already have a description), done
+# ones that got a placeholder again are put back on the list. Bookmarks
+# deleted in Nextcloud stay on the list until writing them fails.
+# If a page cannot be read, what was read is kept, but the high-water mark
+# stays where it was - the next run looks at the same bookmarks again.
+# Returns the number of bookmarks added.
+def update_work_list(queue, silent = False):
+    statuses = queue.statuses()
+    high_water = queue.get_meta('high_water')
+    if high_water != None:
+        high_water = int(float(high_water))
+    new_high_water = high_water or 0
+    added = 0
+    downloaded = 0
+    new_pending, new_done, known = [], [], []
+
+    def flush():
+        queue.add(new_pending)
+        queue.add(new_done, done = True)
+        # Keep the latest version of those already on the list
+        queue.add(known)
+        for l in [new_pending, new_done, known]:
+            l.clear()
+
+    def consider(b):
+        nonlocal added
+        status = statuses.get(b['id'])
+        if status == None:
+            added += 1
+            statuses[b['id']] = 'pending' if needs_description(b) else 'done'
+            (new_pending if needs_description(b) else new_done).append(b)
+        else:
+            known.append(b)
+            if status == 'done' and needs_description(b):
+                queue.set(b['id'], 'pending')
+                statuses[b['id']] = 'pending'
+        if len(new_pending) + len(new_done) + len(known) >= 1000:
+            flush()
+
+    limit = get_setting('nc_batch_size', 100)
+    bookmarks = iter_nc_bookmarks(limit = limit, sortby = 'lastmodified')
+    try:
+        for b in iter_nc_bookmarks(limit = limit, search = ['###LLM###']):
+            downloaded += 1
+            consider(b)
+        for b in bookmarks:
+            lastmodified = b.get('lastmodified', 0)
+            # Same second as the high-water mark may still be new
+            if high_water != None and lastmodified < high_water:
+                break
+            downloaded += 1
+            consider(b)
+            new_high_water = max(new_high_water, lastmodified)
+    except Exception as e:
+        print(f"Could not read all candidates from Nextcloud: {e}")
+        new_high_water = high_water
+    bookmarks.close()
+    flush()
+    if new_high_water != None:
+        queue.set_meta('high_water', new_high_water)
+    if not silent:
+        print(f"Downloaded {downloaded} candidate bookmarks")
+    return added
+
+# Write the result for one bookmark back to Nextcloud.
+# llm_description: the new description, "" if there is nothing to describe,
+# None if the page is unreachable.
+def write_result(b, llm_description, nc_unread_folder, mirror):
+    b = dict(b)
+    if llm_description == None:
+        # Site is unreachable
+        if nc_unread_folder in b['folders']:
+            return True
+        b['folders'] = b['folders'] + [nc_unread_folder]
+    else:
+        description = b['description']
+        if not '# LLM_DESCRIPTION' in description:
+            description = description + "# LLM_DESCRIPTION\n###LLM###"
+        # Upload modified description
+        b['description'] = description.replace("###LLM###",llm_description)
+    data = {k: v for k, v in b.items() if k != 'id'}
+    if edit_nc_bookmark(data, b['id']) == None:
+        return False
+    mirror.upsert(b)
+    return True
+
+# Work through the pending bookmarks, most valuable first (see scheduler.py);
+# returns a dict status -> count for this run.
+# max_items: stop after this many bookmarks; max_runtime: stop taking new ones
+# after this many seconds; fetch_workers: pages read at once (config:
+# llm_improve_fetch_workers); llm_workers: LLM requests at once (config:
+# llm_workers, default: what the Ollama servers take); score: function
+# b -> (score, tier) for the order, default: PriorityScorer.
+def improve_nc_descriptions(max_items = None, max_runtime = None,
+                            fetch_workers = None, llm_workers = None,
+                            retry_unreachable = False, score = None):
+    # Get folder ID for marking unreadable bookmarks
+    nc_unread_folder = get_nc_folder(UNREAD_FOLDER)
+    # The local copy is kept up to date with what we write, but not synced:
+    # the work list only needs the candidates
+    mirror = NcMirror()
+    queue = WorkQueue()
+    if retry_unreachable:
+        print(f"{queue.reset('unreachable')} unreachable bookmarks put back on the list")
+    added = update_work_list(queue)
+    todo = []
+    for id in queue.todo():
+        # Lists from older versions do not keep the bookmarks
+        b = queue.bookmark(id) or mirror.get(id)
+        if b == None:
+            # Deleted since
+            queue.remove([id])
+            continue
+        todo.append(b)
+    print(f"{added} new bookmarks, {len(todo)} to do")
+    # Throughput of the last run, for the first estimates
+    rate = queue.get_meta('rate')
+    scheduler = Scheduler(todo, score or PriorityScorer(nc_unread_folder),
+                          rate = float(rate) if rate != None else None)
+    scheduler.print_eta()
+    fetch_workers = fetch_workers or get_setting('llm_improve_fetch_workers', 8)
+    llm_workers = llm_workers or get_setting('llm_workers') or get_llm_pool().capacity()
+    start = time.monotonic()
+    stop = threading.Event()
+    counts = {'done': 0, 'unreachable': 0, 'failed': 0}
+    counts_lock = threading.Lock()
+
+    def handle_signal(signum, frame):
+        if not stop.is_set():
+            print("\nStopping - finishing the bookmarks in the works...", flush=True)
+        stop.set()
+
+    def out_of_budget():
+        return stop.is_set() or (max_runtime != None and time.monotonic() - start > max_runtime)
+
+    def finish(id, status, error = None):
+        queue.set(id, status, error)
+        scheduler.done()
+        with counts_lock:
+            counts[status] += 1
+
+    def source():
+        n = 0
+        for b in scheduler:
+            if out_of_budget() or (max_items != None and n >= max_items):
+                break
+            n += 1
+            yield b
+
+    def fetch(b):
+        if out_of_budget():
+            # Left pending for the next run
+            return None
+        try:
+            page = read_page(b['url'], silent = True)
+        except Exception as e:
+            finish(b['id'], 'failed', str(e))
+            return None
+        print("." if page != None else "x", end="", flush=True)
+        return (b, page)
+
+    def describe(item):
+        b, page = item
+        if page == None:
+            return (b, None)
+        if page['skipped']:
+            return (b, "")
+        if out_of_budget():
+            return None
+        try:
+            llm_description = summarize_content(b['url'], page['title'], b['description'], page['content'])
+        except Exception as e:
+            # LLM unreachable or failing; ollama.ResponseError, connection errors...
+            finish(b['id'], 'failed', str(e))
+            return None
+        print("@", end="", flush=True)
+        return (b, llm_description)
+
+    def write(item):
+        b, llm_description = item
+        if not write_result(b, llm_description, nc_unread_folder, mirror):
+            finish(b['id'], 'failed', "Could not write to Nextcloud")
+            return None
+        finish(b['id'], 'unreachable' if llm_description == None else 'done')
+        print("*", end="", flush=True)
+        return b
+
+    old_handlers = {s: signal.signal(s, handle_signal) for s in [signal.SIGTERM, signal.SIGINT]}
+    try:
+        pipe = Pipeline()
+        pipe.add_stage("fetch", fetch, workers = fetch_workers)
+        pipe.add_stage("llm", describe, workers = llm_workers)
+        pipe.add_stage("nextcloud", write, workers = get_setting('nc_concurrency', 8))
+        pipe.run(source())
+    finally:
+        for s, handler in old_handlers.items():
+            signal.signal(s, handler)
+        mirror.close()
+    print(f"\n{counts['done']} described, {counts['unreachable']} unreachable, "
+          f"{counts['failed']} failed in {time.monotonic() - start:.0f}s")
+    left = queue.counts()
+    print(f"Left to do: {left['pending']} pending, {left['failed']} failed")
+    if scheduler.finished >= 10:
+        queue.set_meta('rate', scheduler.rate())
+    if len(scheduler) > 0:
+        scheduler.print_eta()
+    queue.close()
+    return counts
 
 if __name__ == "__main__":
-    # Import config
+    parser = argparse.ArgumentParser(description = "Have an LLM describe the Nextcloud bookmarks")
+    parser.add_argument('--max-items', type = int, help = "stop after this many bookmarks")
+    parser.add_argument('--max-runtime', type = float, help = "stop after this many seconds")
+    parser.add_argument('--fetch-workers', type = int, help = "web pages read at once")
+    parser.add_argument('--llm-workers', type = int, help = "LLM requests at once")
+    parser.add_argument('--retry-unreachable', action = 'store_true',
+                        help = "try unreachable bookmarks again")
+    args = parser.parse_args()
     # Try to reach NC bookmarks
     if not probe_nc_bookmarks():
         print("Nextcloud unreachable. Returning.")
-    # Get folder ID for marking unreadable bookmarks
-    nc_unread_folder = get_nc_folder(UNREAD_FOLDER)
-    p = 0
-    # Smaller stepwidth, loading the bookmarks is negligible
-    print(f"Batch progress: (.) Reading (x) Checking (^) Website unreachable (@) AI reflecting (*) Done")
-    nc_df = get_nc_bookmarks(page=p, limit = 10)
-    while len(nc_df) > 0:
-        # print 10 markers to show progress
-        print("..........\b\b\b\b\b\b\b\b\b\b",end="", flush=True)
-        # Step through bookmarks
-        for b in nc_df:
-            print("^",end="", flush=True)
-            url = b['url']
-            description = b['description']
-            # Bookmark already prepared for LLM description?
-            if '# LLM_DESCRIPTION' in description:
-                # Check whether there is still a placeholder, otherwise, 
-                if '###LLM###' in description: 
-                    print("\b@",end="", flush=True)
-                    llm_description = suggest_description(url,description,silent = True)
-                else: # already has a LLM description   
-                    llm_description = "" 
-            else: # No LLM description, native bookmark not set by importer
-                print("\b@",end="", flush=True)
-                llm_description = suggest_description(url,description,silent = True)
-                if not (llm_description == None):
-                    description = description + "# LLM_DESCRIPTION\n###LLM###"
-            if llm_description == None: 
-                # Site is unreachable
-                print("\bx",end="", flush=True)
-                if nc_unread_folder not in b['folders']:
-                    b['folders'].append(nc_unread_folder)
-            else:
-                # Upload modified description
-                description = description.replace("###LLM###",llm_description)
-                b['description'] = description
-                edit_nc_bookmark(b)
-                print("\b*",end="", flush=True)
-        p += 1
-        nc_df = get_nc_bookmarks(page=p, limit = 10)    
-    input("Done - press ENTER to return")
+    else:
+        # Several pages are read and summarized at once, spread over the Ollama servers
+        pool = get_llm_pool()
+        if pool.probe() == 0:
+            # Every bookmark would fail
+            print("No Ollama server reachable:")
+            pool.print_health()
+        else:
+            print(f"Progress: (.) Read (x) Website unreachable (@) AI reflecting (*) Done")
+            improve_nc_descriptions(max_items = args.max_items,
+                                    max_runtime = args.max_runtime,
+                                    fetch_workers = args.fetch_workers,
+                                    llm_workers = args.llm_workers,
+                                    retry_unreachable = args.retry_unreachable)
+            pool.print_health()
+    # Started from the menu: wait; in the background: just end
+    if sys.stdin.isatty():
+        input("Done - press ENTER to return")
@@ -0,0 +1,320 @@
+# nc_mirror.py
+#
+# Local SQLite mirror of the Nextcloud bookmarks collection.
+#
+# Filled by one bulk dump via iter_nc_bookmarks, then queried locally:
+# looking up a URL, a tag, or a folder no longer needs an API call.
+# The time of the last sync is kept in the meta table, so callers
+# can decide for themselves when the mirror is too old to be trusted.
+#
+# Between full dumps, sync() only fetches what has changed: Nextcloud
+# returns bookmarks sorted by lastmodified, newest first, so we can stop
+# paging as soon as we reach a bookmark older than the newest one we have
+# (the "high-water mark"). Deletions are only noticed by a full refresh.
+#
+# Every change to the mirror also updates the tag index (tag_index.py).
+
+import os
+import json
+import sqlite3
+import threading
+import time
+
+from config import *
+from process import canonical_url, CANONICAL_URL_VERSION
+from nc_bookmarks_api import iter_nc_bookmarks
+from tag_index import TagIndex
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bookmarks (
+    id INTEGER PRIMARY KEY,
+    url TEXT,
+    canonical_url TEXT,
+    title TEXT,
+    lastmodified INTEGER,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_bookmarks_canonical_url ON bookmarks(canonical_url);
+CREATE TABLE IF NOT EXISTS bookmark_tags (
+    bookmark_id INTEGER,
+    tag TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_bookmark_tags_tag ON bookmark_tags(tag);
+CREATE INDEX IF NOT EXISTS idx_bookmark_tags_id ON bookmark_tags(bookmark_id);
+CREATE TABLE IF NOT EXISTS bookmark_folders (
+    bookmark_id INTEGER,
+    folder_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_bookmark_folders_folder ON bookmark_folders(folder_id);
+CREATE INDEX IF NOT EXISTS idx_bookmark_folders_id ON bookmark_folders(bookmark_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+class NcMirror:
+    """
+    SQLite copy of the Nextcloud bookmarks, indexed on canonical URL, tag and folder.
+
+    Bookmarks are stored as the dicts returned by the API (column 'data'),
+    so lookups return the same dicts as get_nc_bookmarks/find_nc_bookmark.
+    """
+    def __init__(self, path = MIRROR_PATH):
+        path = os.path.expanduser(path)
+        directory = os.path.dirname(path)
+        if directory != "" and not os.path.exists(directory):
+            os.mkdir(directory)
+        self.path = path
+        # The mirror may be shared by worker threads; serialize access
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+        # Canonical URLs stored by an older version of canonical_url?
+        if self._get_meta('canonical_url_version') != str(CANONICAL_URL_VERSION):
+            self.update_canonical_urls()
+        # The tag index is only trusted if it was saved together with the mirror
+        self.tags = TagIndex()
+        if self._get_meta('tag_index_saved') != str(self.tags.saved_at) and self.count() > 0:
+            self.rebuild_tags()
+
+    def update_canonical_urls(self):
+        with self.lock:
+            rows = self.db.execute("SELECT id, url FROM bookmarks").fetchall()
+            self.db.executemany("UPDATE bookmarks SET canonical_url = ? WHERE id = ?",
+                                [(canonical_url(url), id) for id, url in rows])
+            self._set_meta('canonical_url_version', CANONICAL_URL_VERSION)
+            self.db.commit()
+
+    def _tags_of(self, id):
+        return [r[0] for r in self.db.execute(
+            "SELECT tag FROM bookmark_tags WHERE bookmark_id = ?", (id,)).fetchall()]
+
+    # Called with the lock held, before a commit that changes tags: 
+    # until the index is saved, the file on disk does not match the mirror
+    def _tags_dirty(self):
+        self._set_meta('tag_index_saved', "")
+
+    def _save_tags(self):
+        self._set_meta('tag_index_saved', self.tags.save())
+        self.db.commit()
+
+    # Build the tag index from scratch from the mirrored bookmarks
+    def rebuild_tags(self):
+        with self.lock:
+            self.tags.clear()
+            for (data,) in self.db.execute("SELECT data FROM bookmarks"):
+                self.tags.update(json.loads(data))
+            self._save_tags()
+
+    def _insert(self, b):
+        id = b['id']
+        self.tags.update(b, self._tags_of(id))
+        self.db.execute("DELETE FROM bookmark_tags WHERE bookmark_id = ?", (id,))
+        self.db.execute("DELETE FROM bookmark_folders WHERE bookmark_id = ?", (id,))
+        self.db.execute("INSERT OR REPLACE INTO bookmarks VALUES (?,?,?,?,?,?)",
+                        (id,
+                         b.get('url', ""),
+                         canonical_url(b.get('url', "")),
+                         b.get('title', ""),
+                         b.get('lastmodified', 0),
+                         json.dumps(b)))
+        self.db.executemany("INSERT INTO bookmark_tags VALUES (?,?)",
+                            [(id, t) for t in b.get('tags', [])])
+        self.db.executemany("INSERT INTO bookmark_folders VALUES (?,?)",
+                            [(id, f) for f in b.get('folders', [])])
+
+    # Add or replace a single bookmark (e.g. after creating it in Nextcloud)
+    def upsert(self, b):
+        with self.lock:
+            self._insert(b)
+            self._tags_dirty()
+            self.db.commit()
+            if self.tags.checkpoint() != None:
+                self._set_meta('tag_index_saved', self.tags.saved_at)
+                self.db.commit()
+
+    def delete(self, id):
+        with self.lock:
+            self.tags.remove(id, self._tags_of(id))
+            self._tags_dirty()
+            self.db.execute("DELETE FROM bookmarks WHERE id = ?", (id,))
+            self.db.execute("DELETE FROM bookmark_tags WHERE bookmark_id = ?", (id,))
+            self.db.execute("DELETE FROM bookmark_folders WHERE bookmark_id = ?", (id,))
+            self.db.commit()
+
+    # Back to the last commit after a failed sync, tag index included
+    # (called with the lock held)
+    def _rollback(self):
+        self.db.rollback()
+        self.tags = TagIndex()
+        if self._get_meta('tag_index_saved') != str(self.tags.saved_at):
+            self.tags.clear()
+            for (data,) in self.db.execute("SELECT data FROM bookmarks"):
+                self.tags.update(json.loads(data))
+            self._save_tags()
+
+    # Replace the mirror's content by a full dump from Nextcloud.
+    # bookmarks: iterable of bookmark dicts; defaults to iter_nc_bookmarks()
+    # Nothing is committed until the dump is complete: if it fails, the old
+    # content stays, and so do the sync times.
+    # Returns the number of bookmarks mirrored, None if the dump failed.
+    def refresh(self, bookmarks = None, prefetch = None):
+        if bookmarks == None:
+            if prefetch == None:
+                prefetch = get_setting('nc_prefetch', 4)
+            bookmarks = iter_nc_bookmarks(limit = get_setting('nc_batch_size', 100),
+                                          prefetch = prefetch)
+        n = 0
+        with self.lock:
+            self.db.execute("DELETE FROM bookmarks")
+            self.db.execute("DELETE FROM bookmark_tags")
+            self.db.execute("DELETE FROM bookmark_folders")
+            self.tags.clear()
+            high_water = 0
+            try:
+                for b in bookmarks:
+                    self._insert(b)
+                    high_water = max(high_water, b.get('lastmodified', 0))
+                    n += 1
+            except Exception as e:
+                print(f"Could not download the Nextcloud bookmarks, keeping the old copy: {e}")
+                self._rollback()
+                return None
+            t = time.time()
+            self._set_meta('last_sync', t)
+            self._set_meta('last_full_sync', t)
+            self._set_meta('high_water', high_water)
+            self._save_tags()
+        return n
+
+    # Fetch only bookmarks modified since the last sync, and stop
+    # paging at the first one that is older than the high-water mark.
+    # Falls back to a full refresh if the mirror was never filled, or if the last
+    # full refresh is older than full_max_age seconds (config: nc_mirror_full_refresh,
+    # default: one day) - that is the only way to notice deleted bookmarks.
+    #
+    # Returns the number of bookmarks updated, None if the sync failed
+    # (then the mirror is left as it was).
+    def sync(self, full_max_age = None):
+        if full_max_age == None:
+            full_max_age = get_setting('nc_mirror_full_refresh', 86400)
+        with self.lock:
+            high_water = self._get_meta('high_water')
+            last_full_sync = self._get_meta('last_full_sync')
+        if high_water == None or last_full_sync == None \
+            or time.time() - float(last_full_sync) > full_max_age:
+            return self.refresh()
+        high_water = int(float(high_water))
+        new_high_water = high_water
+        n = 0
+        bookmarks = iter_nc_bookmarks(limit = get_setting('nc_batch_size', 100),
+                                      sortby = 'lastmodified')
+        with self.lock:
+            try:
+                for b in bookmarks:
+                    lastmodified = b.get('lastmodified', 0)
+                    # Same second as the high-water mark may still be new; 
+                    # re-inserting is harmless.
+                    if lastmodified < high_water:
+                        break
+                    self._insert(b)
+                    new_high_water = max(new_high_water, lastmodified)
+                    n += 1
+            except Exception as e:
+                print(f"Could not update the Nextcloud bookmarks, keeping the old copy: {e}")
+                self._rollback()
+                return None
+            bookmarks.close()
+            self._set_meta('last_sync', time.time())
+            self._set_meta('high_water', new_high_water)
+            self._save_tags()
+        return n
+
+    def _set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?,?)", (key, str(value)))
+
+    def _get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row == None:
+            return None
+        return row[0]
+
+    # Unix time of the last sync, None if the mirror was never filled
+    def last_sync(self):
+        with self.lock:
+            t = self._get_meta('last_sync')
+        if t == None:
+            return None
+        return float(t)
+
+    # Never synced, or synced more than max_age seconds ago?
+    # (config: nc_mirror_max_age, default: one hour)
+    def is_stale(self, max_age = None):
+        if max_age == None:
+            max_age = get_setting('nc_mirror_max_age', 3600)
+        t = self.last_sync()
+        return t == None or time.time() - t > max_age
+
+    def _select(self, sql, params):
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    # All bookmarks for this URL (compared in canonical form),
+    # optionally only those in folder_id. Like find_nc_bookmark, returns a list.
+    def find_url(self, url, folder_id = None):
+        if folder_id == None or folder_id == -1:
+            return self._select("SELECT data FROM bookmarks WHERE canonical_url = ?",
+                                (canonical_url(url),))
+        return self._select("""SELECT b.data FROM bookmarks b
+                               JOIN bookmark_folders f ON f.bookmark_id = b.id
+                               WHERE b.canonical_url = ? AND f.folder_id = ?""",
+                            (canonical_url(url), folder_id))
+
+    def find_tag(self, tag):
+        return self._select("""SELECT b.data FROM bookmarks b
+                               JOIN bookmark_tags t ON t.bookmark_id = b.id
+                               WHERE t.tag = ?""", (tag,))
+
+    def find_folder(self, folder_id):
+        return self._select("""SELECT b.data FROM bookmarks b
+                               JOIN bookmark_folders f ON f.bookmark_id = b.id
+                               WHERE f.folder_id = ?""", (folder_id,))
+
+    def get(self, id):
+        r = self._select("SELECT data FROM bookmarks WHERE id = ?", (id,))
+        if len(r) == 0:
+            return None
+        return r[0]
+
+    # Generator over all mirrored bookmarks, most recently modified first
+    def iter_bookmarks(self):
+        with self.lock:
+            ids = [r[0] for r in self.db.execute(
+                "SELECT id FROM bookmarks ORDER BY lastmodified DESC").fetchall()]
+        for id in ids:
+            b = self.get(id)
+            if b != None:
+                yield b
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM bookmarks").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self._save_tags()
+        self.db.close()
+
+# Open the mirror, and bring it up to date if it is missing or stale.
+# max_age = 0 forces a (usually incremental) sync.
+def get_nc_mirror(max_age = None):
+    mirror = NcMirror()
+    if mirror.is_stale(max_age):
+        print("Updating local copy of the Nextcloud bookmarks...")
+        n = mirror.sync()
+        if n != None:
+            print(f"{n} bookmarks updated")
+    return mirror
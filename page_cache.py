@@ -0,0 +1,391 @@
+# page_cache.py
+#
+# On-disk cache for the web pages suggest_description reads.
+#
+# The index (an SQLite table keyed by URL) keeps status, headers, ETag and
+# Last-Modified, the time of the fetch, and whether the page could only be read
+# without certificate verification. Failures are recorded, too, so a dead link
+# is not tried again on every run. The page bodies are stored as files named by
+# the hash of their content - the same page under two URLs is stored once.
+#
+# Policy:
+# - younger than ttl: served from disk, no request at all
+# - older: revalidated with a conditional GET (If-None-Match/If-Modified-Since);
+#   a 304 refreshes the entry without downloading the page again
+# - failures that will not go away (404, 410, a host name that does not exist)
+#   are cached for error_ttl; others (timeouts, server errors...) only for
+#   retry_ttl, and reported as transient, so the caller can try again later
+# - if the bodies take up more than max_size bytes, the least recently used
+#   entries are evicted
+#
+# Downloads are streamed with connect/read timeouts, and stop at max_bytes or
+# after max_seconds - whatever arrived until then is kept (the title and the
+# start of the text are what matters). Anything that is not HTML or text
+# (by Content-Type, or by sniffing the first bytes) is not downloaded at all.
+
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import logging
+import socket
+
+import requests
+from requests.exceptions import SSLError
+
+from config import *
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    status INTEGER,
+    error TEXT,
+    headers TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    encoding TEXT,
+    body_hash TEXT,
+    size INTEGER,
+    insecure INTEGER,
+    fetched_at REAL,
+    accessed_at REAL,
+    permanent INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_pages_accessed_at ON pages(accessed_at);
+CREATE INDEX IF NOT EXISTS idx_pages_body_hash ON pages(body_hash);
+"""
+
+# Content types we read; everything else (PDFs, images, videos...) is skipped
+TEXT_TYPES = ['text/html', 'application/xhtml+xml', 'text/plain', 'application/xml', 'text/xml']
+# Signatures of binary files served with a wrong (or no) Content-Type
+BINARY_MAGIC = [b'%PDF', b'PK\x03\x04', b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'\x1f\x8b', b'ID3']
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+
+COLUMNS = ['url', 'status', 'error', 'headers', 'etag', 'last_modified', 'encoding',
+           'body_hash', 'size', 'insecure', 'fetched_at', 'accessed_at', 'permanent']
+
+# Answers that mean the page is gone for good
+PERMANENT_STATUS = [404, 410]
+# Resolver answers that will not change soon: the name does not exist,
+# or has no addresses (EAI_NODATA is not defined everywhere)
+PERMANENT_DNS_ERRORS = {getattr(socket, name) for name in ['EAI_NONAME', 'EAI_NODATA']
+                        if hasattr(socket, name)}
+
+# The name resolution error behind a requests exception, None if there is none.
+# It is wrapped a few levels deep
+# (requests ConnectionError -> urllib3 MaxRetryError -> NameResolutionError -> gaierror)
+def find_gaierror(e):
+    cause = e
+    for _ in range(5):
+        if cause == None:
+            break
+        if isinstance(cause, socket.gaierror):
+            return cause
+        if getattr(cause, 'reason', None) != None:
+            cause = cause.reason
+        elif cause.args and isinstance(cause.args[0], Exception):
+            cause = cause.args[0]
+        else:
+            cause = cause.__context__
+    return None
+
+# Does the host of the failed request not exist at all?
+def host_unknown(e):
+    gaierror = find_gaierror(e)
+    return gaierror != None and gaierror.errno in PERMANENT_DNS_ERRORS
+
+class PageCache:
+    """
+    Content-addressed HTTP cache for web pages.
+
+    - path: cache directory (default: PAGE_CACHE_PATH)
+    - ttl: seconds a page is served without asking the server (config: page_cache_ttl)
+    - error_ttl: seconds a permanent failure (404, 410, unknown host) is
+      remembered (config: page_cache_error_ttl)
+    - retry_ttl: seconds any other failure is remembered (config: page_cache_retry_ttl)
+    - max_size: max. bytes of stored pages (config: page_cache_max_size)
+    - timeout: (connect, read) timeout for requests
+      (config: page_connect_timeout, page_read_timeout)
+    - max_bytes: max. bytes read of a page (config: page_max_bytes)
+    - max_seconds: max. time for reading a page (config: page_max_seconds)
+    """
+    def __init__(self,
+                 path = PAGE_CACHE_PATH,
+                 ttl = None,
+                 error_ttl = None,
+                 retry_ttl = None,
+                 max_size = None,
+                 timeout = None,
+                 max_bytes = None,
+                 max_seconds = None):
+        path = os.path.expanduser(path)
+        self.body_path = os.path.join(path, "bodies")
+        os.makedirs(self.body_path, exist_ok=True)
+        self.ttl = ttl if ttl != None else get_setting('page_cache_ttl', 7*86400)
+        self.error_ttl = error_ttl if error_ttl != None else get_setting('page_cache_error_ttl', 86400)
+        self.retry_ttl = retry_ttl if retry_ttl != None else get_setting('page_cache_retry_ttl', 600)
+        self.max_size = max_size if max_size != None else get_setting('page_cache_max_size', 500*1024*1024)
+        if timeout == None:
+            timeout = (get_setting('page_connect_timeout', 5), get_setting('page_read_timeout', 15))
+        self.timeout = timeout
+        self.max_bytes = max_bytes if max_bytes != None else get_setting('page_max_bytes', 2*1024*1024)
+        self.max_seconds = max_seconds if max_seconds != None else get_setting('page_max_seconds', 30)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        # Caches from before permanent and transient failures were told apart
+        if 'permanent' not in [r[1] for r in self.db.execute("PRAGMA table_info(pages)")]:
+            self.db.execute("ALTER TABLE pages ADD COLUMN permanent INTEGER")
+        self.db.commit()
+
+    ########## Index and bodies ##########
+
+    def _get_entry(self, url):
+        with self.lock:
+            row = self.db.execute(f"SELECT {','.join(COLUMNS)} FROM pages WHERE url = ?",
+                                  (url,)).fetchone()
+        if row == None:
+            return None
+        return dict(zip(COLUMNS, row))
+
+    def _put_entry(self, entry):
+        entry['accessed_at'] = time.time()
+        with self.lock:
+            self.db.execute(f"INSERT OR REPLACE INTO pages VALUES ({','.join('?' * len(COLUMNS))})",
+                            [entry.get(c) for c in COLUMNS])
+            self.db.commit()
+
+    def _touch(self, url):
+        with self.lock:
+            self.db.execute("UPDATE pages SET accessed_at = ? WHERE url = ?", (time.time(), url))
+            self.db.commit()
+
+    def _body_file(self, body_hash):
+        return os.path.join(self.body_path, body_hash[:2], body_hash)
+
+    def _write_body(self, body):
+        body_hash = hashlib.sha256(body).hexdigest()
+        f = self._body_file(body_hash)
+        if not os.path.exists(f):
+            os.makedirs(os.path.dirname(f), exist_ok=True)
+            # Write to a temp file first, so a crash does not leave half a page
+            with open(f + ".tmp", 'wb') as out:
+                out.write(body)
+            os.replace(f + ".tmp", f)
+        return body_hash
+
+    def _read_body(self, body_hash):
+        try:
+            with open(self._body_file(body_hash), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    ########## Fetching ##########
+
+    # One streaming GET; falls back to no certificate verification on SSL errors.
+    # Returns (response, insecure) - or raises RequestException. The body
+    # has not been read yet; use _read_content().
+    def _download(self, url, headers, insecure, silent):
+        if not insecure:
+            try:
+                return requests.get(url, headers=headers, timeout=self.timeout, stream=True), False
+            except SSLError:
+                if not silent:
+                    print(f"WARNING: Invalid certificate for {url}")
+        # Bad certificate? Then try again without verification
+        logging.captureWarnings(True)
+        logging.getLogger("urllib3").setLevel(logging.ERROR)
+        try:
+            return requests.get(url, headers=headers, timeout=self.timeout, stream=True, verify=False), True
+        finally:
+            logging.captureWarnings(False)
+
+    # Read the body of a streamed response up to max_bytes / max_seconds.
+    # Returns (body, reason): reason is None if the page is to be used, 
+    # otherwise why it was skipped (not HTML). Closes the response.
+    def _read_content(self, response):
+        content_type = response.headers.get('Content-Type', "").split(';')[0].strip().lower()
+        try:
+            if content_type != "" and content_type not in TEXT_TYPES:
+                return None, f"Skipped: {content_type}"
+            deadline = time.monotonic() + self.max_seconds
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(chunk_size = 8192):
+                if size == 0 and any(chunk.startswith(m) for m in BINARY_MAGIC):
+                    return None, "Skipped: binary content"
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= self.max_bytes or time.monotonic() > deadline:
+                    # Keep what we have
+                    break
+            return b"".join(chunks)[:self.max_bytes], None
+        finally:
+            response.close()
+
+    # Encoding from the Content-Type header, else from a <meta charset>, else UTF-8
+    def _encoding(self, response, body):
+        if 'charset' in response.headers.get('Content-Type', "").lower():
+            return response.encoding
+        m = META_CHARSET_RE.search(body[:4096])
+        if m != None:
+            return m.group(1).decode('ascii')
+        return 'utf-8'
+
+    # A failure that may go away: worth another try soon
+    def _transient(self, entry):
+        return entry['status'] != 200 and not entry.get('permanent')
+
+    def _page(self, entry, from_cache):
+        body = self._read_body(entry['body_hash']) if entry.get('body_hash') else None
+        text = ""
+        if body != None:
+            try:
+                text = body.decode(entry.get('encoding') or 'utf-8', errors='replace')
+            except LookupError:
+                # Unknown encoding in the page
+                text = body.decode('utf-8', errors='replace')
+        return {
+            'url': entry['url'],
+            'status': entry['status'],
+            'error': entry.get('error'),
+            'headers': json.loads(entry.get('headers') or "{}"),
+            'text': text,
+            'insecure': bool(entry.get('insecure')),
+            'transient': self._transient(entry),
+            'from_cache': from_cache,
+        }
+
+    # Return the page at url as a dict with
+    # - 'status' (HTTP status code, None if the page could not be fetched at all)
+    # - 'error' (message if not fetched, or why it was skipped), 'text', 'headers',
+    # - 'insecure' (read without certificate verification), 'from_cache'
+    # - 'transient' (failed, but may work later: timeout, server error...)
+    def fetch(self, url, silent = False):
+        entry = self._get_entry(url)
+        now = time.time()
+        if entry != None:
+            age = now - entry['fetched_at']
+            failed = entry['status'] != 200
+            if failed:
+                ttl = self.retry_ttl if self._transient(entry) else self.error_ttl
+            else:
+                ttl = self.ttl
+            if age < ttl:
+                # A cached page whose body was evicted is treated as missing
+                # (pages without a body were skipped, e.g. PDFs)
+                if failed or entry['body_hash'] == None \
+                    or os.path.exists(self._body_file(entry['body_hash'])):
+                    self._touch(url)
+                    return self._page(entry, True)
+        # Conditional GET if we have a page to fall back on
+        headers = {}
+        insecure = False
+        if entry != None:
+            insecure = bool(entry['insecure'])
+            if entry['status'] == 200 and entry['body_hash'] != None:
+                if entry['etag']:
+                    headers['If-None-Match'] = entry['etag']
+                if entry['last_modified']:
+                    headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            response, insecure = self._download(url, headers, insecure, silent)
+        except requests.exceptions.RequestException as e:
+            if not silent:
+                print(f"Failed to fetch the webpage. {e}")
+            entry = {'url': url, 'status': None, 'error': str(e), 'fetched_at': now,
+                     'insecure': int(insecure), 'permanent': int(host_unknown(e))}
+            self._put_entry(entry)
+            return self._page(entry, False)
+        if response.status_code == 304 and headers != {} \
+            and os.path.exists(self._body_file(entry['body_hash'])):
+            response.close()
+            entry['fetched_at'] = now
+            self._put_entry(entry)
+            return self._page(entry, True)
+        body = None
+        skipped = None
+        if response.status_code == 200:
+            try:
+                body, skipped = self._read_content(response)
+            except requests.exceptions.RequestException as e:
+                if not silent:
+                    print(f"Failed to read the webpage. {e}")
+                entry = {'url': url, 'status': None, 'error': str(e), 'fetched_at': now,
+                         'insecure': int(insecure)}
+                self._put_entry(entry)
+                return self._page(entry, False)
+        else:
+            response.close()
+        entry = {
+            'url': url,
+            'status': response.status_code,
+            'error': skipped if response.status_code == 200 else f"Status code: {response.status_code}",
+            'headers': json.dumps(dict(response.headers)),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'insecure': int(insecure),
+            'fetched_at': now,
+            'permanent': int(response.status_code in PERMANENT_STATUS),
+        }
+        if body != None:
+            entry['encoding'] = self._encoding(response, body)
+            entry['body_hash'] = self._write_body(body)
+            entry['size'] = len(body)
+        self._put_entry(entry)
+        if body != None:
+            self.evict()
+        return self._page(entry, False)
+
+    ########## Eviction ##########
+
+    def total_size(self):
+        with self.lock:
+            return self.db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT body_hash, size FROM pages WHERE body_hash IS NOT NULL)"
+            ).fetchone()[0]
+
+    # Remove least recently used pages until the bodies fit into max_size
+    def evict(self):
+        total = self.total_size()
+        if total <= self.max_size:
+            return 0
+        n = 0
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT url, body_hash, size FROM pages WHERE body_hash IS NOT NULL ORDER BY accessed_at"
+            ).fetchall()
+        for url, body_hash, size in rows:
+            if total <= self.max_size:
+                break
+            with self.lock:
+                self.db.execute("DELETE FROM pages WHERE url = ?", (url,))
+                still_used = self.db.execute("SELECT 1 FROM pages WHERE body_hash = ?",
+                                             (body_hash,)).fetchone()
+                self.db.commit()
+            if still_used == None:
+                try:
+                    os.remove(self._body_file(body_hash))
+                except OSError:
+                    pass
+                total -= size or 0
+            n += 1
+        return n
+
+    def close(self):
+        self.db.close()
+
+# Shared cache, opened on first use
+page_cache = None
+page_cache_lock = threading.Lock()
+
+def get_page_cache():
+    global page_cache
+    with page_cache_lock:
+        if page_cache == None:
+            page_cache = PageCache()
+        return page_cache
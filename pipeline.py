@@ -0,0 +1,126 @@
+# pipeline.py
+#
+# A small staged producer/consumer pipeline on threads.
+#
+# Each stage has its own number of workers and reads from a bounded queue
+# that is filled by the stage before it. If a stage is slow (say, the LLM),
+# the queue in front of it fills up, and the stages before it block -
+# so memory stays bounded while the fast stages keep working ahead.
+#
+#   pipe = Pipeline(queue_size=100)
+#   pipe.add_stage("dump", dump_page, fan_out=True)   # page -> single items
+#   pipe.add_stage("llm", enrich, workers=2)
+#   pipe.add_stage("nc", write_nc, workers=8)
+#   stats = pipe.run(pages)
+
+import queue
+import threading
+
+from config import *
+
+# End-of-stream marker passed down the queues
+STOP = object()
+
+class Stage:
+    """
+    One step of the pipeline.
+
+    - func(item) returns the item to pass on, or None to drop it.
+      With fan_out=True, it returns a list of items to pass on one by one.
+    - workers: number of threads running func
+    - finish(): optional, called once after the last item has been processed;
+      may return a list of items to pass on (e.g. a flushed batch)
+    """
+    def __init__(self, name, func, workers = 1, fan_out = False, finish = None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.fan_out = fan_out
+        self.finish = finish
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.running = workers
+        self.lock = threading.Lock()
+
+class Pipeline:
+    def __init__(self, queue_size = None):
+        if queue_size == None:
+            queue_size = get_setting('pipeline_queue_size', 100)
+        self.queue_size = queue_size
+        self.stages = []
+
+    def add_stage(self, name, func, workers = 1, fan_out = False, finish = None):
+        self.stages.append(Stage(name, func, workers, fan_out, finish))
+        return self
+
+    def _put(self, stage, out_q, result):
+        if result == None:
+            with stage.lock:
+                stage.dropped += 1
+            return
+        for r in (result if stage.fan_out else [result]):
+            if out_q != None:
+                out_q.put(r)
+
+    def _work(self, stage, in_q, out_q):
+        while True:
+            item = in_q.get()
+            if item is STOP:
+                # Let the sibling workers see it, too
+                in_q.put(STOP)
+                break
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                print(f"\nERROR in stage {stage.name}: {e}")
+                with stage.lock:
+                    stage.errors += 1
+                continue
+            with stage.lock:
+                stage.processed += 1
+            self._put(stage, out_q, result)
+        with stage.lock:
+            stage.running -= 1
+            last = stage.running == 0
+        if last:
+            # The last worker to leave finishes the stage and passes on the end marker
+            if stage.finish != None:
+                try:
+                    for r in stage.finish() or []:
+                        if out_q != None:
+                            out_q.put(r)
+                except Exception as e:
+                    print(f"\nERROR finishing stage {stage.name}: {e}")
+                    with stage.lock:
+                        stage.errors += 1
+            if out_q != None:
+                out_q.put(STOP)
+
+    def _feed(self, source, out_q):
+        try:
+            for item in source:
+                out_q.put(item)
+        except Exception as e:
+            print(f"\nERROR reading pipeline source: {e}")
+        finally:
+            out_q.put(STOP)
+
+    # Feed the items from source through all stages; blocks until done.
+    # Returns a dict with the number of processed/dropped/failed items per stage.
+    def run(self, source):
+        queues = [queue.Queue(maxsize = self.queue_size) for _ in self.stages]
+        threads = [threading.Thread(target = self._feed, args = (source, queues[0]), daemon = True)]
+        for i, stage in enumerate(self.stages):
+            out_q = queues[i+1] if i+1 < len(queues) else None
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(target = self._work,
+                                                args = (stage, queues[i], out_q),
+                                                daemon = True))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return {s.name: {'processed': s.processed,
+                         'dropped': s.dropped,
+                         'errors': s.errors} for s in self.stages}
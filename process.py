@@ -11,8 +11,16 @@ from requests.exceptions import SSLError
 
 import logging
 import warnings
+import threading
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import re
+import copy
  
 from config import *
+from page_cache import get_page_cache
+from llm_cache import LlmCache
+from llm_pool import get_llm_pool
+from embeddings import get_embedding_index
 
 def tag_process(s):
     # Take a comma-separated string, split into substrings, and 
@@ -38,6 +46,41 @@ def convert_to_dict(l):
     return sorted_d
 #
 
+# Query parameters that only track where a click came from
+TRACKING_PARAMS = ['fbclid', 'gclid', 'dclid', 'gbraid', 'wbraid', 'msclkid', 'yclid',
+                   'mc_cid', 'mc_eid', '_ga', '_gl', 'igshid', 'ref_src', 'ref_url',
+                   'cmpid', 's_cid', 'wt_mc', '_hsenc', '_hsmi', 'mkt_tok', 'spm',
+                   'oly_anon_id', 'oly_enc_id', 'vero_id', 'xtor']
+TRACKING_PREFIXES = ['utm_', 'pk_', 'mtm_', 'at_']
+# Bump when canonical_url changes, so stored canonical URLs are recomputed
+CANONICAL_URL_VERSION = 3
+
+# Normalize a URL so that trivial variants of the same address compare equal:
+# http and https, with or without "www.", default ports, trailing slash,
+# tracking parameters (utm_..., fbclid...), order of the query parameters,
+# and fragments (except for #! and #/ routes of single-page apps).
+def canonical_url(url):
+    u = urlsplit(str(url).strip())
+    scheme = u.scheme.lower()
+    if scheme not in ['http', 'https']:
+        return urlunsplit((scheme, u.netloc.lower(), u.path, u.query, u.fragment))
+    host = (u.hostname or "")
+    if host.startswith("www."):
+        host = host[4:]
+    try:
+        port = u.port
+    except ValueError:
+        # Not a number
+        port = None
+    if port != None and port not in [80, 443]:
+        host = f"{host}:{port}"
+    path = u.path.rstrip('/')
+    query = [(k, v) for k, v in parse_qsl(u.query, keep_blank_values=True)
+             if k.lower() not in TRACKING_PARAMS
+             and not any(k.lower().startswith(p) for p in TRACKING_PREFIXES)]
+    fragment = u.fragment if u.fragment[:1] in ['!', '/'] else ''
+    return urlunsplit(('https', host, path, urlencode(sorted(query)), fragment))
+
 def better_desc(d1,d2):
     # Pick the "better" of two descriptions - if one of them is empty, return the other, 
     # if both are non-empty, compare, if not identical, merge. 
@@ -102,94 +145,259 @@ def refactor_diigo_bookmark(url,
     }
     return d
 
-def suggest_description(url,description = "", silent = False):
-    # Tries to read the webpage at url, return None if not reachable,
-    # or a LLM-created description of the page. 
-    # Fetch the webpage content
-    try:
-        response = requests.get(url)
-    except SSLError as e:
-        # Bad certificate? Then try again without verification
-        # Set up logging
-        logging.captureWarnings(True)
-        logging.getLogger("urllib3").setLevel(logging.ERROR)
-        if not silent:
-            print(f"WARNING: Invalid certificate for {url}")
+# Shared LLM answer cache. When it is first opened, answers from other 
+# models or to other prompts are purged.
+llm_cache = None
+llm_cache_lock = threading.Lock()
+
+def get_llm_cache():
+    global llm_cache
+    with llm_cache_lock:
+        if llm_cache == None:
+            llm_cache = LlmCache()
+            llm_cache.invalidate(config['ollama']['model'], [summarize_prompt, summarize_chunk_prompt])
+        return llm_cache
+
+# Ask the LLM via ollama - unless the same question has been asked before.
+# The request goes to the least busy Ollama server (see llm_pool.py).
+# Raises ollama.ResponseError if the LLM cannot be queried.
+def llm_chat(messages, options = {}):
+    model = config['ollama']['model']
+    cache = get_llm_cache()
+    key = cache.key(model, messages, options)
+    answer = cache.get(key)
+    if answer != None:
+        return answer
+    answer = get_llm_pool().chat(model=model, 
+                                 messages=messages,
+                                 options=options)
+    cache.put(key, answer, model, messages[0]['content'])
+    return answer
+
+# HTML parser for BeautifulSoup (config: html_parser): 'lxml' is several
+# times faster than Python's own 'html.parser', which is the fallback if
+# lxml is not installed
+def get_html_parser():
+    parser = get_setting('html_parser', 'lxml')
+    if parser == 'lxml':
         try:
-            response = requests.get(url,verify=False)
-        except: 
-            if not silent:
-                print("Error: Could not read {url} even without verification")
-            return
-        logging.captureWarnings(False)
-    except requests.exceptions.RequestException as e:
-        if not silent:
-            print(f"Failed to fetch the webpage. {e}")
+            import lxml
+        except ImportError:
+            parser = 'html.parser'
+    return parser
+
+# Tags that never contain the content of a page
+NON_TEXT_TAGS = ['script', 'style', 'noscript', 'template', 'iframe', 'svg', 'canvas',
+                 'button', 'select']
+# ...tags that usually hold navigation and the like (though some pages wrap
+# everything in a <form> or a <header>)...
+BOILERPLATE_TAGS = NON_TEXT_TAGS + ['nav', 'header', 'footer', 'aside', 'form']
+# ...and ids/classes that usually mark cookie banners, menus, sharing buttons etc.
+# Only whole words of a class or id count ("main-nav", not "unavailable").
+BOILERPLATE_RE = re.compile(r'(?<![a-z0-9])(cookies?|consent|gdpr|banner|newsletter|subscribe|'
+                            r'popup|modal|nav|navbar|navigation|menu|breadcrumbs?|sidebar|'
+                            r'footer|header|share|sharing|social|comments?|related|'
+                            r'advert|ads?|promo|sponsor(ed)?)(?![a-z0-9])', re.IGNORECASE)
+# A block holding more than this share of the text is no boilerplate,
+# whatever its class says ("layout-with-sidebar", "post has-comments")
+BOILERPLATE_MAX_SHARE = 0.3
+# Less text than this after the clean-up: something went wrong, use the whole page
+MIN_CONTENT_CHARS = 200
+
+# Lines of the text of a tag, with normalized whitespace, empty ones dropped
+def text_lines(tag):
+    lines = [" ".join(l.split()) for l in tag.get_text(separator="\n").splitlines()]
+    return "\n".join(l for l in lines if l != "")
+
+def text_length(tag):
+    return len("".join(tag.get_text().split()))
+
+# Strip a parsed page down to its main text, with normalized whitespace:
+# no scripts, navigation, cookie banners, footers... If the page marks its
+# main content (<main>, <article>, role="main"), only that is used, and only
+# cleaned up inside. Only small blocks are removed - never one that holds
+# much of the text, like a page wrapper with a class "layout-header-fixed".
+# If (almost) nothing is left, falls back to the text of the whole page as
+# parsed, without scripts and styles. Changes soup.
+def extract_main_content(soup):
+    original = copy.copy(soup)
+    main = soup.find('main') or soup.find('article') or soup.find(attrs={'role': 'main'})
+    if main == None:
+        main = soup.body if soup.body != None else soup
+    for tag in main(NON_TEXT_TAGS):
+        tag.decompose()
+    limit = BOILERPLATE_MAX_SHARE * text_length(main)
+    for tag in main.find_all(True):
+        if tag.decomposed or tag.name in ['main', 'article']:
+            continue
+        attrs = tag.attrs or {}
+        marker = " ".join([attrs.get('id') or ""] + list(attrs.get('class') or []))
+        if tag.name in BOILERPLATE_TAGS or (marker.strip() != "" and BOILERPLATE_RE.search(marker)):
+            if text_length(tag) <= limit:
+                tag.decompose()
+    text = text_lines(main)
+    if len(text) < MIN_CONTENT_CHARS:
+        for tag in original(NON_TEXT_TAGS):
+            tag.decompose()
+        page = text_lines(original.body if original.body != None else original)
+        if len(page) > len(text):
+            text = page
+    return text
+
+# Rough token count: about 4 characters per token for European languages
+# (config: llm_chars_per_token)
+def estimate_tokens(text):
+    return len(text) // get_setting('llm_chars_per_token', 4) + 1
+
+# Split text into parts of at most max_tokens, at line breaks where possible
+def split_text(text, max_tokens):
+    max_chars = max_tokens * get_setting('llm_chars_per_token', 4)
+    chunks = []
+    chunk = ""
+    for line in text.splitlines():
+        while len(line) > max_chars:
+            # A single huge line - cut it
+            if chunk != "":
+                chunks.append(chunk)
+                chunk = ""
+            chunks.append(line[:max_chars])
+            line = line[max_chars:]
+        if len(chunk) + len(line) + 1 > max_chars:
+            chunks.append(chunk)
+            chunk = ""
+        chunk = f"{chunk}\n{line}" if chunk != "" else line
+    if chunk != "":
+        chunks.append(chunk)
+    return chunks
+
+def summary_messages(prompt, url, title, description, content):
+    summary_string = f"""
+        URL: {url}
+        TITLE: {title}
+        {f"DESCRIPTION: {description}" if description != "" else ""}
+        PAGE CONTENT: 
+        {content}
+        """
+    return [{
+        'role': 'system',
+        'content': prompt
+    },
+    {
+        'role': 'user',
+        'content': summary_string
+    }]
+
+# Have the LLM summarize the page content with the smallest prompt that 
+# still covers it. Content within the token budget (config: llm_token_budget)
+# goes in one prompt; longer content is cut into parts which are 
+# summarized one by one, then the summary is made from those (map-reduce).
+# Only the first llm_max_chunks parts are used.
+def summarize_content(url, title, description, content):
+    budget = get_setting('llm_token_budget', 3000)
+    options = {'temperature':0.3}
+    if estimate_tokens(content) <= budget:
+        return llm_chat(summary_messages(summarize_prompt, url, title, description, content),
+                        options)
+    chunks = split_text(content, budget)[:get_setting('llm_max_chunks', 4)]
+    partials = [llm_chat(summary_messages(summarize_chunk_prompt, url, title, "", c), options)
+                for c in chunks]
+    return llm_chat(summary_messages(summarize_prompt, url, title, description, 
+                                     "\n\n".join(partials)),
+                    options)
+
+def read_page(url, silent = False):
+    # Fetch the webpage at url (from the local cache if we have read it before)
+    # and extract its title and main text. 
+    # Returns None if it is not reachable for good (404, 410, unknown host), 
+    # otherwise a dict with 
+    # - title, content
+    # - skipped: True if it is not a web page (PDFs, images...)
+    # Raises ConnectionError if it cannot be read for now (timeout, server 
+    # error...) - so it is tried again later instead of being given up.
+    page = get_page_cache().fetch(url, silent = silent)
+    if page['status'] != 200 and page['transient']:
+        raise ConnectionError(f"Could not read {url} for now: {page['error']}")
+    if page['status'] == None:
+        # Could not be fetched at all; already reported
         return
-    if response.status_code == 200:
+    if page['status'] == 200 and page['error'] != None:
+        # Skipped while downloading
+        if not silent:
+            print(f"Not summarizing {url}: {page['error']}")
+        return {'title': "", 'content': "", 'skipped': True}
+    if page['status'] == 200:
         # Parse the HTML content
-        soup = BeautifulSoup(response.text, 'html.parser')
+        soup = BeautifulSoup(page['text'], get_html_parser())
         # Extract the main text content
         title = soup.find('title')
         if title != None:
-            title = str(title)
+            title = title.get_text().strip()
         else:
             title = ""
-        main_content = soup.get_text()
-                
-        # Generate a summary using the Gemma2 model
-        sys_p = summarize_prompt
-        summary_string = f"""
-        URL: {url}
-        TITLE: {title}
-        {"DESCRIPTION",description if description != "" else ""}
-        PAGE CONTENT: 
-        {main_content}
-        """
-        messages = [{
-            'role': 'system',
-            'content': sys_p
-        },
-        {
-            'role': 'user',
-            'content': summary_string
-        }]
-        options = {'temperature':0.3}
-        try:
-            llm_response = ollama.chat(model=config['ollama']['model'], 
-                                       messages=messages,
-                                       options=options)
-            return llm_response['message']['content']
-        except ollama.ResponseError as e:
-            if not silent: 
-                print(f"Could not query LLM via ollama: {e.error}")
-            return ""
+        return {'title': title, 'content': extract_main_content(soup), 'skipped': False}
     else:
         if not silent:
-            print(f"Failed to fetch the webpage. Status code: {response.status_code}")
+            print(f"Failed to fetch the webpage. Status code: {page['status']}")
         return None
-     #
 
-def suggest_tags(bookmark):
-    # Get LLM assessment of bookmarks for this bookmark.
+def suggest_description(url,description = "", silent = False):
+    # Tries to read the webpage at url, return None if not reachable,
+    # "" if it is not a web page (PDFs, images...), 
+    # or a LLM-created description of the page. 
+    # Raises ConnectionError if the page cannot be read for now (see read_page),
+    # ollama.ResponseError (or a connection error) if the LLM cannot be queried -
+    # there is no description yet, and it is worth trying again later.
+    page = read_page(url, silent = silent)
+    if page == None:
+        return
+    if page['skipped']:
+        return ""
+    # Generate a summary using the Gemma2 model
+    return summarize_content(url, page['title'], description, page['content'])
+
+def suggest_tags(bookmark, k = 10, n = 5):
+    # Suggest tags for this bookmark from the tags of the k most similar 
+    # bookmarks (by embedding, see embeddings.py) - no chat with the LLM.
     # bookmark is a dict containing: 
-    # - url
+    # - id (if it is in Nextcloud already)
     # - title
     # - description (including LLM summary)
     # - tags (existing tags)
-    return
-
-def write_bookmarks_file(bookmarks_dict, lastdate):
-    # Where do I get lastdate, the date of the last bookmark?
-    # Haven't properly thought this through yet. 
-    export_dict = {
-        'lastdate': lastdate,
-        'data': bookmarks_dict
-    }
-    with open(tags_path, 'w') as f:
-        json.dump(export_dict, f)
-    
+    # Returns a list of up to n new tags, best first; [] if the 
+    # embedding model cannot be queried.
+    try:
+        return get_embedding_index().suggest(bookmark, k, n)
+    except ollama.ResponseError as e:
+        print(f"Could not query embedding model via ollama: {e.error}")
+        return []
+
 if __name__ == "__main__":
+    # Imported here: nc_mirror itself imports this module
+    from nc_mirror import get_nc_mirror
+    from nc_bookmarks_api import bulk_edit_nc_bookmarks
     print("AI-based improvement of tags")
-    print("Not implemented yet. Sorry. ^_^")
-    input("Press ENTER to return to menu")
\ No newline at end of file
+    mirror = get_nc_mirror(max_age = 0)
+    bookmarks = list(mirror.iter_bookmarks())
+    print(f"Embedding new and changed bookmarks (of {len(bookmarks)})...")
+    index = get_embedding_index()
+    index.update(bookmarks)
+    # Suggest tags for the bookmarks that have none
+    untagged = [b for b in bookmarks if b['tags'] == []]
+    changed = []
+    for b in untagged:
+        tags = suggest_tags(b)
+        if tags != []:
+            if len(changed) < 20:
+                print(f"{b['title'][:60]}: {', '.join(tags)}")
+            b = dict(b)
+            b['tags'] = tags[:3]
+            changed.append(b)
+    if len(changed) > 20:
+        print(f"...and {len(changed) - 20} more")
+    if len(changed) > 0 and input(f"Add the first three suggested tags to {len(changed)} untagged bookmarks? (y/N) ").lower() == 'y':
+        result = bulk_edit_nc_bookmarks(changed)
+        for b, id in zip(changed, result['ids']):
+            if id != None:
+                mirror.upsert(b)
+    mirror.close()
+    input("Press ENTER to return to menu")
@@ -0,0 +1,234 @@
+# rate_limit.py
+#
+# Shared rate limiting for all API calls to Diigo and Nextcloud.
+#
+# Every endpoint (or group of endpoints with a common limit) gets its own
+# RateLimiter, which combines:
+# - a token bucket, so calls are spread out at the current rate
+# - AIMD adjustment: every success raises the rate a little (additive increase),
+#   every 429/5xx (and, for Diigo, its "overloaded" 400) halves it
+#   (multiplicative decrease) - so we settle just below what the server takes
+# - retries with jittered exponential backoff, honouring Retry-After
+# - a circuit breaker: after too many failures in a row, all calls to the
+#   endpoint pause for a cooldown period instead of hammering the server;
+#   after that, a single call (the probe) decides whether to go on or to
+#   pause again
+# Calls that must not be repeated (a POST creating a bookmark) are not retried
+# after a read timeout: the server may have done it without us hearing back.
+#
+# Use it like this:
+#   response = get_limiter('diigo_delete').call(requests.delete, url, params=...)
+
+import random
+import threading
+import time
+
+import requests
+import urllib3
+
+from config import *
+
+# Defaults per endpoint. Can be overridden in config.yaml, e.g.
+#   rate_limits:
+#     diigo_delete:
+#       rate: 0.2
+LIMITER_DEFAULTS = {
+    # Nextcloud takes a lot; only back off if it complains
+    'nextcloud': {'rate': 50, 'burst': 20},
+    # Official Diigo API: a couple of dozen calls per ten minutes,
+    # answers with a 400 when it has had enough
+    'diigo_api': {'rate': 0.5, 'max_rate': 2, 'min_rate': 1/120,
+                  'increase': 0.02, 'extra_retry_status': [400]},
+    'diigo_delete': {'rate': 0.5, 'max_rate': 2, 'min_rate': 1/300,
+                     'increase': 0.02, 'extra_retry_status': [400]},
+    # Interaction API, as used by the Diigo website
+    'dia': {'rate': 2, 'max_rate': 5, 'min_rate': 1/60, 'increase': 0.05},
+}
+
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+# HTTP methods that may be sent twice without doing twice
+IDEMPOTENT_METHODS = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE']
+
+class RateLimiter:
+    """
+    Token bucket with AIMD rate adjustment, retries and a circuit breaker,
+    for one endpoint. Thread-safe; share one instance per endpoint.
+
+    - rate: calls per second to start with; max_rate/min_rate: limits for AIMD
+    - burst: number of calls that may go out at once after a pause
+    - increase: added to the rate after each success; decrease: factor on failure
+    - max_retries: retries for a call before the failed response is returned
+    - backoff_base, backoff_max: exponential backoff in seconds (with full jitter)
+    - failure_threshold, cooldown: open the circuit for cooldown seconds
+      after this many failures in a row; then one call goes through as a
+      probe - if it fails, the circuit opens again
+    - extra_retry_status: status codes to treat as "slow down" in addition to
+      429 and 5xx
+    """
+    def __init__(self,
+                 name,
+                 rate = 1.0,
+                 max_rate = None,
+                 min_rate = 0.01,
+                 burst = 1,
+                 increase = 0.1,
+                 decrease = 0.5,
+                 max_retries = 5,
+                 backoff_base = 1.0,
+                 backoff_max = 300,
+                 failure_threshold = 5,
+                 cooldown = 300,
+                 extra_retry_status = []):
+        self.name = name
+        self.rate = rate
+        self.max_rate = max_rate if max_rate != None else rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.retry_status = set(RETRY_STATUS + list(extra_retry_status))
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.failures = 0
+        self.open_until = 0
+        # After a cooldown, the circuit is half open: the next call is the
+        # probe (the thread making it), the others wait for its result
+        self.half_open = False
+        self.probe = None
+        self.lock = threading.Lock()
+        self.closed = threading.Condition(self.lock)
+
+    # Wait until the circuit is closed (or it is our turn to probe) and a
+    # token is available
+    def acquire(self):
+        with self.closed:
+            while True:
+                now = time.monotonic()
+                if self.open_until > now:
+                    self.closed.wait(self.open_until - now)
+                elif self.probe != None:
+                    self.closed.wait()
+                else:
+                    break
+            if self.half_open:
+                self.probe = threading.get_ident()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Take the token now (possibly going into debt), and sleep it off
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def _probing(self):
+        return self.probe != None and self.probe == threading.get_ident()
+
+    def success(self):
+        with self.closed:
+            self.failures = 0
+            self.rate = min(self.max_rate, self.rate + self.increase)
+            if self._probing():
+                self.half_open = False
+                self.probe = None
+                self.closed.notify_all()
+
+    def failure(self, retry_after = None):
+        with self.closed:
+            self.failures += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            if self._probing() or self.failures >= self.failure_threshold:
+                cooldown = self.cooldown
+                if retry_after != None:
+                    cooldown = max(cooldown, retry_after)
+                if self._probing():
+                    print(f"\n{self.name}: still failing, pausing for {cooldown:.0f}s")
+                else:
+                    print(f"\n{self.name}: {self.failures} failures in a row, pausing for {cooldown:.0f}s")
+                self.open_until = time.monotonic() + cooldown
+                # Counting starts again; after the cooldown, one probe decides
+                self.failures = 0
+                self.half_open = True
+                self.probe = None
+                self.closed.notify_all()
+
+    # A probe that ended without a verdict (another error): let the next call probe
+    def release(self):
+        with self.closed:
+            if self._probing():
+                self.probe = None
+                self.closed.notify_all()
+
+    def backoff(self, attempt, retry_after = None):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after != None:
+            delay = max(delay, retry_after)
+        return delay
+
+    # Call func (which does one HTTP request and returns the response) at the
+    # permitted rate, retrying on "slow down" responses and connection errors.
+    # idempotent: False for requests that must not be sent twice (POST) - they
+    # are only retried if they never reached the server; after a read timeout
+    # or a broken connection, the exception is raised at once.
+    # Returns the last response; raises the last exception if every attempt failed
+    # with a connection error or timeout.
+    def call(self, func, *args, idempotent = True, **kwargs):
+        try:
+            for attempt in range(self.max_retries + 1):
+                last_attempt = attempt == self.max_retries
+                self.acquire()
+                try:
+                    response = func(*args, **kwargs)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    self.failure()
+                    if last_attempt or not (idempotent or never_sent(e)):
+                        raise
+                    time.sleep(self.backoff(attempt))
+                    continue
+                if response.status_code in self.retry_status:
+                    retry_after = get_retry_after(response)
+                    self.failure(retry_after)
+                    if last_attempt:
+                        return response
+                    time.sleep(self.backoff(attempt, retry_after))
+                    continue
+                self.success()
+                return response
+        finally:
+            self.release()
+
+# Did the request fail before it was sent (no connection to the server)?
+def never_sent(e):
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(reason, (urllib3.exceptions.NewConnectionError,
+                               urllib3.exceptions.ConnectTimeoutError))
+
+# Seconds to wait as requested by the server, None if not given
+def get_retry_after(response):
+    value = response.headers.get('Retry-After')
+    if value == None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        # HTTP date; not worth parsing
+        return None
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+# The shared limiter for this endpoint name, created on first use
+def get_limiter(name):
+    with limiters_lock:
+        if name not in limiters:
+            settings = dict(LIMITER_DEFAULTS.get(name, {}))
+            settings.update(get_setting('rate_limits', {}).get(name, {}))
+            limiters[name] = RateLimiter(name, **settings)
+        return limiters[name]
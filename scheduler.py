@@ -0,0 +1,167 @@
+# scheduler.py
+#
+# Priority scheduling for long jobs over the bookmarks (the LLM descriptions
+# in nc_llm_improve.py take days for a large collection): the most valuable
+# bookmarks are done first, so a partial run is worth the most it can be.
+#
+# A scoring function gives every bookmark a score and a tier (a name for
+# why it matters). The default one, PriorityScorer, adds up
+#   unread       the bookmark is in the UNREAD_FOLDER (LESEN)
+#   clicked      it has been opened (log of clickcount)
+#   recent       it was added recently (halving every recent_days)
+#   undescribed  it has no description of its own
+# weighted by llm_priority_weights. Any function b -> (score, tier) will do.
+#
+# The Scheduler hands out the bookmarks by score, highest first (a heap), and
+# estimates when each tier will be finished from the throughput so far.
+#
+#   scheduler = Scheduler(bookmarks, PriorityScorer(unread_folder), rate = 0.2)
+#   scheduler.print_eta()
+#   for b in scheduler: ... scheduler.done()
+
+import math
+import time
+import heapq
+import itertools
+import threading
+
+from config import *
+
+TIERS = ['unread', 'clicked', 'recent', 'undescribed', 'other']
+
+# The description the user wrote, without what the importer and the LLM added
+def own_description(b):
+    description = str(b.get('description', ""))
+    for heading in ["# BOOKMARKED", "# LLM_DESCRIPTION", "# ANNOTATIONS"]:
+        description = description.split(heading)[0]
+    return description.strip()
+
+class PriorityScorer:
+    """
+    Default scoring function: b -> (score, tier).
+
+    - unread_folder: ID of the UNREAD_FOLDER, None to ignore it
+    - weights: dict with 'unread', 'clicked', 'recent', 'undescribed'
+      (config: llm_priority_weights)
+    - recent_days: the recency bonus halves every so many days
+      (config: llm_priority_recent_days)
+    """
+    def __init__(self, unread_folder = None, weights = None, recent_days = None):
+        self.unread_folder = unread_folder
+        self.weights = {'unread': 100, 'clicked': 10, 'recent': 20, 'undescribed': 5}
+        self.weights.update(weights or get_setting('llm_priority_weights', {}))
+        self.recent_days = recent_days or get_setting('llm_priority_recent_days', 30)
+        self.now = time.time()
+
+    def __call__(self, b):
+        unread = self.unread_folder != None and self.unread_folder in b.get('folders', [])
+        clicks = b.get('clickcount') or 0
+        added = b.get('added')
+        age_days = (self.now - added) / 86400 if added else math.inf
+        undescribed = own_description(b) == ""
+        score = (self.weights['unread'] * unread
+                 + self.weights['clicked'] * math.log2(1 + clicks)
+                 + self.weights['recent'] * 0.5 ** (max(age_days, 0) / self.recent_days)
+                 + self.weights['undescribed'] * undescribed)
+        if unread:
+            tier = 'unread'
+        elif clicks > 0:
+            tier = 'clicked'
+        elif age_days <= self.recent_days:
+            tier = 'recent'
+        elif undescribed:
+            tier = 'undescribed'
+        else:
+            tier = 'other'
+        return score, tier
+
+# "2d 3h", "4h 10m", "12m"
+def format_duration(seconds):
+    minutes = int(seconds // 60)
+    days, minutes = divmod(minutes, 1440)
+    hours, minutes = divmod(minutes, 60)
+    if days > 0:
+        return f"{days}d {hours}h"
+    if hours > 0:
+        return f"{hours}h {minutes}m"
+    return f"{minutes}m"
+
+class Scheduler:
+    """
+    Hands out bookmarks by priority, highest score first; thread-safe.
+
+    - bookmarks: iterable of bookmark dicts
+    - score: function b -> (score, tier), default PriorityScorer()
+    - rate: expected bookmarks per second until there is a measurement
+      (e.g. from the last run), None if unknown
+    """
+    def __init__(self, bookmarks, score = None, rate = None):
+        self.score = score or PriorityScorer()
+        self.lock = threading.Lock()
+        self.heap = []
+        self.tiers = {}
+        # Keeps equal scores in the order given, and the dicts out of the comparison
+        self.sequence = itertools.count()
+        for b in bookmarks:
+            s, tier = self.score(b)
+            self.tiers[b['id']] = tier
+            self.heap.append((-s, next(self.sequence), b))
+        heapq.heapify(self.heap)
+        self.expected_rate = rate
+        self.start = time.monotonic()
+        self.finished = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            if not self.heap:
+                raise StopIteration
+            return heapq.heappop(self.heap)[2]
+
+    def push(self, b):
+        s, tier = self.score(b)
+        with self.lock:
+            self.tiers[b['id']] = tier
+            heapq.heappush(self.heap, (-s, next(self.sequence), b))
+
+    # A bookmark is finished (whatever the result): counts for the throughput
+    def done(self):
+        with self.lock:
+            self.finished += 1
+
+    # Bookmarks per second: measured once a few are finished, expected before
+    def rate(self):
+        seconds = time.monotonic() - self.start
+        if self.finished >= 10 and seconds > 0:
+            return self.finished / seconds
+        return self.expected_rate
+
+    # Dict tier -> {'count': bookmarks left, 'eta': seconds until the last
+    # one is finished (None if the rate is unknown)}. A tier is finished when
+    # its lowest-scored bookmark is - which is why the tiers overlap.
+    def eta(self):
+        with self.lock:
+            order = sorted(self.heap)
+            tier_of = dict(self.tiers)
+        rate = self.rate()
+        result = {}
+        for position, (_, _, b) in enumerate(order):
+            tier = tier_of[b['id']]
+            entry = result.setdefault(tier, {'count': 0, 'eta': None})
+            entry['count'] += 1
+            if rate:
+                entry['eta'] = (position + 1) / rate
+        return {t: result[t] for t in TIERS + sorted(set(result) - set(TIERS)) if t in result}
+
+    def print_eta(self):
+        rate = self.rate()
+        for tier, e in self.eta().items():
+            eta = f" - done in {format_duration(e['eta'])}" if e['eta'] != None else ""
+            print(f"  {tier}: {e['count']} bookmarks{eta}")
+        if rate:
+            print(f"  ({rate * 3600:.0f} bookmarks per hour)")
@@ -0,0 +1,151 @@
+# tag_index.py
+#
+# Persistent index of the Nextcloud tags, kept in TAG_INDEX_PATH (tags.json).
+#
+# For every tag: how many bookmarks use it, when it was first and last seen,
+# and the IDs of those bookmarks. The index is kept up to date by the local
+# mirror (nc_mirror.py) - every bookmark that is written, changed or deleted
+# there updates the tags it had and has - so tag statistics and single-use
+# tags never need a rescan of all bookmarks.
+#
+# The file is written when the mirror is synced or closed, and after every
+# save_every changes. It carries the time of the save, which the mirror
+# remembers, too; if the two do not match (the program died in between),
+# the mirror rebuilds the index from its bookmarks.
+
+import os
+import json
+import time
+
+from config import *
+
+class TagIndex:
+    """
+    Tag -> {'count', 'first_seen', 'last_seen', 'ids'}, with first/last seen
+    as Unix times (the bookmark's 'added' / 'lastmodified' where known).
+    """
+    def __init__(self, path = TAG_INDEX_PATH, save_every = 100):
+        self.path = os.path.expanduser(path)
+        self.save_every = save_every
+        self.tags = {}
+        self.saved_at = None
+        self.changes = 0
+        self.sorted_counts = None
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            # Unreadable: start empty, the mirror will rebuild it
+            return
+        self.saved_at = data.get('saved_at')
+        self.tags = {t: {'count': e['count'],
+                         'first_seen': e['first_seen'],
+                         'last_seen': e['last_seen'],
+                         'ids': set(e['ids'])} for t, e in data.get('tags', {}).items()}
+
+    # Write the index (if it has changed); returns the time of the save,
+    # which is stored in the file as 'saved_at'
+    def save(self):
+        if self.changes == 0 and self.saved_at != None:
+            return self.saved_at
+        self.saved_at = time.time()
+        data = {'saved_at': self.saved_at,
+                'tags': {t: {'count': e['count'],
+                             'first_seen': e['first_seen'],
+                             'last_seen': e['last_seen'],
+                             'ids': sorted(e['ids'])} for t, e in self.tags.items()}}
+        directory = os.path.dirname(self.path)
+        if directory != "" and not os.path.exists(directory):
+            os.mkdir(directory)
+        # Write to a temp file first, so a crash does not leave half an index
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump(data, f, ensure_ascii = False)
+        os.replace(self.path + ".tmp", self.path)
+        self.changes = 0
+        return self.saved_at
+
+    def _changed(self):
+        self.sorted_counts = None
+        self.changes += 1
+
+    def clear(self):
+        self.tags = {}
+        self._changed()
+
+    def _add_tag(self, tag, id, added, modified):
+        e = self.tags.get(tag)
+        if e == None:
+            e = self.tags[tag] = {'count': 0, 'first_seen': added, 'last_seen': modified, 'ids': set()}
+        if id not in e['ids']:
+            e['ids'].add(id)
+            e['count'] += 1
+        e['first_seen'] = min(e['first_seen'], added)
+        e['last_seen'] = max(e['last_seen'], modified)
+
+    def _remove_tag(self, tag, id):
+        e = self.tags.get(tag)
+        if e == None or id not in e['ids']:
+            return
+        e['ids'].discard(id)
+        e['count'] -= 1
+        if e['count'] == 0:
+            del self.tags[tag]
+
+    # A bookmark was written: old_tags are the tags it had before ([] if new)
+    def update(self, b, old_tags = []):
+        now = time.time()
+        added = b.get('added') if b.get('added') != None else now
+        modified = b.get('lastmodified') if b.get('lastmodified') != None else now
+        new_tags = b.get('tags', [])
+        for t in old_tags:
+            if t not in new_tags:
+                self._remove_tag(t, b['id'])
+        for t in new_tags:
+            self._add_tag(t, b['id'], added, modified)
+        self._changed()
+
+    # A bookmark with these tags was deleted
+    def remove(self, id, tags):
+        for t in tags:
+            self._remove_tag(t, id)
+        self._changed()
+
+    # Save if save_every changes have piled up
+    def checkpoint(self):
+        if self.changes >= self.save_every:
+            return self.save()
+        return None
+
+    # Dict tag -> count, most frequent first (like convert_to_dict)
+    def counts(self):
+        if self.sorted_counts == None:
+            self.sorted_counts = dict(sorted(((t, e['count']) for t, e in self.tags.items()),
+                                             key = lambda x: x[1], reverse = True))
+        return self.sorted_counts
+
+    def get(self, tag):
+        return self.tags.get(tag)
+
+    # Tags used by only one bookmark
+    def unique_tags(self):
+        return [t for t, e in self.tags.items() if e['count'] == 1]
+
+    # IDs of the bookmarks whose tags are all single-use tags
+    def single_use_ids(self):
+        candidates = {}
+        for t, e in self.tags.items():
+            if e['count'] == 1:
+                id = next(iter(e['ids']))
+                candidates[id] = candidates.get(id, 0) + 1
+        # Compare with the number of tags the bookmark has
+        tag_count = {}
+        for e in self.tags.values():
+            for id in e['ids']:
+                if id in candidates:
+                    tag_count[id] = tag_count.get(id, 0) + 1
+        return sorted(id for id, n in candidates.items() if tag_count[id] == n)
@@ -0,0 +1,186 @@
+# tag_similarity.py
+#
+# Find tags that are probably the same tag, misspelt: "javascript", "javscript",
+# "java-script". Comparing each of ~15k tags with every other one would take
+# ~100 million edit distances, so candidates are found with a deletion index
+# instead (as in SymSpell): every tag is filed under all the strings you get
+# by deleting up to max_distance characters from it. Two tags within that
+# edit distance always share at least one such string, so only tags that
+# share one are compared - a few per tag instead of all of them.
+#
+# Similar tags are grouped into clusters around their most frequent member,
+# which becomes the tag the others are merged into (the merge plan).
+#
+#   counts = convert_to_dict(all_tags)
+#   clusters = cluster_tags(counts)
+#   plan = merge_plan(clusters)
+
+import os
+import re
+import json
+from collections import defaultdict
+
+from config import *
+
+# Within this distance, tags are treated as variants of each other -
+# short tags must match exactly (after normalization), or "cat" would be "car"
+def max_distance(tag):
+    if len(tag) < 4:
+        return 0
+    if len(tag) < 8:
+        return 1
+    return 2
+
+# Spelling-independent form of a tag: lowercase, no punctuation,
+# "-", "_" and "." as spaces, single spaces. "+" and "#" are kept:
+# "c++", "c#" and "c" are different languages.
+def normalize_tag(tag):
+    t = str(tag).lower().strip()
+    t = re.sub(r'[-_./]+', ' ', t)
+    t = re.sub(r'[^\w +#]+', '', t)
+    return " ".join(t.split())
+
+# All strings made by deleting up to d characters from s (including s)
+def deletes(s, d):
+    result = {s}
+    current = {s}
+    for _ in range(d):
+        current = {c[:i] + c[i+1:] for c in current for i in range(len(c))}
+        result |= current
+    return result
+
+# Edit distance, giving up (returning limit+1) as soon as it exceeds limit
+def levenshtein(a, b, limit = None):
+    if limit == None:
+        limit = max(len(a), len(b))
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1,
+                               current[j-1] + 1,
+                               previous[j-1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+def digits(s):
+    return re.sub(r'\D', '', s)
+
+def signs(s):
+    return re.sub(r'[^+#]', '', s)
+
+# Pairs of tags (a, b, distance) that are probably the same.
+# tags: iterable of tag strings.
+def similar_pairs(tags):
+    # Tags with the same normalized form are variants at distance 0
+    by_norm = defaultdict(list)
+    for t in tags:
+        by_norm[normalize_tag(t)].append(t)
+    pairs = []
+    for variants in by_norm.values():
+        for i, a in enumerate(variants):
+            for b in variants[i+1:]:
+                pairs.append((a, b, 0))
+    # Deletion index over the normalized forms
+    index = defaultdict(list)
+    for n in by_norm:
+        if n == "":
+            continue
+        for d in deletes(n, max_distance(n)):
+            index[d].append(n)
+    seen = set()
+    for candidates in index.values():
+        if len(candidates) < 2:
+            continue
+        for i, a in enumerate(candidates):
+            for b in candidates[i+1:]:
+                key = (a, b) if a < b else (b, a)
+                if key in seen:
+                    continue
+                seen.add(key)
+                # "covid19" and "covid20" are not typos of each other
+                if digits(a) != digits(b):
+                    continue
+                # Nor are "notepad++" and "notepad"
+                if signs(a) != signs(b):
+                    continue
+                limit = min(max_distance(a), max_distance(b))
+                dist = levenshtein(a, b, limit)
+                if dist <= limit:
+                    pairs += [(ta, tb, dist) for ta in by_norm[a] for tb in by_norm[b]]
+    return pairs
+
+# Group similar tags around the most frequent one.
+# tag_counts: dict tag -> frequency (as from convert_to_dict).
+# Returns a list of clusters, most frequent first, each a dict with
+#   'tag' (the most frequent member), 'count' (total of all members),
+#   'variants' (list of (tag, count, distance to 'tag')).
+# A tag is only added to a cluster if it is close to the cluster's tag itself,
+# so chains like cat-car-bar do not end up as one cluster.
+def cluster_tags(tag_counts):
+    neighbours = defaultdict(dict)
+    for a, b, d in similar_pairs(tag_counts.keys()):
+        neighbours[a][b] = d
+        neighbours[b][a] = d
+    clusters = []
+    assigned = set()
+    # Most frequent tags first: they become the heads of their clusters
+    for tag in sorted(neighbours, key = lambda t: (-tag_counts[t], t)):
+        if tag in assigned:
+            continue
+        variants = [(v, tag_counts[v], d) for v, d in neighbours[tag].items()
+                    if v not in assigned]
+        if variants == []:
+            continue
+        assigned.add(tag)
+        assigned |= {v for v, _, _ in variants}
+        variants.sort(key = lambda x: (-x[1], x[2], x[0]))
+        clusters.append({'tag': tag,
+                         'count': tag_counts[tag] + sum(c for _, c, _ in variants),
+                         'variants': variants})
+    clusters.sort(key = lambda c: (-c['count'], c['tag']))
+    return clusters
+
+# Merge plan from the clusters: a list of dicts
+#   {'from': variant, 'to': cluster tag, 'count': uses of the variant, 'distance': ...}
+# Variants used more often than max_share of the cluster tag are left out -
+# two frequent tags are more likely to be different words. That goes for
+# variants at distance 0, too: "C-Sharp" and "c sharp" may well be one tag,
+# but if both are in heavy use, the user gets to decide.
+def merge_plan(clusters, max_share = 0.5):
+    plan = []
+    for c in clusters:
+        head_count = c['count'] - sum(n for _, n, _ in c['variants'])
+        for v, n, d in c['variants']:
+            if n > max_share * head_count:
+                continue
+            plan.append({'from': v, 'to': c['tag'], 'count': n, 'distance': d})
+    return plan
+
+def write_merge_plan(plan, path = TAG_MERGE_PLAN_PATH):
+    path = os.path.expanduser(path)
+    with open(path, 'w') as f:
+        json.dump(plan, f, indent = 2, ensure_ascii = False)
+    return path
+
+# Apply a merge plan to bookmarks (dicts with a 'tags' list);
+# returns the list of bookmarks that changed, with their tags replaced.
+def apply_merge_plan(bookmarks, plan):
+    replace = {p['from']: p['to'] for p in plan}
+    changed = []
+    for b in bookmarks:
+        if not any(t in replace for t in b['tags']):
+            continue
+        tags = []
+        for t in b['tags']:
+            t = replace.get(t, t)
+            if t not in tags:
+                tags.append(t)
+        b = dict(b)
+        b['tags'] = tags
+        changed.append(b)
+    return changed
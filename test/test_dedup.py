@@ -0,0 +1,115 @@
+# Tests for duplicate detection (dedup.py): plain_url, MinHash/LSH, clusters and merging
+
+import numpy as np
+
+import dedup
+from dedup import (MinHasher, find_duplicates, lsh_candidates, merge_cluster,
+                   merge_nc_duplicates, plain_url, shingles)
+
+ARTICLE = ("How to tune the garbage collector of the Java virtual machine for "
+           "low latency services with large heaps and many short lived objects")
+
+def bookmark(id, url, title = "", description = "", **kwargs):
+    return dict(id = id, url = url, title = title, description = description, **kwargs)
+
+def test_plain_url():
+    assert plain_url("http://www.Example.com/page/?utm_source=x&id=1") == \
+        plain_url("https://example.com/page?id=1")
+    # Fragments and other parameters may select another page
+    assert plain_url("https://example.com/page#a") != plain_url("https://example.com/page#b")
+    assert plain_url("https://example.com/page?ref=a") != plain_url("https://example.com/page")
+
+def test_shingles():
+    s = shingles("Hello,   World")
+    assert len(s) == len("hello world") - 4
+    assert len(shingles("abc")) == 0
+    # Repetitions count once
+    assert len(shingles("abcde abcde abcde")) == len(set(shingles("abcde abcde abcde")))
+
+def test_minhash_estimates_similarity():
+    hasher = MinHasher(num_perm = 256)
+    same, similar, other = hasher.signatures([shingles(ARTICLE), shingles(ARTICLE + " (2023)"),
+                                              shingles("A recipe for apple pie with cinnamon and a crunchy crust")])
+    assert np.mean(same == similar) > 0.8
+    assert np.mean(same == other) < 0.2
+
+def test_lsh_candidates():
+    signatures = np.array([[1, 2, 3, 4], [1, 2, 9, 9], [7, 8, 9, 9], [5, 5, 5, 5]], dtype = np.uint64)
+    assert lsh_candidates(signatures, bands = 2) == {(0, 1), (1, 2)}
+    # Overfull buckets are skipped
+    assert lsh_candidates(signatures, bands = 2, max_bucket = 1) == set()
+
+def test_same_address_is_a_url_cluster():
+    clusters = find_duplicates([bookmark(1, "http://www.example.com/a/"),
+                                bookmark(2, "https://example.com/a?utm_source=feed"),
+                                bookmark(3, "https://example.com/b")])
+    assert len(clusters) == 1
+    assert clusters[0]['reason'] == 'url'
+    assert {b['id'] for b in clusters[0]['bookmarks']} == {1, 2}
+
+def test_similar_text_is_a_text_cluster():
+    clusters = find_duplicates([bookmark(1, "https://blog.example.com/gc-tuning", ARTICLE),
+                                bookmark(2, "https://news.example.org/item/42", ARTICLE + "!"),
+                                bookmark(3, "https://example.com/pie", "A recipe for apple pie with cinnamon")])
+    assert len(clusters) == 1
+    assert clusters[0]['reason'] == 'text'
+    assert {b['id'] for b in clusters[0]['bookmarks']} == {1, 2}
+
+def test_llm_description_is_ignored():
+    summary = "# LLM_DESCRIPTION\n" + ARTICLE
+    clusters = find_duplicates([bookmark(1, "https://a.example.com/", "Home", summary),
+                                bookmark(2, "https://b.example.com/", "Start", summary)])
+    assert clusters == []
+
+def test_canonical_only_match_is_not_merged_automatically():
+    # canonical_url drops tracking parameters other than utm_, plain_url does not
+    clusters = find_duplicates([bookmark(1, "https://example.com/a?fbclid=x"),
+                                bookmark(2, "https://example.com/a")])
+    assert len(clusters) == 1 and clusters[0]['reason'] == 'text'
+
+def test_merge_cluster_keeps_the_oldest():
+    cluster = {'bookmarks': [bookmark(2, "https://example.com/", "", "Short", added = 200,
+                                      tags = ['b', 'c'], folders = [2]),
+                             bookmark(1, "http://example.com/", "", "", added = 100,
+                                      tags = ['a', 'b'], folders = [1])],
+               'reason': 'url'}
+    keep, others = merge_cluster(cluster)
+    assert keep['id'] == 1 and [b['id'] for b in others] == [2]
+    assert keep['tags'] == ['a', 'b', 'c']
+    assert keep['folders'] == [1, 2]
+    assert keep['description'] == "Short"
+
+class Mirror:
+    def __init__(self):
+        self.upserted = []
+        self.deleted = []
+
+    def upsert(self, b):
+        self.upserted.append(b['id'])
+
+    def delete(self, id):
+        self.deleted.append(id)
+
+def test_merge_nc_duplicates(monkeypatch):
+    deleted = []
+    monkeypatch.setattr(dedup, "bulk_edit_nc_bookmarks",
+                        lambda bookmarks, silent = False: {'ids': [b['id'] for b in bookmarks]})
+    monkeypatch.setattr(dedup, "delete_nc_bookmark", lambda id: deleted.append(id) or True)
+    clusters = [{'bookmarks': [bookmark(1, "https://a.example/", added = 1),
+                               bookmark(2, "http://a.example/", added = 2)], 'reason': 'url'},
+                {'bookmarks': [bookmark(3, "https://b.example/", added = 1),
+                               bookmark(4, "https://c.example/", added = 2)], 'reason': 'text'}]
+    mirror = Mirror()
+    assert merge_nc_duplicates(clusters, mirror, silent = True) == 1
+    assert deleted == [2] and mirror.upserted == [1] and mirror.deleted == [2]
+    assert merge_nc_duplicates(clusters[1:], Mirror(), include_text = True, silent = True) == 1
+
+def test_nothing_is_deleted_if_the_merge_fails(monkeypatch):
+    deleted = []
+    monkeypatch.setattr(dedup, "bulk_edit_nc_bookmarks",
+                        lambda bookmarks, silent = False: {'ids': [None for b in bookmarks]})
+    monkeypatch.setattr(dedup, "delete_nc_bookmark", lambda id: deleted.append(id) or True)
+    clusters = [{'bookmarks': [bookmark(1, "https://a.example/"),
+                               bookmark(2, "http://a.example/")], 'reason': 'url'}]
+    assert merge_nc_duplicates(clusters, Mirror(), silent = True) == 0
+    assert deleted == []
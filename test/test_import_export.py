@@ -0,0 +1,37 @@
+# Tests for DumpWriter (import_export.py)
+
+import pandas as pd
+
+from import_export import DumpWriter, DIIGO_FIELDS_LIST
+
+def bookmarks(rows):
+    return pd.DataFrame([dict({c: "" for c in DIIGO_FIELDS_LIST}, **r) for r in rows])
+
+def test_appends_only_new_bookmarks(tmp_path):
+    path = str(tmp_path / "dump.csv")
+    writer = DumpWriter(path)
+    assert len(writer.append(bookmarks([{'url': "https://a.com", 'title': "A"},
+                                        {'url': "https://a.com", 'title': "A"}]))) == 1
+    assert len(writer.append(bookmarks([{'url': "https://a.com", 'title': "A"},
+                                        {'url': "https://b.com", 'title': "B"}]))) == 1
+    assert len(pd.read_csv(path)) == 2
+
+def test_keys_are_exact(tmp_path):
+    writer = DumpWriter(str(tmp_path / "dump.csv"))
+    # Distinct Diigo bookmarks, even if the addresses are the same page
+    new = writer.append(bookmarks([{'url': "http://a.com/", 'title': "A"},
+                                   {'url': "https://www.a.com", 'title': "A"}]))
+    assert len(new) == 2
+
+def test_keys_survive_a_restart(tmp_path):
+    path = str(tmp_path / "dump.csv")
+    rows = [{'url': "https://a.com", 'title': None},
+            {'url': "https://b.com", 'title': "nan"},
+            {'url': "https://c.com", 'title': "1234"}]
+    assert len(DumpWriter(path).append(bookmarks(rows))) == 3
+    # A new writer reads the keys from the file
+    assert len(DumpWriter(path).append(bookmarks(rows))) == 0
+
+def test_missing_columns(tmp_path):
+    writer = DumpWriter(str(tmp_path / "dump.csv"))
+    assert writer.append(pd.DataFrame([{'url': "https://a.com"}])) is None
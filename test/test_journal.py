@@ -0,0 +1,42 @@
+# Tests for Journal (journal.py)
+
+import os
+
+from journal import Journal
+
+def test_replay(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path, batch_size = 2)
+    journal.record(1, 'dumped')
+    journal.record(1, 'created', nc_id = 17)
+    journal.record(2, 'dumped')
+    journal.close()
+    journal = Journal(path)
+    assert journal.resuming()
+    assert journal.done(1, 'created')
+    assert journal.get(1, 'created') == {'nc_id': 17}
+    assert journal.done(2, 'dumped') and not journal.done(2, 'created')
+    journal.close()
+
+def test_half_written_line(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    journal.record(1, 'dumped')
+    journal.close()
+    with open(path, 'a') as f:
+        f.write('{"link_id": 2, "sta')
+    journal = Journal(path)
+    assert journal.done(1, 'dumped') and not journal.done(2, 'dumped')
+    # Appended after the broken line, not onto it
+    journal.record(3, 'dumped')
+    journal.close()
+    assert Journal(path).done(3, 'dumped')
+
+def test_finish(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    journal.record(1, 'deleted')
+    journal.finish()
+    assert not os.path.exists(path)
+    assert os.path.exists(path + ".0.done")
+    assert not Journal(path).resuming()
@@ -0,0 +1,128 @@
+# Tests for the dead-link scanner (link_check.py): classification, DNS cache,
+# host interleaving and checks against a local server
+
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import requests
+
+from link_check import (DnsCache, LinkChecker, classify_exception, classify_response,
+                        interleave_by_host)
+
+def dns_error(errno):
+    return requests.exceptions.ConnectionError(socket.gaierror(errno, "DNS"))
+
+def test_classify_exception():
+    assert classify_exception(requests.exceptions.SSLError("bad certificate")) == 'tls'
+    assert classify_exception(requests.exceptions.ConnectTimeout("timed out")) == 'timeout'
+    assert classify_exception(requests.exceptions.MissingSchema("no scheme")) == 'invalid'
+    assert classify_exception(requests.exceptions.ConnectionError("refused")) == 'connection'
+
+def test_only_unknown_hosts_are_dns_errors():
+    assert classify_exception(dns_error(socket.EAI_NONAME)) == 'dns'
+    # A busy resolver does not make a link dead
+    assert classify_exception(dns_error(socket.EAI_AGAIN)) == 'connection'
+
+class Response:
+    def __init__(self, status_code, url, history = []):
+        self.status_code = status_code
+        self.url = url
+        self.history = history
+
+def test_classify_response():
+    url = "https://example.com/a"
+    assert classify_response(Response(200, url), url) == 'ok'
+    assert classify_response(Response(404, url), url) == 'not_found'
+    assert classify_response(Response(410, url), url) == 'gone'
+    assert classify_response(Response(503, url), url) == 'http_error'
+    assert classify_response(Response(200, "https://example.com/b", [Response(301, url)]), url) == 'redirect'
+    # Temporary redirects are not worth changing the bookmark for
+    assert classify_response(Response(200, "https://example.com/b", [Response(302, url)]), url) == 'ok'
+
+# A resolver answering from a dict: an address, or the errno to fail with
+def resolver(answers):
+    calls = []
+    def getaddrinfo(host, *args, **kwargs):
+        calls.append(host)
+        answer = answers[host]
+        if isinstance(answer, int):
+            raise socket.gaierror(answer, "DNS")
+        return answer
+    getaddrinfo.calls = calls
+    return getaddrinfo
+
+def test_dns_cache_asks_once_per_host():
+    dns = DnsCache()
+    dns.original = resolver({'a.example': [('addr',)], 'gone.example': socket.EAI_NONAME})
+    assert dns.getaddrinfo('a.example', 80) == [('addr',)]
+    assert dns.getaddrinfo('a.example', 80) == [('addr',)]
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            dns.getaddrinfo('gone.example', 80)
+    assert dns.original.calls == ['a.example', 'gone.example']
+
+def test_dns_cache_asks_again_after_temporary_failures():
+    dns = DnsCache()
+    dns.original = resolver({'busy.example': socket.EAI_AGAIN})
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            dns.getaddrinfo('busy.example', 80)
+    assert dns.original.calls == ['busy.example', 'busy.example']
+
+def test_dns_cache_install_and_uninstall():
+    original = socket.getaddrinfo
+    dns = DnsCache()
+    dns.install()
+    try:
+        assert socket.getaddrinfo == dns.getaddrinfo
+    finally:
+        dns.uninstall()
+    assert socket.getaddrinfo == original
+
+def test_interleave_by_host():
+    urls = ["https://a.example/1", "https://a.example/2", "https://a.example/3",
+            "https://b.example/1", "https://c.example/1"]
+    hosts = [b['url'].split('/')[2][0] for b in interleave_by_host({'url': u} for u in urls)]
+    assert hosts == ['a', 'b', 'c', 'a', 'a']
+
+class Handler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        if self.path == "/head-refused":
+            # Some servers refuse HEAD, the GET works
+            self.send_response(405)
+        elif self.path == "/moved":
+            self.send_response(301)
+            self.send_header('Location', "/page")
+        elif self.path == "/missing":
+            self.send_response(404)
+        else:
+            self.send_response(200)
+        self.end_headers()
+
+    def do_GET(self):
+        self.send_response(404 if self.path == "/missing" else 200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+def test_link_checker(server):
+    checker = LinkChecker(concurrency = 4, per_host = 2, host_delay = 0, timeout = (2, 2))
+    paths = ["/page", "/head-refused", "/moved", "/missing"]
+    bookmarks = [{'id': n, 'url': server + p} for n, p in enumerate(paths)]
+    results = {b['id']: r for b, r in checker.run(bookmarks)}
+    assert [results[n]['result'] for n in range(len(paths))] == ['ok', 'ok', 'redirect', 'not_found']
+    assert results[2]['final_url'] == server + "/page"
+
+def test_link_checker_invalid_url():
+    assert LinkChecker(concurrency = 1).check("not a url")['result'] == 'invalid'
@@ -0,0 +1,73 @@
+# Tests for LlmPool failover (llm_pool.py), against stub Ollama servers
+
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ollama
+import pytest
+
+from llm_pool import LlmPool
+
+def stub_server(status):
+    class Handler(BaseHTTPRequestHandler):
+        requests = 0
+        def do_POST(self):
+            Handler.requests += 1
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if status == 200:
+                body = {'model': "stub", 'created_at': "2024-01-01T00:00:00Z",
+                        'message': {'role': "assistant", 'content': "hello"}, 'done': True}
+            else:
+                body = {'error': "overloaded"}
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', "application/json")
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server, Handler
+
+@pytest.fixture
+def servers():
+    started = [stub_server(500), stub_server(200)]
+    yield started
+    for server, _ in started:
+        server.shutdown()
+        server.server_close()
+
+def url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def test_fails_over_to_a_working_server(servers):
+    (broken, broken_handler), (working, working_handler) = servers
+    pool = LlmPool(hosts = [url(broken), url(working)], parallel = 1, timeout = 5, cooldown = 60)
+    for _ in range(3):
+        assert pool.chat("stub", [{'role': "user", 'content': "hi"}]) == "hello"
+    health = {h['host']: h for h in pool.health()}
+    # The broken one (first, equally loaded) is tried once, then left alone for the cooldown
+    assert broken_handler.requests == 1
+    assert working_handler.requests == 3
+    assert not health[url(broken)]['up'] and health[url(working)]['up']
+
+def test_unreachable_server(servers):
+    _, (working, _) = servers
+    pool = LlmPool(hosts = [f"http://127.0.0.1:{free_port()}", url(working)],
+                   parallel = 1, timeout = 5)
+    assert pool.chat("stub", [{'role': "user", 'content': "hi"}]) == "hello"
+
+def test_all_servers_failing(servers):
+    (broken, _), _ = servers
+    pool = LlmPool(hosts = [url(broken), f"http://127.0.0.1:{free_port()}"], parallel = 1, timeout = 5)
+    with pytest.raises(ollama.ResponseError):
+        pool.chat("stub", [{'role': "user", 'content': "hi"}])
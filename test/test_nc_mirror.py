@@ -0,0 +1,90 @@
+# Tests for NcMirror refresh/sync (nc_mirror.py), with a fake Nextcloud
+
+import pytest
+
+import nc_mirror
+from nc_mirror import NcMirror
+from tag_index import TagIndex
+
+def bookmark(id, lastmodified, tags = [], folders = [1]):
+    return {'id': id, 'url': f"https://example.com/{id}", 'title': f"B{id}",
+            'tags': list(tags), 'folders': list(folders), 'lastmodified': lastmodified}
+
+class FakeNextcloud:
+    """
+    Serves self.bookmarks like iter_nc_bookmarks, newest first; counts what
+    was handed out, and raises after fail_after bookmarks if set.
+    """
+    def __init__(self, bookmarks):
+        self.bookmarks = bookmarks
+        self.served = 0
+        self.fail_after = None
+
+    def __call__(self, **kwargs):
+        for n, b in enumerate(sorted(self.bookmarks, key = lambda b: -b['lastmodified'])):
+            if self.fail_after != None and n >= self.fail_after:
+                raise ConnectionError("Could not read page 1 of the Nextcloud bookmarks")
+            self.served += 1
+            yield dict(b)
+
+@pytest.fixture
+def nextcloud(monkeypatch, tmp_path):
+    fake = FakeNextcloud([bookmark(i, 100 + i, tags = ["common", f"t{i}"]) for i in range(5)])
+    monkeypatch.setattr(nc_mirror, 'iter_nc_bookmarks', fake)
+    monkeypatch.setattr(nc_mirror, 'TagIndex', lambda: TagIndex(str(tmp_path / "tags.json")))
+    return fake
+
+@pytest.fixture
+def mirror(nextcloud, tmp_path):
+    m = NcMirror(str(tmp_path / "mirror.sqlite"))
+    yield m
+    m.close()
+
+def test_refresh_and_lookups(nextcloud, mirror):
+    assert mirror.refresh() == 5
+    assert mirror.count() == 5
+    assert [b['id'] for b in mirror.find_url("http://www.example.com/3/")] == [3]
+    assert len(mirror.find_tag("common")) == 5
+    assert len(mirror.find_folder(1)) == 5
+    assert mirror.tags.counts()['common'] == 5
+    assert not mirror.is_stale(3600)
+
+def test_sync_stops_at_the_high_water_mark(nextcloud, mirror):
+    mirror.refresh()
+    nextcloud.bookmarks[2] = bookmark(2, 200, tags = ["changed"])
+    nextcloud.bookmarks.append(bookmark(9, 201))
+    nextcloud.served = 0
+    assert mirror.sync() == 3
+    # The two changed ones, and the one at the old high-water mark
+    assert nextcloud.served == 4
+    assert mirror.get(2)['tags'] == ["changed"]
+    assert mirror.get(9) != None
+    assert mirror.tags.counts()['common'] == 4
+
+def test_failed_refresh_keeps_the_old_copy(nextcloud, mirror):
+    mirror.refresh()
+    last_sync = mirror.last_sync()
+    nextcloud.bookmarks = [bookmark(i, 300 + i) for i in range(10, 20)]
+    nextcloud.fail_after = 3
+    assert mirror.refresh() == None
+    assert mirror.count() == 5 and mirror.get(10) == None
+    assert mirror.last_sync() == last_sync
+    assert mirror.tags.counts()['common'] == 5
+
+def test_failed_sync_keeps_the_high_water_mark(nextcloud, mirror):
+    mirror.refresh()
+    nextcloud.bookmarks += [bookmark(i, 300 + i) for i in range(10, 20)]
+    nextcloud.fail_after = 3
+    assert mirror.sync() == None
+    assert mirror.get(19) == None
+    # The next sync fetches all of them
+    nextcloud.fail_after = None
+    assert mirror.sync() == 11
+
+def test_full_refresh_notices_deletions(nextcloud, mirror):
+    mirror.refresh()
+    del nextcloud.bookmarks[0]
+    assert mirror.sync() == 1
+    assert mirror.get(0) != None
+    assert mirror.sync(full_max_age = 0) == 4
+    assert mirror.get(0) == None
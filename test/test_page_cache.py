@@ -0,0 +1,126 @@
+# Tests for PageCache (page_cache.py): conditional GET, TTLs, failures, LRU eviction
+
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import requests
+
+from page_cache import PageCache, host_unknown
+
+PAGE = b"<html><head><title>Page</title></head><body>" + b"x" * 1000 + b"</body></html>"
+
+class Handler(BaseHTTPRequestHandler):
+    hits = []
+
+    def do_GET(self):
+        Handler.hits.append((self.path, self.headers.get('If-None-Match')))
+        if self.path.startswith("/page"):
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+            self.wfile.write(PAGE + self.path.encode())
+        elif self.path == "/missing":
+            self.send_response(404)
+            self.end_headers()
+        else:
+            self.send_response(503)
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+@pytest.fixture
+def cache(tmp_path):
+    Handler.hits.clear()
+    c = PageCache(path=str(tmp_path), ttl=3600, error_ttl=3600, retry_ttl=3600,
+                  max_size=10**6, timeout=(2, 2), max_bytes=10**5, max_seconds=5)
+    yield c
+    c.close()
+
+def age(cache, url, seconds):
+    with cache.lock:
+        cache.db.execute("UPDATE pages SET fetched_at = fetched_at - ? WHERE url = ?", (seconds, url))
+        cache.db.commit()
+
+def test_page_served_from_cache_within_ttl(cache, server):
+    first = cache.fetch(server + "/page", silent=True)
+    second = cache.fetch(server + "/page", silent=True)
+    assert first['status'] == 200 and not first['from_cache']
+    assert second['from_cache'] and second['text'] == first['text']
+    assert len(Handler.hits) == 1
+
+def test_conditional_get_after_ttl(cache, server):
+    cache.fetch(server + "/page", silent=True)
+    age(cache, server + "/page", 7200)
+    page = cache.fetch(server + "/page", silent=True)
+    assert Handler.hits[-1] == ("/page", '"v1"')
+    assert page['status'] == 200 and page['from_cache']
+    assert "Page" in page['text']
+
+def test_not_found_is_permanent(cache, server):
+    page = cache.fetch(server + "/missing", silent=True)
+    assert page['status'] == 404 and not page['transient']
+    cache.retry_ttl = 0
+    assert cache.fetch(server + "/missing", silent=True)['from_cache']
+    assert len(Handler.hits) == 1
+
+def test_server_error_is_transient(cache, server):
+    page = cache.fetch(server + "/broken", silent=True)
+    assert page['status'] == 503 and page['transient']
+    assert cache.fetch(server + "/broken", silent=True)['from_cache']
+    # Retried once retry_ttl is over, even though error_ttl is not
+    age(cache, server + "/broken", 10)
+    cache.retry_ttl = 5
+    assert not cache.fetch(server + "/broken", silent=True)['from_cache']
+    assert len(Handler.hits) == 2
+
+def test_connection_error_is_transient(cache):
+    # Nothing listens on port 9 (discard) here
+    page = cache.fetch("http://127.0.0.1:9/", silent=True)
+    assert page['status'] == None and page['transient']
+
+def test_unknown_host_is_permanent(cache, monkeypatch):
+    def get(url, **kwargs):
+        raise requests.exceptions.ConnectionError(
+            socket.gaierror(socket.EAI_NONAME, "Name or service not known"))
+    monkeypatch.setattr(requests, "get", get)
+    page = cache.fetch("http://no-such-host.invalid/", silent=True)
+    assert page['status'] == None and not page['transient']
+
+def test_host_unknown():
+    assert host_unknown(requests.exceptions.ConnectionError(
+        socket.gaierror(socket.EAI_NONAME, "Name or service not known")))
+    assert not host_unknown(requests.exceptions.ConnectionError(
+        socket.gaierror(socket.EAI_AGAIN, "Temporary failure in name resolution")))
+    assert not host_unknown(requests.exceptions.ReadTimeout("timed out"))
+
+def test_least_recently_used_pages_are_evicted(cache, server):
+    cache.max_size = 2500
+    cache.fetch(server + "/page1", silent=True)
+    time.sleep(0.01)
+    cache.fetch(server + "/page2", silent=True)
+    time.sleep(0.01)
+    # page1 is used again, so page2 is the oldest
+    cache.fetch(server + "/page1", silent=True)
+    time.sleep(0.01)
+    cache.fetch(server + "/page3", silent=True)
+    assert cache.total_size() <= 2500
+    assert cache._get_entry(server + "/page2") == None
+    assert cache._get_entry(server + "/page1") != None
+    assert cache._get_entry(server + "/page3") != None
@@ -0,0 +1,46 @@
+# Tests for Pipeline (pipeline.py)
+
+import threading
+
+from pipeline import Pipeline
+
+def test_all_items_pass_and_every_stage_ends():
+    out = []
+    lock = threading.Lock()
+    def collect(x):
+        with lock:
+            out.append(x)
+        return x
+    pipe = Pipeline(queue_size = 2)
+    pipe.add_stage("split", lambda page: page, fan_out = True)
+    pipe.add_stage("double", lambda x: 2 * x, workers = 4)
+    pipe.add_stage("collect", collect, workers = 3)
+    stats = pipe.run([list(range(i, i + 10)) for i in range(0, 100, 10)])
+    assert sorted(out) == [2 * i for i in range(100)]
+    assert stats['double'] == {'processed': 100, 'dropped': 0, 'errors': 0}
+
+def test_drops_errors_and_finish():
+    flushed = []
+    def fail_on_3(x):
+        if x == 3:
+            raise ValueError("3")
+        return x if x % 2 == 0 else None
+    pipe = Pipeline()
+    pipe.add_stage("filter", fail_on_3, workers = 2)
+    pipe.add_stage("last", lambda x: x, finish = lambda: flushed.append(True))
+    stats = pipe.run(range(10))
+    assert stats['filter'] == {'processed': 9, 'dropped': 4, 'errors': 1}
+    assert stats['last']['processed'] == 5
+    assert flushed == [True]
+
+def test_failing_source_shuts_down():
+    def source():
+        yield 1
+        yield 2
+        raise ConnectionError("page 3")
+    pipe = Pipeline()
+    pipe.add_stage("a", lambda x: x, workers = 3)
+    pipe.add_stage("b", lambda x: x, workers = 2)
+    # Returns instead of hanging, with what got through
+    stats = pipe.run(source())
+    assert stats['b']['processed'] == 2
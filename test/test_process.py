@@ -0,0 +1,93 @@
+# Tests for canonical_url, extract_main_content and suggest_description (process.py)
+
+import ollama
+import pytest
+from bs4 import BeautifulSoup
+
+import process
+from process import canonical_url, extract_main_content, suggest_description
+
+def test_trivial_variants_are_equal():
+    a = canonical_url("http://www.example.com/page/")
+    assert canonical_url("https://example.com/page") == a
+    assert canonical_url("HTTPS://WWW.Example.com:443/page") == a
+
+def test_tracking_parameters_are_dropped():
+    assert canonical_url("https://example.com/a?utm_source=x&id=3&fbclid=y") == \
+        canonical_url("https://example.com/a?id=3")
+
+def test_query_order_does_not_matter():
+    assert canonical_url("https://example.com/a?b=2&a=1") == canonical_url("https://example.com/a?a=1&b=2")
+
+def test_content_parameters_are_kept():
+    # 'ref' and 'share' often select what is shown
+    assert canonical_url("https://example.com/a?ref=main") != canonical_url("https://example.com/a?ref=dev")
+    assert canonical_url("https://example.com/a?share=1") != canonical_url("https://example.com/a")
+
+def test_fragments():
+    assert canonical_url("https://example.com/a#section") == canonical_url("https://example.com/a")
+    assert canonical_url("https://example.com/#!/one") != canonical_url("https://example.com/#!/two")
+
+def test_other_schemes_and_ports():
+    assert canonical_url("ftp://example.com/a/") == "ftp://example.com/a/"
+    assert canonical_url("https://example.com:8080/a") != canonical_url("https://example.com/a")
+
+def extract(html):
+    return extract_main_content(BeautifulSoup(html, 'html.parser'))
+
+ARTICLE = "Real article text here. " * 20
+
+def test_main_content_without_boilerplate():
+    text = extract(f"""<body><nav>Home About</nav><main><h1>Title</h1><p>{ARTICLE}</p>
+        <div class="share-buttons">Share</div><div class="unavailable">Sold out</div></main>
+        <footer>Imprint</footer></body>""")
+    assert text.startswith("Title\nReal article text here.")
+    assert "Share" not in text and "Home" not in text and "Imprint" not in text
+    # "unavailable" is no "nav"
+    assert "Sold out" in text
+
+def test_wrapper_with_boilerplate_class_is_kept():
+    assert extract('<body><div class="layout-header-fixed"><p>Real article text here.</p></div></body>') \
+        == "Real article text here."
+    text = extract(f"""<body><div class="layout-with-sidebar"><div class="sidebar">Links</div>
+        <p>{ARTICLE}</p></div></body>""")
+    assert ARTICLE.strip() in text and "Links" not in text
+
+def test_post_inside_main_is_kept():
+    text = extract(f"""<body><main><div class="post has-comments"><p>{ARTICLE}</p>
+        <div class="comments">First!</div></div></main><nav>x</nav></body>""")
+    assert ARTICLE.strip() in text and "First!" not in text and "x" not in text.split()
+
+def test_falls_back_to_the_unmodified_page():
+    # Everything in the main content looks like boilerplate
+    text = extract(f"""<body><main><div class="cookie-banner">We use cookies</div></main>
+        <div class="content"><p>{ARTICLE}</p></div><script>var x;</script></body>""")
+    assert ARTICLE.strip() in text and "var x" not in text
+
+class Cache:
+    def __init__(self, page):
+        self.page = page
+
+    def fetch(self, url, silent = False):
+        return dict(self.page, url = url, error = None, headers = {}, insecure = False, from_cache = False)
+
+def page_cache(monkeypatch, status, transient = False, text = ""):
+    monkeypatch.setattr(process, "get_page_cache",
+                        lambda: Cache({'status': status, 'transient': transient, 'text': text}))
+
+def test_page_gone_gives_no_description(monkeypatch):
+    page_cache(monkeypatch, 404)
+    assert suggest_description("https://example.com/gone", silent = True) == None
+
+def test_page_unreachable_for_now_raises(monkeypatch):
+    page_cache(monkeypatch, None, transient = True)
+    with pytest.raises(ConnectionError):
+        suggest_description("https://example.com/slow", silent = True)
+
+def test_llm_failure_raises(monkeypatch):
+    page_cache(monkeypatch, 200, text = "<html><body><p>Some text</p></body></html>")
+    def summarize_content(*args):
+        raise ollama.ResponseError("model not found")
+    monkeypatch.setattr(process, "summarize_content", summarize_content)
+    with pytest.raises(ollama.ResponseError):
+        suggest_description("https://example.com/page", silent = True)
@@ -0,0 +1,113 @@
+# Tests for RateLimiter (rate_limit.py): retries, AIMD, circuit breaker
+
+import threading
+import time
+
+import pytest
+import requests
+
+from rate_limit import RateLimiter
+
+class Response:
+    def __init__(self, status_code, headers = {}):
+        self.status_code = status_code
+        self.headers = headers
+
+def limiter(**kwargs):
+    settings = dict(rate = 1000, burst = 1000, backoff_base = 0.001, backoff_max = 0.01,
+                    failure_threshold = 100, cooldown = 0.2)
+    settings.update(kwargs)
+    return RateLimiter("test", **settings)
+
+# A function answering with the given results in turn (an exception is raised)
+def server(*results):
+    calls = []
+    def func():
+        r = results[min(len(calls), len(results) - 1)]
+        calls.append(time.monotonic())
+        if isinstance(r, Exception):
+            raise r
+        return Response(r)
+    func.calls = calls
+    return func
+
+def test_retries_until_success():
+    func = server(503, 429, 200)
+    assert limiter().call(func).status_code == 200
+    assert len(func.calls) == 3
+
+def test_gives_up_after_max_retries():
+    func = server(500)
+    assert limiter(max_retries = 2).call(func).status_code == 500
+    assert len(func.calls) == 3
+    func = server(requests.exceptions.ConnectionError())
+    with pytest.raises(requests.exceptions.ConnectionError):
+        limiter(max_retries = 2).call(func)
+
+def test_no_retry_for_client_errors():
+    func = server(404)
+    assert limiter().call(func).status_code == 404
+    assert len(func.calls) == 1
+
+def test_aimd():
+    l = limiter(rate = 10, max_rate = 12, increase = 1, decrease = 0.5)
+    l.call(server(503, 200))
+    assert l.rate == 6
+    for _ in range(10):
+        l.call(server(200))
+    assert l.rate == 12
+
+def test_read_timeout_is_not_retried_for_posts():
+    func = server(requests.exceptions.ReadTimeout(), 200)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        limiter().call(func, idempotent = False)
+    assert len(func.calls) == 1
+    # ...but for a GET
+    func = server(requests.exceptions.ReadTimeout(), 200)
+    assert limiter().call(func).status_code == 200
+    # ...and if the request never got out
+    func = server(requests.exceptions.ConnectTimeout(), 200)
+    assert limiter().call(func, idempotent = False).status_code == 200
+
+def test_circuit_opens_and_a_probe_closes_it():
+    l = limiter(failure_threshold = 3, max_retries = 0)
+    for _ in range(3):
+        l.call(server(503))
+    # Open: the counter starts again, and the next call waits for the cooldown
+    assert l.failures == 0 and l.half_open
+    start = time.monotonic()
+    assert l.call(server(200)).status_code == 200
+    assert time.monotonic() - start >= 0.15
+    assert not l.half_open
+    # Closed again: no waiting
+    start = time.monotonic()
+    l.call(server(200))
+    assert time.monotonic() - start < 0.1
+
+def test_failing_probe_opens_the_circuit_again():
+    l = limiter(failure_threshold = 3, max_retries = 0)
+    for _ in range(3):
+        l.call(server(503))
+    # One failed probe is enough to pause again, not another three failures
+    l.call(server(503))
+    assert l.open_until > time.monotonic() + 0.1
+
+def test_others_wait_for_the_probe():
+    l = limiter(failure_threshold = 1, max_retries = 0, cooldown = 0.05)
+    l.call(server(503))
+    probe_running = threading.Event()
+    order = []
+    def slow():
+        probe_running.set()
+        time.sleep(0.2)
+        order.append("probe")
+        return Response(200)
+    def quick():
+        order.append("other")
+        return Response(200)
+    t = threading.Thread(target = l.call, args = (slow,))
+    t.start()
+    probe_running.wait(1)
+    l.call(quick)
+    t.join()
+    assert order == ["probe", "other"]
@@ -0,0 +1,83 @@
+# Tests for priority scheduling (scheduler.py)
+
+import time
+
+from scheduler import PriorityScorer, Scheduler, format_duration, own_description
+
+DAY = 86400
+OLD = time.time() - 1000 * DAY
+UNREAD = 7
+
+def bookmark(id, folders = [1], clickcount = 0, added = OLD, description = "Mine"):
+    return {'id': id, 'folders': folders, 'clickcount': clickcount, 'added': added,
+            'description': description}
+
+def scorer():
+    return PriorityScorer(UNREAD, weights = {'unread': 100, 'clicked': 10, 'recent': 20, 'undescribed': 5},
+                          recent_days = 30)
+
+def test_own_description():
+    assert own_description({'description': "Mine\n# BOOKMARKED\n2020\n# LLM_DESCRIPTION\nText"}) == "Mine"
+    assert own_description({'description': "# LLM_DESCRIPTION\nText"}) == ""
+
+def test_tiers():
+    score = scorer()
+    assert score(bookmark(1, folders = [1, UNREAD], clickcount = 3))[1] == 'unread'
+    assert score(bookmark(2, clickcount = 3))[1] == 'clicked'
+    assert score(bookmark(3, added = time.time() - DAY))[1] == 'recent'
+    assert score(bookmark(4, description = ""))[1] == 'undescribed'
+    assert score(bookmark(5))[1] == 'other'
+    # Without a date it is not recent
+    assert score(bookmark(6, added = None))[1] == 'other'
+
+def test_scores():
+    score = scorer()
+    assert score(bookmark(1, folders = [UNREAD]))[0] > score(bookmark(2, clickcount = 100))[0]
+    assert score(bookmark(1, clickcount = 3))[0] > score(bookmark(2, clickcount = 1))[0]
+    assert score(bookmark(1, added = time.time() - DAY))[0] > score(bookmark(2, added = time.time() - 60 * DAY))[0]
+    assert score(bookmark(1, description = ""))[0] > score(bookmark(2))[0]
+
+def test_no_unread_folder():
+    score = PriorityScorer(None)
+    assert score(bookmark(1, folders = [UNREAD]))[1] == 'other'
+
+def test_highest_score_first():
+    bookmarks = [bookmark(1), bookmark(2, clickcount = 5), bookmark(3, folders = [UNREAD]),
+                 bookmark(4, description = "")]
+    assert [b['id'] for b in Scheduler(bookmarks, scorer())] == [3, 2, 4, 1]
+
+def test_equal_scores_keep_their_order():
+    scheduler = Scheduler([bookmark(i) for i in [5, 3, 9]], scorer())
+    assert [b['id'] for b in scheduler] == [5, 3, 9]
+
+def test_push():
+    scheduler = Scheduler([bookmark(1)], scorer())
+    scheduler.push(bookmark(2, folders = [UNREAD]))
+    assert len(scheduler) == 2
+    assert next(scheduler)['id'] == 2
+
+def test_eta():
+    bookmarks = [bookmark(1, folders = [UNREAD]), bookmark(2, folders = [UNREAD]),
+                 bookmark(3, clickcount = 1), bookmark(4)]
+    eta = Scheduler(bookmarks, scorer(), rate = 0.5).eta()
+    assert list(eta) == ['unread', 'clicked', 'other']
+    assert eta['unread'] == {'count': 2, 'eta': 4}
+    assert eta['clicked'] == {'count': 1, 'eta': 6}
+    assert eta['other'] == {'count': 1, 'eta': 8}
+
+def test_eta_without_a_rate():
+    eta = Scheduler([bookmark(1)], scorer()).eta()
+    assert eta == {'other': {'count': 1, 'eta': None}}
+
+def test_measured_rate():
+    scheduler = Scheduler([], scorer(), rate = 1)
+    assert scheduler.rate() == 1
+    scheduler.start -= 10
+    for _ in range(20):
+        scheduler.done()
+    assert 1.5 < scheduler.rate() <= 2
+
+def test_format_duration():
+    assert format_duration(12 * 60) == "12m"
+    assert format_duration(4 * 3600 + 10 * 60) == "4h 10m"
+    assert format_duration(2 * DAY + 3 * 3600) == "2d 3h"
@@ -0,0 +1,77 @@
+# Tests for the incremental tag index (tag_index.py)
+
+import json
+
+import pytest
+
+from tag_index import TagIndex
+
+def bookmark(id, tags, added = 100, lastmodified = 200):
+    return {'id': id, 'tags': list(tags), 'added': added, 'lastmodified': lastmodified}
+
+@pytest.fixture
+def index(tmp_path):
+    return TagIndex(str(tmp_path / "tags.json"))
+
+def test_update_counts_and_dates(index):
+    index.update(bookmark(1, ["a", "b"], added = 100, lastmodified = 300))
+    index.update(bookmark(2, ["a"], added = 50, lastmodified = 200))
+    assert index.counts() == {'a': 2, 'b': 1}
+    assert list(index.counts()) == ['a', 'b']
+    e = index.get("a")
+    assert e['ids'] == {1, 2}
+    assert (e['first_seen'], e['last_seen']) == (50, 300)
+
+def test_updating_a_bookmark_twice_counts_once(index):
+    index.update(bookmark(1, ["a"]))
+    index.update(bookmark(1, ["a"]), old_tags = ["a"])
+    assert index.counts() == {'a': 1}
+
+def test_changed_tags(index):
+    index.update(bookmark(1, ["a", "b"]))
+    index.update(bookmark(1, ["b", "c"]), old_tags = ["a", "b"])
+    assert index.counts() == {'b': 1, 'c': 1}
+    assert index.get("a") == None
+
+def test_remove(index):
+    index.update(bookmark(1, ["a", "b"]))
+    index.update(bookmark(2, ["a"]))
+    index.remove(1, ["a", "b"])
+    assert index.counts() == {'a': 1}
+    # Removing again changes nothing
+    index.remove(1, ["a"])
+    assert index.counts() == {'a': 1}
+
+def test_unique_tags_and_single_use_ids(index):
+    index.update(bookmark(1, ["only1", "also1"]))
+    index.update(bookmark(2, ["common", "only2"]))
+    index.update(bookmark(3, ["common"]))
+    assert sorted(index.unique_tags()) == ["also1", "only1", "only2"]
+    # Bookmark 2 has a tag used elsewhere, too
+    assert index.single_use_ids() == [1]
+
+def test_save_and_load(index, tmp_path):
+    index.update(bookmark(1, ["a", "b"]))
+    index.update(bookmark(2, ["a"]))
+    saved_at = index.save()
+    loaded = TagIndex(str(tmp_path / "tags.json"))
+    assert loaded.saved_at == saved_at
+    assert loaded.counts() == index.counts()
+    assert loaded.get("a")['ids'] == {1, 2}
+    # Nothing changed: not written again
+    assert index.save() == saved_at
+
+def test_checkpoint(tmp_path):
+    index = TagIndex(str(tmp_path / "tags.json"), save_every = 3)
+    index.update(bookmark(1, ["a"]))
+    index.update(bookmark(2, ["a"]))
+    assert index.checkpoint() == None
+    index.update(bookmark(3, ["a"]))
+    assert index.checkpoint() != None
+    with open(tmp_path / "tags.json") as f:
+        assert json.load(f)['tags']['a']['count'] == 3
+
+def test_unreadable_file_starts_empty(tmp_path):
+    (tmp_path / "tags.json").write_text("{not json")
+    index = TagIndex(str(tmp_path / "tags.json"))
+    assert index.counts() == {} and index.saved_at == None
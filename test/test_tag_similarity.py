@@ -0,0 +1,24 @@
+# Tests for cluster_tags and merge_plan (tag_similarity.py)
+
+from tag_similarity import normalize_tag, cluster_tags, merge_plan
+
+def test_normalize_tag():
+    assert normalize_tag("Java-Script") == "java script"
+    assert normalize_tag("C++") == "c++"
+    assert normalize_tag("C#") == "c#"
+
+def test_misspellings_are_clustered():
+    clusters = cluster_tags({'javascript': 20, 'javscript': 2, 'Java_Script': 1, 'python': 10})
+    assert len(clusters) == 1
+    assert clusters[0]['tag'] == 'javascript'
+    assert {v for v, _, _ in clusters[0]['variants']} == {'javscript', 'Java_Script'}
+
+def test_different_things_stay_apart():
+    # Short tags, numbers, "+" and "#"
+    assert cluster_tags({'cat': 5, 'car': 3, 'covid19': 4, 'covid20': 2,
+                         'c': 9, 'c++': 7, 'c#': 6, 'notepad': 4, 'notepad++': 3}) == []
+
+def test_merge_plan_leaves_frequent_variants():
+    clusters = cluster_tags({'javascript': 20, 'javscript': 2, 'JavaScript': 15})
+    plan = merge_plan(clusters, max_share = 0.5)
+    assert plan == [{'from': 'javscript', 'to': 'javascript', 'count': 2, 'distance': 1}]
@@ -0,0 +1,84 @@
+# Tests for the persistent work list (work_queue.py)
+
+import sqlite3
+
+import pytest
+
+from work_queue import WorkQueue
+
+@pytest.fixture
+def queue(tmp_path):
+    q = WorkQueue(str(tmp_path / "queue.sqlite"), max_retries = 2)
+    yield q
+    q.close()
+
+def test_add_and_todo_by_id(queue):
+    queue.add([{'id': 3}, {'id': 1}, {'id': 2}])
+    queue.add([{'id': 4}], done = True)
+    assert queue.todo() == [1, 2, 3]
+    assert queue.counts() == {'pending': 3, 'done': 1, 'unreachable': 0, 'failed': 0}
+
+def test_adding_again_keeps_the_status(queue):
+    queue.add([{'id': 1, 'title': "old"}])
+    queue.set(1, 'done')
+    queue.add([{'id': 1, 'title': "new"}])
+    assert queue.get(1)['status'] == 'done'
+    assert queue.bookmark(1)['title'] == "new"
+
+def test_failed_items_are_retried_last(queue):
+    queue.add([{'id': 1}, {'id': 2}, {'id': 3}])
+    queue.set(1, 'failed', "timeout")
+    queue.set(2, 'unreachable')
+    assert queue.todo() == [3, 1]
+    assert queue.get(1) == {'status': 'failed', 'retries': 1, 'error': "timeout"}
+
+def test_retries_run_out(queue):
+    queue.add([{'id': 1}])
+    queue.set(1, 'failed', "timeout")
+    queue.set(1, 'failed', "timeout")
+    assert queue.get(1)['retries'] == 2
+    assert queue.todo() == []
+
+def test_reset(queue):
+    queue.add([{'id': 1}, {'id': 2}, {'id': 3}])
+    queue.set(1, 'unreachable')
+    queue.set(2, 'unreachable')
+    queue.set(3, 'done')
+    assert queue.reset('unreachable') == 2
+    assert queue.todo() == [1, 2]
+
+def test_remove_and_statuses(queue):
+    queue.add([{'id': 1}, {'id': 2}])
+    queue.set(2, 'done')
+    queue.remove([1])
+    assert queue.statuses() == {2: 'done'}
+    assert queue.get(1) == None and queue.bookmark(1) == None
+
+def test_meta(queue):
+    assert queue.get_meta('last_run') == None
+    queue.set_meta('last_run', 123.5)
+    assert queue.get_meta('last_run') == "123.5"
+
+def test_survives_a_restart(tmp_path):
+    path = str(tmp_path / "queue.sqlite")
+    q = WorkQueue(path, max_retries = 3)
+    q.add([{'id': 1}, {'id': 2}])
+    q.set(1, 'done')
+    q.close()
+    q = WorkQueue(path, max_retries = 3)
+    assert q.todo() == [2]
+    q.close()
+
+def test_old_lists_get_the_bookmark_column(tmp_path):
+    path = str(tmp_path / "queue.sqlite")
+    db = sqlite3.connect(path)
+    db.execute("""CREATE TABLE items (id INTEGER PRIMARY KEY, status TEXT,
+                  retries INTEGER DEFAULT 0, updated REAL, error TEXT)""")
+    db.execute("INSERT INTO items (id, status) VALUES (1, 'pending')")
+    db.commit()
+    db.close()
+    q = WorkQueue(path, max_retries = 3)
+    assert q.todo() == [1] and q.bookmark(1) == None
+    q.add([{'id': 1, 'url': "https://example.com/"}])
+    assert q.bookmark(1)['url'] == "https://example.com/"
+    q.close()
@@ -0,0 +1,168 @@
+# work_queue.py
+#
+# Persistent work list for jobs that run over the Nextcloud bookmarks and take
+# days, like the LLM descriptions (nc_llm_improve.py).
+#
+# Every bookmark ID has a status:
+#   pending      still to do
+#   done         finished (or nothing to do)
+#   unreachable  the web page could not be read
+#   failed       something went wrong; tried again on the next run, up to
+#                max_retries times
+# The list is kept in SQLite (default: LLM_QUEUE_PATH), and every change is
+# committed at once - so a run can be stopped at any time, and the next one
+# continues with what is still pending. Items that were in the works when a
+# run died are still pending.
+#
+# The list also keeps the bookmarks themselves, as they were when they were
+# added, so a run needs neither a full download nor the mirror to work on
+# them - and its 'done' items are the index of what is already enriched.
+#
+#   queue = WorkQueue()
+#   queue.add(bookmarks)
+#   for id in queue.todo(): b = queue.bookmark(id) ... queue.set(id, 'done')
+
+import os
+import json
+import sqlite3
+import threading
+import time
+
+from config import *
+
+STATUSES = ['pending', 'done', 'unreachable', 'failed']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    status TEXT,
+    retries INTEGER DEFAULT 0,
+    updated REAL,
+    error TEXT,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_items_status ON items(status);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+class WorkQueue:
+    """
+    Bookmark ID -> status, retries, time of the last change, last error.
+
+    - path: SQLite file (default: LLM_QUEUE_PATH)
+    - max_retries: failed items are tried again until they have failed this
+      often (config: llm_improve_max_retries)
+    """
+    def __init__(self, path = LLM_QUEUE_PATH, max_retries = None):
+        path = os.path.expanduser(path)
+        directory = os.path.dirname(path)
+        if directory != "" and not os.path.exists(directory):
+            os.mkdir(directory)
+        self.path = path
+        if max_retries == None:
+            max_retries = get_setting('llm_improve_max_retries', 3)
+        self.max_retries = max_retries
+        # Shared by the worker threads; serialize access
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        # Lists from before the bookmarks were kept
+        if 'data' not in [r[1] for r in self.db.execute("PRAGMA table_info(items)")]:
+            self.db.execute("ALTER TABLE items ADD COLUMN data TEXT")
+        self.db.commit()
+
+    # Add bookmarks (dicts with 'id') that are not in the list yet, as pending -
+    # or, if done is True, as already done. For those already in the list,
+    # only the stored bookmark is replaced.
+    def add(self, bookmarks, done = False):
+        status = 'done' if done else 'pending'
+        now = time.time()
+        with self.lock:
+            self.db.executemany("""INSERT INTO items (id, status, updated, data) VALUES (?,?,?,?)
+                                   ON CONFLICT(id) DO UPDATE SET data = excluded.data""",
+                                [(b['id'], status, now, json.dumps(b)) for b in bookmarks])
+            self.db.commit()
+
+    # Set the status of an item; 'failed' counts a retry
+    def set(self, id, status, error = None):
+        with self.lock:
+            if status == 'failed':
+                self.db.execute("""INSERT INTO items (id, status, retries, updated, error) VALUES (?,?,1,?,?)
+                                   ON CONFLICT(id) DO UPDATE SET status = excluded.status,
+                                   retries = retries + 1, updated = excluded.updated, error = excluded.error""",
+                                (id, status, time.time(), error))
+            else:
+                self.db.execute("""INSERT INTO items (id, status, updated, error) VALUES (?,?,?,?)
+                                   ON CONFLICT(id) DO UPDATE SET status = excluded.status,
+                                   updated = excluded.updated, error = excluded.error""",
+                                (id, status, time.time(), error))
+            self.db.commit()
+
+    # Put items back on the list, e.g. all 'unreachable' ones
+    def reset(self, status):
+        with self.lock:
+            n = self.db.execute("UPDATE items SET status = 'pending', retries = 0 WHERE status = ?",
+                                (status,)).rowcount
+            self.db.commit()
+        return n
+
+    def get(self, id):
+        with self.lock:
+            row = self.db.execute("SELECT status, retries, error FROM items WHERE id = ?", (id,)).fetchone()
+        if row == None:
+            return None
+        return {'status': row[0], 'retries': row[1], 'error': row[2]}
+
+    # The bookmark as stored with the item, None if there is none
+    def bookmark(self, id):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM items WHERE id = ?", (id,)).fetchone()
+        if row == None or row[0] == None:
+            return None
+        return json.loads(row[0])
+
+    def remove(self, ids):
+        with self.lock:
+            self.db.executemany("DELETE FROM items WHERE id = ?", [(id,) for id in ids])
+            self.db.commit()
+
+    # Dict id -> status of all items
+    def statuses(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT id, status FROM items").fetchall())
+
+    # IDs still to do: pending ones, then failed ones with retries left,
+    # each by ID (the rowid)
+    def todo(self):
+        with self.lock:
+            return [r[0] for r in self.db.execute(
+                """SELECT id FROM items WHERE status = 'pending'
+                   OR (status = 'failed' AND retries < ?)
+                   ORDER BY status = 'failed', rowid""", (self.max_retries,))]
+
+    # Dict status -> number of items
+    def counts(self):
+        with self.lock:
+            rows = self.db.execute("SELECT status, COUNT(*) FROM items GROUP BY status").fetchall()
+        counts = {s: 0 for s in STATUSES}
+        counts.update(dict(rows))
+        return counts
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES (?,?)", (key, str(value)))
+            self.db.commit()
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row == None:
+            return None
+        return row[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()